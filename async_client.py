@@ -0,0 +1,264 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+import config
+import errors
+import oauth2
+
+# An asyncio counterpart to oauth2.OAuth2Client and main.ReceiptsClient for pushing
+# many receipts concurrently from a single process. The interactive OAuth2 flow is
+# not repeated here: authorise with OAuth2Client first, then hand it over with
+# AsyncOAuth2Client.from_client(), which keeps using its tokens, refreshed as they
+# expire, and its client-side rate limits.
+
+class AsyncOAuth2Client:
+    ''' Sends API calls to the Monzo API over a shared aiohttp connection pool, with at
+        most `concurrency` requests in flight at any time and a timeout on each request.
+        Given a token_client, an oauth2.OAuth2Client, its current access token is sent
+        instead of access_token, refreshed before it expires and once more if the API
+        rejects it, and its response cache is kept from serving receipts written here.
+        Given a rate_limiter, a ratelimit.RequestLimiter, every request waits for it first.
+    '''
+
+    def __init__(self, access_token, user_id="", concurrency=None, timeout=None, token_client=None,
+        rate_limiter=None):
+        self._access_token = access_token
+        self._user_id = user_id
+        self._token_client = token_client
+        self._rate_limiter = rate_limiter
+        self._concurrency = concurrency or getattr(config, "MONZO_ASYNC_CONCURRENCY", 32)
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        self._timeout = aiohttp.ClientTimeout(total=timeout or getattr(config, "MONZO_HTTP_TIMEOUT", 10))
+        self._session = None
+        self._limiter_executor = None
+        # Waits for the rate limiter block, and get threads of their own, so that they do
+        # not hold up the event loop's default executor.
+
+
+    @classmethod
+    def from_client(cls, client, **kwargs):
+        ''' Builds an async client sharing the tokens and rate limits of an authorised
+            oauth2.OAuth2Client.
+        '''
+        return cls(client._access_token, client._user_id, token_client=client,
+            rate_limiter=client._rate_limiter, **kwargs)
+
+
+    async def open(self):
+        ''' Opens the pooled session, connections are kept alive between requests. '''
+
+        if self._session is not None:
+            return
+        # All requests go to the one API host, so the pool is sized for every request the
+        # semaphore lets through to have a connection.
+        connector = aiohttp.TCPConnector(
+            limit=self._concurrency,
+            limit_per_host=self._concurrency,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self._timeout,
+        )
+        if self._rate_limiter is not None:
+            self._limiter_executor = ThreadPoolExecutor(max_workers=self._concurrency)
+
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._limiter_executor is not None:
+            self._limiter_executor.shutdown(wait=False, cancel_futures=True)
+            self._limiter_executor = None
+
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+    def _refreshable(self):
+        return self._token_client is not None and self._token_client._is_confidential_client
+
+
+    async def _in_thread(self, function, *args, executor=None):
+        # Token refreshes and rate limiter waits block, so they are kept off the event loop.
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+    def _release_abandoned(self, acquired):
+        if not acquired.cancelled() and acquired.exception() is None:
+            # An infinite latency leaves the adaptive concurrency limit as it is.
+            self._rate_limiter.release(float("inf"))
+
+
+    async def _request(self, method, path, params=None, data=None, timeout=None):
+        ''' Sends an API call with the current access token, which is refreshed first if it is
+            about to expire. If the API rejects the token anyway, it is refreshed and the call
+            retried once.
+        '''
+        if self._session is None:
+            await self.open()
+        if path.startswith("/"):
+            path = path[1:]
+
+        if self._refreshable() and self._token_client._tokens.expiring():
+            await self._in_thread(self._token_client._tokens.refresh_if_expiring)
+        generation = self._token_client._tokens.generation if self._token_client is not None else None
+        status, headers, resp = await self._limited_request(method, path, params, data, timeout)
+        if status == 401 and self._refreshable():
+            await self._in_thread(self._token_client._tokens.refresh, generation)
+            status, headers, resp = await self._limited_request(method, path, params, data, timeout)
+
+        if status != 200:
+            raise errors.from_response("{} {} failed".format(method, path), status, resp,
+                oauth2.parse_retry_after(headers.get("Retry-After")))
+
+        if method != "GET" and self._token_client is not None:
+            self._token_client._invalidate_written(path, data)
+        return resp
+
+
+    async def _limited_request(self, method, path, params, data, timeout):
+        ''' Sends a request once the rate limiter lets it through, and feeds back whether the
+            API showed signs of overload. Returns the status, headers and decoded body.
+        '''
+        if self._rate_limiter is not None:
+            fields = params or data
+            account = fields.get("account_id") if isinstance(fields, dict) else None
+            acquired = asyncio.ensure_future(self._in_thread(self._rate_limiter.acquire, path.split("/")[0],
+                account or self._user_id, executor=self._limiter_executor))
+            try:
+                await asyncio.shield(acquired)
+            except asyncio.CancelledError:
+                # The waiting thread cannot be interrupted, so a slot it gets is handed back.
+                acquired.add_done_callback(self._release_abandoned)
+                raise
+
+        access_token = self._token_client._access_token if self._token_client is not None else self._access_token
+        request_timeout = self._timeout if timeout is None else aiohttp.ClientTimeout(total=timeout)
+        started = time.monotonic()
+        overloaded = False
+        retry_after = None
+        try:
+            async with self._semaphore:
+                async with self._session.request(method, oauth2.api_url(path), params=params, data=data,
+                    timeout=request_timeout,
+                    headers={"Authorization": "Bearer {}".format(access_token)}) as response:
+                    body = await response.text()
+            overloaded = response.status == 429 or response.status >= 500
+            retry_after = oauth2.parse_retry_after(response.headers.get("Retry-After"))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            overloaded = True
+            raise errors.TransientError("{} {} failed: {!r}".format(method, path, e)) from e
+        finally:
+            if self._rate_limiter is not None:
+                self._rate_limiter.release(time.monotonic() - started, overloaded, retry_after)
+
+        try:
+            resp = json.loads(body)
+        except json.decoder.JSONDecodeError:
+            resp = body
+        return response.status, response.headers, resp
+
+
+    async def api_get(self, path, params_data, timeout=None):
+        ''' Uses the access token to send a GET API call to the Monzo API. '''
+
+        return await self._request("GET", path, params=params_data, timeout=timeout)
+
+
+    async def api_post(self, path, params_data, timeout=None):
+        ''' Uses the access token to send a POST API call to the Monzo API. '''
+
+        return await self._request("POST", path, data=params_data, timeout=timeout)
+
+
+    async def api_put(self, path, params_data, timeout=None):
+        ''' Uses the access token to send a PUT API call to the Monzo API. '''
+
+        return await self._request("PUT", path, data=params_data, timeout=timeout)
+
+
+class AsyncReceiptsClient:
+    ''' The operations of main.ReceiptsClient for a single account, as coroutines. Results
+        are returned rather than printed, so that many calls can be gathered together.
+    '''
+
+    def __init__(self, api_client, account_id):
+        self._api_client = api_client
+        self._account_id = account_id
+
+
+    async def iter_transactions(self, since=None, before=None, page_size=100):
+        ''' Yields transactions oldest first, following the "since" cursor page by page. '''
+
+        cursor = since
+        while True:
+            params = {
+                "account_id": self._account_id,
+                "limit": page_size,
+            }
+            if cursor is not None:
+                params["since"] = cursor
+            if before is not None:
+                params["before"] = before
+            response = await self._api_client.api_get("transactions", params)
+            if "transactions" not in response:
+                raise errors.APIError("Could not list past transactions ({})".format(response),
+                    response=response)
+
+            page = response["transactions"]
+            for transaction in page:
+                yield transaction
+            if len(page) < page_size:
+                return
+            cursor = page[-1]["id"]
+
+
+    async def list_transactions(self, **kwargs):
+        return [transaction async for transaction in self.iter_transactions(**kwargs)]
+
+
+    async def read_receipt(self, receipt_id):
+        ''' Retrieve receipt for a transaction with an external ID of our choosing. '''
+
+        return await self._api_client.api_get("transaction-receipts", {
+            "external_id": receipt_id,
+        })
+
+
+    async def put_receipt(self, receipt):
+        ''' Uploads a receipt_types.Receipt. '''
+
+        return await self._api_client.api_put("transaction-receipts/", receipt.marshal())
+
+
+    async def put_receipts(self, receipts):
+        ''' Uploads many receipts concurrently, bounded by the API client's concurrency limit.
+            Results are returned in the order of the receipts given, with any exception
+            raised for a receipt in place of its result.
+        '''
+        return await asyncio.gather(*[self.put_receipt(receipt) for receipt in receipts],
+            return_exceptions=True)
+
+
+    async def list_webhooks(self):
+        return await self._api_client.api_get("webhooks", {
+            "account_id": self._account_id,
+        })
+
+
+    async def register_webhook(self, incoming_endpoint):
+        return await self._api_client.api_post("webhooks", {
+            "account_id": self._account_id,
+            "url": incoming_endpoint,
+        })
@@ -0,0 +1,208 @@
+import gzip
+import json
+import random
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the parts of the Monzo API used by this client, so that it can be
+# exercised and benchmarked without credentials or network access. Run on its own with
+#   python benchmarks/mock_server.py [PORT] [TRANSACTIONS]
+# or start it in-process with MockMonzoAPI(...).start().
+
+USER_ID = "user_mock"
+ACCOUNT_ID = "acc_mock"
+
+
+def generate_transactions(count, seed=0):
+    ''' Generates a deterministic transaction history, oldest first. One in ten transactions
+        is not initiated by the user, like the fees the API returns for real accounts.
+    '''
+    rng = random.Random(seed)
+    started = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    transactions = []
+    for i in range(count):
+        created = started + timedelta(minutes=17 * i)
+        transactions.append({
+            "id": "tx_{:010d}".format(i),
+            "account_id": ACCOUNT_ID,
+            "created": created.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "settled": (created + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "amount": -rng.randint(50, 20000),
+            "currency": "GBP",
+            "merchant": "merch_{}".format(rng.randint(0, 499)),
+            "user_id": "" if i % 10 == 9 else USER_ID,
+            "description": "MOCK MERCHANT {}".format(i % 500),
+        })
+    return transactions
+
+
+class MockMonzoAPI:
+    ''' Serves oauth2/token, ping/whoami, accounts, transactions, transaction-receipts and
+        webhooks from memory. Every response is delayed by `latency` seconds, and a share
+        `error_rate` of API calls fail with a 500, or a 429 with Retry-After if
+        rate_limit_rate is set. Access tokens added to revoked_tokens are refused with a 401.
+        With compress, responses are gzipped for clients which accept it, as the API does.
+    '''
+
+    def __init__(self, port=0, transactions=10000, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=0,
+        compress=False):
+        self.transactions = generate_transactions(transactions, seed)
+        self._positions = {transaction["id"]: i for i, transaction in enumerate(self.transactions)}
+        self.receipts = {}
+        self.webhooks = []
+        self.revoked_tokens = set()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.compress = compress
+        self.request_count = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+
+    @property
+    def hostname(self):
+        return "127.0.0.1:{}".format(self._server.server_address[1])
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are sent in one write; written separately, the body waits
+            # on the delayed ACK of the headers on every kept-alive request.
+            wbufsize = 64 * 1024
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                api._handle(self, "GET")
+
+            def do_POST(self):
+                api._handle(self, "POST")
+
+            def do_PUT(self):
+                api._handle(self, "PUT")
+
+        return Handler
+
+
+    def _handle(self, request, method):
+        url = urllib.parse.urlparse(request.path)
+        path = url.path.strip("/")
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length).decode("utf-8") if length else ""
+
+        with self._lock:
+            self.request_count += 1
+            roll = self._rng.random()
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path != "oauth2/token":
+            if roll < self.rate_limit_rate:
+                return self._respond(request, 429, {"code": "too_many_requests"}, {"Retry-After": "1"})
+            if roll < self.rate_limit_rate + self.error_rate:
+                return self._respond(request, 500, {"code": "internal_service"})
+            authorization = request.headers.get("Authorization", "")
+            if not authorization.startswith("Bearer ") or authorization[len("Bearer "):] in self.revoked_tokens:
+                return self._respond(request, 401, {"code": "unauthorized"})
+
+        route = (method, path)
+        if route == ("POST", "oauth2/token"):
+            status, response = 200, {"access_token": "access_mock", "refresh_token": "refresh_mock",
+                "user_id": USER_ID, "expires_in": 21600, "token_type": "Bearer"}
+        elif route == ("GET", "ping/whoami"):
+            status, response = 200, {"authenticated": True, "client_id": "oauth2client_mock", "user_id": USER_ID}
+        elif route == ("GET", "accounts"):
+            status, response = 200, {"accounts": [{"id": ACCOUNT_ID, "type": "uk_retail"}]}
+        elif route == ("GET", "transactions"):
+            status, response = 200, {"transactions": self._list_transactions(params)}
+        elif route == ("PUT", "transaction-receipts"):
+            status, response = self._put_receipt(body)
+        elif route == ("GET", "transaction-receipts"):
+            receipt = self.receipts.get(params.get("external_id"))
+            status, response = (200, {"receipt": receipt}) if receipt else (404, {"code": "not_found"})
+        elif route == ("GET", "webhooks"):
+            status, response = 200, {"webhooks": list(self.webhooks)}
+        elif route == ("POST", "webhooks"):
+            form = dict(urllib.parse.parse_qsl(body))
+            webhook = {"id": "webhook_{}".format(len(self.webhooks)), "account_id": form.get("account_id"),
+                "url": form.get("url")}
+            self.webhooks.append(webhook)
+            status, response = 200, {"webhook": webhook}
+        else:
+            status, response = 404, {"code": "not_found"}
+        self._respond(request, status, response)
+
+
+    def _list_transactions(self, params):
+        start = 0
+        since = params.get("since")
+        if since in self._positions:
+            start = self._positions[since] + 1
+        elif since:
+            start = next((i for i, transaction in enumerate(self.transactions)
+                if transaction["created"] >= since), len(self.transactions))
+        end = len(self.transactions)
+        if params.get("before"):
+            end = next((i for i, transaction in enumerate(self.transactions)
+                if transaction["created"] >= params["before"]), end)
+        limit = int(params.get("limit", end - start))
+        return self.transactions[start:min(end, start + limit)]
+
+
+    def _put_receipt(self, body):
+        try:
+            receipt = json.loads(body)
+            external_id = receipt["external_id"]
+        except (ValueError, KeyError, TypeError):
+            return 400, {"code": "bad_request"}
+        if receipt.get("transaction_id") not in self._positions:
+            return 404, {"code": "transaction_not_found"}
+        with self._lock:
+            self.receipts[external_id] = receipt
+        return 200, {"receipt_id": "receipt_{}".format(external_id)}
+
+
+    def _respond(self, request, status, response, headers=None):
+        payload = json.dumps(response).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        if self.compress and "gzip" in request.headers.get("Accept-Encoding", ""):
+            payload = gzip.compress(payload)
+            request.send_header("Content-Encoding", "gzip")
+        request.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(payload)
+
+
+if __name__ == "__main__":
+    import sys
+
+    api = MockMonzoAPI(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000,
+        transactions=int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    print("Mock Monzo API listening on {}".format(api.hostname))
+    api._server.serve_forever()
@@ -0,0 +1,121 @@
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import receipt_types
+
+# Compares building and marshalling receipts with receipt_types against the original
+# dict-backed classes, reproduced below. Run with: python benchmarks/receipt_serialization.py
+
+class LegacySubItem:
+    def __init__(self, description, quantity, unit, amount, currency, tax):
+        self.data = {
+            "description": description,
+            "quantity": quantity,
+            "unit": unit,
+            "amount": amount,
+            "currency": currency,
+            "tax": tax,
+        }
+
+class LegacyItem:
+    def __init__(self, description, quantity, unit, amount, currency, tax, sub_items):
+        self.data = {
+            "description": description,
+            "quantity": quantity,
+            "unit": unit,
+            "amount": amount,
+            "currency": currency,
+            "tax": tax,
+            "sub_items": [sub.data for sub in sub_items],
+        }
+
+class LegacyPayment:
+    def __init__(self, type, bin, last_four, auth_code, aid, mid, tid, gift_card_type, amount, currency):
+        self.data = {
+            "type": type,
+            "bin": bin,
+            "last_four": last_four,
+            "auth_code": auth_code,
+            "aid": aid,
+            "mid": mid,
+            "tid": tid,
+            "gift_card_type": gift_card_type,
+            "amount": amount,
+            "currency": currency,
+        }
+
+class LegacyTax:
+    def __init__(self, description, amount, currency, tax_number):
+        self.data = {
+            "description": description,
+            "amount": amount,
+            "currency": currency,
+            "tax_number": tax_number,
+        }
+
+class LegacyReceipt:
+    def __init__(self, id, external_id, transaction_id, total, currency, payments, taxes, items):
+        self.data = {
+            "id": id,
+            "external_id": external_id,
+            "transaction_id": transaction_id,
+            "total": total,
+            "currency": currency,
+            "payments": [payment.data for payment in payments],
+            "taxes": [tax.data for tax in taxes],
+            "items": [item.data for item in items],
+        }
+
+    def marshal(self):
+        return json.dumps(self.data)
+
+
+LEGACY = (LegacySubItem, LegacyItem, LegacyPayment, LegacyTax, LegacyReceipt)
+CURRENT = (receipt_types.SubItem, receipt_types.Item, receipt_types.Payment, receipt_types.Tax,
+    receipt_types.Receipt)
+
+
+def build_receipt(types, n, items_per_receipt):
+    SubItem, Item, Payment, Tax, Receipt = types
+    items = [Item("Item {}".format(i), 2.5, "kg", 269, "GBP", 0, [
+        SubItem("Bananas loose", 1.5, "kg", 119, "GBP", 0),
+        SubItem("Organic bananas", 1, "kg", 150, "GBP", 0),
+    ]) for i in range(items_per_receipt)]
+    return Receipt("", "receipt_{}".format(n), "tx_{}".format(n), 269 * items_per_receipt, "GBP",
+        [Payment("card", "123321", "1234", "A10B2C", "", "", "", "", 269 * items_per_receipt, "GBP")],
+        [Tax("VAT", 0, "GBP", "12345678")], items)
+
+
+def measure(types, receipts, items_per_receipt, repeat=3):
+    elapsed = None
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        for n in range(receipts):
+            build_receipt(types, n, items_per_receipt).marshal()
+        run = time.perf_counter_ns() - started
+        elapsed = run if elapsed is None else min(elapsed, run)
+
+    tracemalloc.start()
+    kept = [build_receipt(types, n, items_per_receipt) for n in range(receipts // 10)]
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+
+    return elapsed / receipts, retained / (receipts // 10)
+
+
+if __name__ == "__main__":
+    receipts = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    items_per_receipt = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    assert build_receipt(LEGACY, 0, 3).marshal() == build_receipt(CURRENT, 0, 3).marshal()
+    print("{} receipts of {} items each".format(receipts, items_per_receipt))
+    for name, types in (("legacy dicts", LEGACY), ("receipt_types", CURRENT)):
+        ns_per_receipt, bytes_per_receipt = measure(types, receipts, items_per_receipt)
+        print("{:>14}: {:>10.0f} ns/receipt (build + marshal), {:>8.0f} bytes/receipt retained".format(
+            name, ns_per_receipt, bytes_per_receipt))
@@ -0,0 +1,210 @@
+import argparse
+import importlib.util
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_server
+
+# Offline benchmarks of the client against benchmarks/mock_server.py. Each benchmark runs
+# in its own process so that its peak RSS is its own. Run with e.g.
+#   python benchmarks/run.py --transactions 50000 --receipts 5000 --latency 0.005
+
+BENCHMARKS = ("listing", "serialization", "bulk-upload", "matching", "validation")
+
+
+def configure(hostname):
+    ''' Points config at the mock API, using config-example.py if there is no config.py.
+        Caching is turned off and client-side rate limits lifted, so that the requests
+        themselves are measured.
+    '''
+    try:
+        import config
+    except ImportError:
+        spec = importlib.util.spec_from_file_location("config", os.path.join(ROOT, "config-example.py"))
+        config = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(config)
+        sys.modules["config"] = config
+
+    config.MONZO_API_HOSTNAME = hostname
+    config.MONZO_API_SCHEME = "http"
+    config.MONZO_TOKEN_STORE_KEY = ""
+    config.MONZO_CACHE_MAX_ENTRIES = 0
+    config.MONZO_RATE_LIMIT_DEFAULT = (1e9, 1e9)
+    config.MONZO_RATE_LIMIT_PER_ACCOUNT = (1e9, 1e9)
+    config.MONZO_RATE_LIMIT_ENDPOINTS = {}
+
+
+def authorised_client():
+    import main
+    import oauth2
+
+    api_client = oauth2.OAuth2Client()
+    api_client._auth_code = "mock"
+    api_client.exchange_auth_code()
+    return main.ReceiptsClient(api_client, mock_server.ACCOUNT_ID)
+
+
+def timed(latencies, function):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+    return wrapper
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return 0, 0
+    return (latencies[int(0.5 * (len(latencies) - 1))] * 1000,
+        latencies[int(0.99 * (len(latencies) - 1))] * 1000)
+
+
+def bench_listing(api, args):
+    client = authorised_client()
+    latencies = []
+    client._api_client.api_get = timed(latencies, client._api_client.api_get)
+
+    started = time.perf_counter()
+    count = sum(1 for _ in client.iter_transactions(page_size=args.page_size))
+    elapsed = time.perf_counter() - started
+    p50, p99 = percentiles(latencies)
+    return {"operations": count, "unit": "transactions", "seconds": elapsed,
+        "latency_p50_ms": p50, "latency_p99_ms": p99, "latency_of": "page requests"}
+
+
+def bench_serialization(api, args):
+    import receipt_serialization
+
+    latencies = []
+    started = time.perf_counter()
+    for n in range(args.receipts):
+        operation_started = time.perf_counter()
+        receipt_serialization.build_receipt(receipt_serialization.CURRENT, n, 10).marshal()
+        latencies.append(time.perf_counter() - operation_started)
+    elapsed = time.perf_counter() - started
+    p50, p99 = percentiles(latencies)
+    return {"operations": args.receipts, "unit": "receipts", "seconds": elapsed,
+        "latency_p50_ms": p50, "latency_p99_ms": p99, "latency_of": "build and marshal"}
+
+
+def bench_bulk_upload(api, args):
+    import bulk_upload
+
+    client = authorised_client()
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "receipts.jsonl")
+        with open(source, "w") as receipts:
+            for n in range(args.receipts):
+                transaction = api.transactions[n % len(api.transactions)]
+                receipts.write(json.dumps({"external_id": "bench_{}".format(n),
+                    "transaction_id": transaction["id"], "total": -transaction["amount"], "currency": "GBP",
+                    "items": [{"description": "Item", "quantity": 1, "amount": -transaction["amount"]}],
+                    "payments": [{"type": "card", "last_four": "1234", "amount": -transaction["amount"]}]}) + "\n")
+
+        uploader = bulk_upload.BulkUploader(client._api_client, os.path.join(directory, "dead_letters.jsonl"),
+            workers=args.workers)
+        summary = uploader.run(bulk_upload.read_records(source))
+    return {"operations": summary["uploaded"], "unit": "receipts", "seconds": summary["elapsed_seconds"],
+        "latency_p50_ms": summary["latency_p50_ms"], "latency_p99_ms": summary["latency_p99_ms"],
+        "latency_of": "PUT requests", "failed": summary["failed"]}
+
+
+def bench_matching(api, args):
+    import matching
+    import receipt_types
+
+    # Receipts for the transactions paid out of the account, timestamped up to two minutes
+    # off their transaction as a merchant's till clock would be, in no particular order.
+    rng = random.Random(0)
+    receipts = []
+    for n, transaction in enumerate(api.transactions[:args.receipts]):
+        total = -transaction["amount"]
+        receipt = receipt_types.Receipt("", "bench_{}".format(n), "", total, "GBP",
+            [receipt_types.Payment("card", "", "1234", "", "", "", "", "", total, "GBP")], [], [])
+        receipts.append((receipt, matching.to_seconds(transaction["created"]) + rng.uniform(-120, 120)))
+    rng.shuffle(receipts)
+
+    started = time.perf_counter()
+    engine = matching.MatchingEngine(api.transactions)
+    matched, _ = engine.match(receipts)
+    elapsed = time.perf_counter() - started
+    return {"operations": len(matched), "unit": "receipts", "seconds": elapsed,
+        "latency_p50_ms": elapsed * 1000, "latency_p99_ms": elapsed * 1000, "latency_of": "whole batch"}
+
+
+def bench_validation(api, args):
+    import receipt_serialization
+    import validation
+
+    receipts = [receipt_serialization.build_receipt(receipt_serialization.CURRENT, n, 10)
+        for n in range(args.receipts)]
+    started = time.perf_counter()
+    codes = validation.validate_receipts(receipts)
+    elapsed = time.perf_counter() - started
+    return {"operations": len(codes), "unit": "receipts", "seconds": elapsed,
+        "latency_p50_ms": elapsed * 1000, "latency_p99_ms": elapsed * 1000, "latency_of": "whole batch",
+        "invalid": int((codes != 0).sum())}
+
+
+def run_child(args):
+    api = mock_server.MockMonzoAPI(transactions=args.transactions, latency=args.latency,
+        error_rate=args.error_rate).start()
+    configure(api.hostname)
+    try:
+        result = globals()["bench_" + args.child.replace("-", "_")](api, args)
+    finally:
+        api.stop()
+
+    result["throughput_per_second"] = result["operations"] / result["seconds"] if result["seconds"] else 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    result["peak_rss_mb"] = peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the client against a local mock Monzo API.")
+    parser.add_argument("benchmarks", nargs="*", help="any of {}, all by default".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--transactions", type=int, default=10000, help="size of the mock transaction history")
+    parser.add_argument("--receipts", type=int, default=2000, help="receipts to serialise or upload")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=8, help="bulk upload workers")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every mock API response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of mock API calls failing with 500")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(benchmark))
+
+    options = [arg for arg in sys.argv[1:] if arg not in BENCHMARKS]
+    print("{:<14} {:>10} {:>14} {:>10} {:>10} {:>10}".format(
+        "benchmark", "ops", "ops/s", "p50 ms", "p99 ms", "RSS MB"))
+    for benchmark in args.benchmarks or BENCHMARKS:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", benchmark] + options,
+            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print("{:<14} {:>10} {:>14.1f} {:>10.3f} {:>10.3f} {:>10.1f}".format(benchmark, result["operations"],
+            result["throughput_per_second"], result["latency_p50_ms"], result["latency_p99_ms"],
+            result["peak_rss_mb"]))
+
+
+if __name__ == "__main__":
+    main()
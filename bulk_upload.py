@@ -0,0 +1,269 @@
+import csv
+import itertools
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import errors
+import receipt_types
+import validation
+
+# Bulk ingestion of receipts into the Transaction Receipts API. Receipts are read one at a
+# time from a JSONL file, or a CSV file with the nested items, payments and taxes columns
+# holding JSON lists, validated a chunk at a time and uploaded on a pool of worker
+# threads. A receipt which cannot be uploaded is written to a dead-letter file instead of
+# stopping the run, and can be fed back in once fixed.
+
+RECEIPT_LIST_FIELDS = ("items", "payments", "taxes")
+
+
+def read_records(path):
+    ''' Yields (line_number, record) pairs from a .jsonl or .csv file without loading it whole. '''
+
+    with open(path, newline="") as source:
+        if path.endswith(".csv"):
+            for line_number, row in enumerate(csv.DictReader(source), start=2):
+                record = dict(row)
+                for field in RECEIPT_LIST_FIELDS:
+                    try:
+                        record[field] = json.loads(record[field]) if record.get(field) else []
+                    except json.decoder.JSONDecodeError:
+                        pass # Left as the raw string, rejected by build_receipt().
+                yield line_number, record
+        else:
+            for line_number, line in enumerate(source, start=1):
+                if line.strip() == "":
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    yield line_number, line
+
+
+def build_receipt(record, validate=True):
+    ''' Validates a receipt record and builds a receipt_types.Receipt from it, raising
+        ValueError if the record is not a usable receipt, or one whose amounts, currencies
+        and taxes are inconsistent. With validate set to False, the consistency checks are
+        left to the caller, to run over many receipts at once with check_receipts().
+    '''
+    if not isinstance(record, dict):
+        raise ValueError("not a receipt object")
+    for field in ("external_id", "transaction_id", "currency"):
+        if not record.get(field):
+            raise ValueError("missing {}".format(field))
+    try:
+        total = int(record["total"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("total must be an amount in minor units")
+
+    try:
+        receipt = receipt_types.Receipt.from_data(dict(record, total=total))
+    except KeyError as e:
+        raise ValueError("missing {}".format(e.args[0]))
+    except (AttributeError, TypeError):
+        raise ValueError("items, payments and taxes must be lists of objects")
+
+    if validate:
+        problem = check_receipts([receipt])[0]
+        if problem is not None:
+            raise ValueError(problem)
+    return receipt
+
+
+def check_receipts(receipts):
+    ''' Runs the consistency checks of validation.py over a batch of receipt_types.Receipts,
+        and returns for each one why it is inconsistent, or None if it is not.
+    '''
+    try:
+        codes = validation.validate_receipts(receipts)
+    except Exception as e:
+        if len(receipts) == 1:
+            # Malformed beyond what the checks handle, which is no more usable.
+            return ["cannot validate receipt: {!r}".format(e)]
+        # Checked one by one, so that only the receipts at fault are rejected.
+        return [problem for receipt in receipts for problem in check_receipts([receipt])]
+    return [None if code == 0 else "inconsistent receipt: {}".format(", ".join(validation.describe(code)))
+        for code in codes]
+
+
+class BulkUploader:
+    ''' Uploads a stream of receipt records with a pool of workers sharing one
+        oauth2.OAuth2Client. Uploads are PUTs keyed on each receipt's external_id, so a
+        retried upload overwrites rather than duplicates the receipt.
+    '''
+
+    def __init__(self, api_client, dead_letter_path, workers=8, conditional_uploader=None, batch_size=500):
+        self._api_client = api_client
+        self._conditional_uploader = conditional_uploader
+        # With a receipt_hashes.ConditionalUploader, receipts unchanged since they were
+        # last written are skipped.
+        self._dead_letter_path = dead_letter_path
+        self._workers = workers
+        self._batch_size = batch_size
+        # Records are validated batch_size at a time, before their uploads are queued.
+
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._counts = {"uploaded": 0, "skipped": 0, "invalid": 0, "failed": 0, "retries": 0}
+
+
+    def _upload(self, receipt):
+        ''' PUTs a receipt, returning None once uploaded, or the error which stopped it. The
+            API client's session already retries transient failures with backoff, or after
+            the delay asked for by the API, and every request waits for its rate limiter, so
+            neither is done again here.
+        '''
+        started = time.monotonic()
+        try:
+            self._api_client.api_put("transaction-receipts/", receipt.marshal())
+            failure = None
+        except errors.APIError as e:
+            failure = e
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return failure
+
+
+    def _count_retries(self, event):
+        if event.method == "PUT" and event.endpoint == "transaction-receipts" and event.retries:
+            with self._lock:
+                self._counts["retries"] += event.retries
+
+
+    def _dead_letter(self, dead_letters, line_number, record, reason):
+        with self._lock:
+            dead_letters.write(json.dumps({
+                "line": line_number,
+                "error": str(reason),
+                "record": record,
+            }) + "\n")
+            dead_letters.flush()
+
+
+    def _reject(self, dead_letters, line_number, record, counter, reason):
+        with self._lock:
+            self._counts[counter] += 1
+        self._dead_letter(dead_letters, line_number, record, reason)
+
+
+    def _process(self, dead_letters, line_number, record, receipt):
+        # Runs on an executor thread, where an exception would be dropped with its future,
+        # so anything unexpected counts the record as failed rather than losing it.
+        try:
+            failure = self._upload_receipt(receipt)
+        except Exception as e:
+            failure = e
+        if failure is not None:
+            self._reject(dead_letters, line_number, record, "failed", failure)
+
+
+    def _upload_receipt(self, receipt):
+        # Returns why the receipt could not be uploaded, or None if it was handled.
+        if self._conditional_uploader is not None and self._conditional_uploader.unchanged(receipt):
+            with self._lock:
+                self._counts["skipped"] += 1
+            return None
+
+        failure = self._upload(receipt)
+        if failure is not None:
+            return failure
+        if self._conditional_uploader is not None:
+            self._conditional_uploader.written(receipt)
+        with self._lock:
+            self._counts["uploaded"] += 1
+        return None
+
+
+    def _build_batch(self, dead_letters, batch):
+        ''' Builds and validates a batch of (line_number, record) pairs, dead-lettering the
+            records which are not usable receipts. Returns (line_number, record, receipt)
+            for the rest.
+        '''
+        built = []
+        for line_number, record in batch:
+            try:
+                built.append((line_number, record, build_receipt(record, validate=False)))
+            except ValueError as e:
+                self._reject(dead_letters, line_number, record, "invalid", e)
+            except Exception as e:
+                self._reject(dead_letters, line_number, record, "failed", e)
+
+        valid = []
+        for (line_number, record, receipt), problem in zip(built,
+            check_receipts([receipt for _, _, receipt in built])):
+            if problem is None:
+                valid.append((line_number, record, receipt))
+            else:
+                self._reject(dead_letters, line_number, record, "invalid", problem)
+        return valid
+
+
+    def run(self, records):
+        ''' Uploads (line_number, record) pairs, as produced by read_records(), and returns a
+            summary of the run. Only a bounded number of records are held in memory at once.
+        '''
+        in_flight = threading.BoundedSemaphore(self._workers * 4)
+        started = time.monotonic()
+        records = iter(records)
+
+        # Retries happen inside the session, and are only seen by observers.
+        self._api_client.add_observer(self._count_retries)
+        try:
+            with open(self._dead_letter_path, "a") as dead_letters, \
+                ThreadPoolExecutor(max_workers=self._workers) as executor:
+                while True:
+                    batch = list(itertools.islice(records, self._batch_size))
+                    if not batch:
+                        break
+                    for line_number, record, receipt in self._build_batch(dead_letters, batch):
+                        in_flight.acquire()
+                        future = executor.submit(self._process, dead_letters, line_number, record, receipt)
+                        future.add_done_callback(lambda _: in_flight.release())
+        finally:
+            self._api_client.remove_observer(self._count_retries)
+
+        return self._summary(time.monotonic() - started)
+
+
+    def _summary(self, elapsed):
+        summary = dict(self._counts)
+        summary["elapsed_seconds"] = elapsed
+        summary["receipts_per_second"] = summary["uploaded"] / elapsed if elapsed > 0 else 0
+        if self._conditional_uploader is not None:
+            stats = self._conditional_uploader.stats()
+            summary["skip_rate"] = stats["skip_rate"]
+            summary["bytes_saved"] = stats["bytes_saved"]
+        latencies = sorted(self._latencies)
+        for name, quantile in (("p50", 0.5), ("p99", 0.99)):
+            summary["latency_{}_ms".format(name)] = \
+                latencies[int(quantile * (len(latencies) - 1))] * 1000 if latencies else 0
+        return summary
+
+
+if __name__ == "__main__":
+    import main
+    import receipt_hashes
+
+    if len(sys.argv) < 2:
+        print("Usage: python bulk_upload.py RECEIPTS.jsonl|RECEIPTS.csv [DEAD_LETTER.jsonl]")
+        sys.exit(1)
+
+    from utils import error
+
+    try:
+        client = main.ReceiptsClient()
+        client.do_auth()
+        conditional_uploader = None
+        receipt_hash_db_path = getattr(main.config, "MONZO_RECEIPT_HASH_DB_PATH", "")
+        if receipt_hash_db_path:
+            conditional_uploader = receipt_hashes.ConditionalUploader(client._api_client,
+                receipt_hashes.ReceiptHashStore(receipt_hash_db_path))
+        uploader = BulkUploader(client._api_client,
+            sys.argv[2] if len(sys.argv) > 2 else "dead_letters.jsonl",
+            conditional_uploader=conditional_uploader)
+        summary = uploader.run(read_records(sys.argv[1]))
+    except errors.MonzoError as e:
+        error(e)
+    print("Bulk upload finished: ", json.dumps(summary, indent=4, sort_keys=True))
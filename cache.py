@@ -0,0 +1,212 @@
+import sqlite3
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+# A read-through cache for GET responses of oauth2.OAuth2Client. Responses are kept in an
+# in-memory LRU and, optionally, a SQLite file which outlives the process. Entries past
+# their TTL are not thrown away straight away: if the API gave an ETag, the entry is
+# revalidated with If-None-Match and reused on a 304. Transaction listings are only cached
+# once they are closed, that is with a "before" timestamp in the past, as an open-ended
+# listing gains every new transaction. The SQLite file drops entries stored longer ago
+# than its max_age, as it is not bounded like the in-memory LRU.
+
+CacheEntry = namedtuple("CacheEntry", ["body", "etag", "stored_at"])
+
+
+def _in_past(timestamp):
+    # Whether an RFC 3339 timestamp is in the past, False if it is missing or malformed.
+    if not timestamp:
+        return False
+    try:
+        parsed = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return False
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed < datetime.now(timezone.utc)
+
+
+class LRUCache:
+    ''' An in-memory cache holding at most max_entries entries, evicting the least
+        recently used first. The bound is a count of responses, whatever their size.
+    '''
+
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def invalidate(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+
+class SQLiteCache:
+    ''' An on-disk cache tier, shared by every client using the same file. Entries stored
+        more than max_age seconds ago are pruned when the file is opened, and then every
+        PRUNE_EVERY writes.
+    '''
+
+    PRUNE_EVERY = 256
+
+    def __init__(self, path, max_age=None):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._max_age = max_age
+        self._writes = 0
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, body TEXT, etag TEXT, stored_at REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_stored_at "
+                "ON responses (stored_at)")
+            self._prune()
+
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT body, etag, stored_at FROM responses WHERE key = ?",
+                (key,)).fetchone()
+        return CacheEntry(*row) if row is not None else None
+
+
+    def set(self, key, entry):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, entry.body, entry.etag, entry.stored_at))
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune()
+
+
+    def _prune(self):
+        # Called holding the lock, within a transaction.
+        if self._max_age is not None:
+            self._connection.execute("DELETE FROM responses WHERE stored_at < ?",
+                (time.time() - self._max_age,))
+
+
+    def delete(self, key):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+
+    def invalidate(self, prefix):
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses WHERE key LIKE ? ESCAPE '\\'",
+                (escaped + "%",))
+
+
+class ResponseCache:
+    ''' Caches GET responses for the API paths given, checking the in-memory tier before
+        the on-disk one. Keeps hit, miss and revalidation counts, and the number of
+        response bytes that did not have to be downloaded again.
+    '''
+
+    def __init__(self, max_entries, ttl, paths, sqlite_path=None, sqlite_max_age=None):
+        self._ttl = ttl
+        self._paths = tuple(paths)
+        self._tiers = [LRUCache(max_entries)]
+        if sqlite_path:
+            self._tiers.append(SQLiteCache(sqlite_path, sqlite_max_age))
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "revalidated": 0, "bytes_saved": 0}
+
+
+    def cacheable(self, path, params=None):
+        if not path.startswith(self._paths):
+            return False
+        if path == "transactions":
+            return _in_past((params or {}).get("before"))
+        return True
+
+
+    def key(self, user_id, path, params):
+        return "{}/{}?{}".format(user_id, path, urllib.parse.urlencode(sorted((params or {}).items())))
+
+
+    def lookup(self, key):
+        ''' Returns (entry, fresh) for a key, entry being None if nothing is cached. A stale
+            entry is returned so that it can be revalidated.
+        '''
+        for i, tier in enumerate(self._tiers):
+            entry = tier.get(key)
+            if entry is None:
+                continue
+            for faster_tier in self._tiers[:i]:
+                faster_tier.set(key, entry)
+
+            fresh = time.time() - entry.stored_at < self._ttl
+            if fresh:
+                self._count("hits", len(entry.body))
+            else:
+                self._count("misses")
+            return entry, fresh
+
+        self._count("misses")
+        return None, False
+
+
+    def store(self, key, body, etag=None):
+        entry = CacheEntry(body, etag, time.time())
+        for tier in self._tiers:
+            tier.set(key, entry)
+
+
+    def revalidated(self, key, entry):
+        ''' Records that the API confirmed a stale entry is unchanged, renewing its TTL. A
+            revalidation is counted as a miss turned into a hit.
+        '''
+        self.store(key, entry.body, entry.etag)
+        self._count("revalidated", len(entry.body))
+
+
+    def delete(self, key):
+        for tier in self._tiers:
+            tier.delete(key)
+
+
+    def invalidate(self, user_id, path):
+        ''' Drops every cached response for path and the paths below it. '''
+        for tier in self._tiers:
+            tier.invalidate("{}/{}".format(user_id, path))
+
+
+    def _count(self, counter, bytes_saved=0):
+        with self._lock:
+            self._stats[counter] += 1
+            self._stats["bytes_saved"] += bytes_saved
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["hits"] + stats["revalidated"]) / lookups if lookups else 0
+        return stats
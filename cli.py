@@ -0,0 +1,94 @@
+import argparse
+import json
+import socket
+import sys
+
+from utils import error
+
+# A thin command-line client of daemon.py. Commands are sent to the daemon over its Unix
+# socket, so none of them go through auth or open new connections to the API. Only the
+# standard library is imported here, to keep startup quick. For example:
+#   python cli.py list --limit 10
+#   python cli.py put-receipt receipt.json
+#   python cli.py read-receipt EXTERNAL_ID
+#   python cli.py register-webhook https://example.com/webhook_callback
+#   python cli.py reconcile-receipts [EXTERNAL_ID ...]
+
+try:
+    import config
+except:
+    print("Cannot import config, register your application on developers.monzo.com, \
+copy config-example.py to config.py, and configure your client credentials.")
+    sys.exit(1)
+
+
+def send(command, args, socket_path=None):
+    ''' Sends a command to the daemon and returns its response. Raises ConnectionError if
+        the daemon closes the connection without a well-formed reply.
+    '''
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path or getattr(config, "MONZO_DAEMON_SOCKET_PATH", "monzo-receipts.sock"))
+        connection.sendall(json.dumps({"command": command, "args": args}).encode("utf-8") + b"\n")
+        with connection.makefile("rb") as response:
+            line = response.readline()
+    finally:
+        connection.close()
+
+    if not line:
+        raise ConnectionError("Daemon closed the connection without replying")
+    try:
+        return json.loads(line.decode("utf-8"))
+    except ValueError as e:
+        raise ConnectionError("Daemon sent a malformed reply: {}".format(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sends commands to a running daemon.py.")
+    subcommands = parser.add_subparsers(dest="command")
+    list_parser = subcommands.add_parser("list", help="list the latest transactions")
+    list_parser.add_argument("--since", help="RFC 3339 timestamp of the earliest transaction")
+    list_parser.add_argument("--before", help="RFC 3339 timestamp after the latest transaction")
+    list_parser.add_argument("--limit", type=int, default=100)
+    put_parser = subcommands.add_parser("put-receipt", help="upload a receipt from a JSON file")
+    put_parser.add_argument("path", help="receipt payload, or - to read it from standard input")
+    read_parser = subcommands.add_parser("read-receipt", help="read a receipt by its external ID")
+    read_parser.add_argument("external_id")
+    webhook_parser = subcommands.add_parser("register-webhook", help="register a webhook")
+    webhook_parser.add_argument("url")
+    reconcile_parser = subcommands.add_parser("reconcile-receipts",
+        help="check stored receipt hashes against the receipts held by the API")
+    reconcile_parser.add_argument("external_ids", nargs="*", help="all receipts with a stored hash by default")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        command_args = {"since": args.since, "before": args.before, "limit": args.limit}
+    elif args.command == "put-receipt":
+        try:
+            with (sys.stdin if args.path == "-" else open(args.path)) as source:
+                command_args = {"receipt": json.load(source)}
+        except (OSError, ValueError) as e:
+            error("Cannot read receipt: {}".format(e))
+    elif args.command == "read-receipt":
+        command_args = {"external_id": args.external_id}
+    elif args.command == "register-webhook":
+        command_args = {"url": args.url}
+    elif args.command == "reconcile-receipts":
+        command_args = {"external_ids": args.external_ids}
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        response = send(args.command, command_args)
+    except (FileNotFoundError, ConnectionRefusedError):
+        error("Daemon is not running, start it with: python daemon.py")
+    except ConnectionError as e:
+        error(e)
+    if not response["ok"]:
+        error("{} ({})".format(response["error"], response["type"]))
+    print(json.dumps(response["result"], indent=4, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
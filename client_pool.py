@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import errors
+import main
+import oauth2
+import tokens
+
+# Serving many users from one process. Each tenant is an authorised Monzo user and one
+# of their accounts, identified by a name of our choosing. All tenants share one pooled
+# HTTP session, response cache and client-side rate limiter. Their tokens live encrypted
+# on disk, one file per tenant, and a client is only kept in memory for the most
+# recently used tenants.
+
+class ReceiptsClientPool:
+    ''' Runs work for many tenants on a shared pool of worker threads. Work submitted for
+        a tenant is run one task at a time in order, tenants with work waiting take turns,
+        and each tenant is held to its own rate limit on the requests its tasks send. A
+        tenant whose limit is used up is passed over until it may send again.
+    '''
+
+    def __init__(self, token_dir, token_key, workers=16, max_loaded=1000,
+        tenant_requests_per_second=5, tenant_burst=10):
+        self._token_dir = token_dir
+        self._token_key = token_key
+        self._max_loaded = max_loaded
+        self._tenant_limit = (tenant_requests_per_second, tenant_burst)
+
+        self._session = oauth2.OAuth2Client.build_session(pool_maxsize=workers)
+        self._rate_limiter = oauth2.OAuth2Client.build_rate_limiter()
+        self._cache = oauth2.OAuth2Client.build_response_cache()
+
+        self._registry_path = os.path.join(token_dir, "tenants.json")
+        self._accounts = {}
+        if os.path.exists(self._registry_path):
+            with open(self._registry_path) as registry:
+                self._accounts = json.load(registry)
+
+        self._lock = threading.Condition()
+        self._loaded = OrderedDict()
+        self._pending = {}
+        self._running = set()
+        self._ready = deque()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+
+    def _build_api_client(self, tenant_id):
+        store = tokens.TokenStore(os.path.join(self._token_dir, "{}.enc".format(tenant_id)), self._token_key)
+        return oauth2.OAuth2Client(response_cache=self._cache, session=self._session, token_store=store,
+            background_refresh=False,
+            rate_limiter=self._rate_limiter.tenant(tenant_id, self._tenant_limit))
+
+
+    def authorise(self, tenant_id):
+        ''' Runs the interactive auth flow for a new tenant and records its account. '''
+
+        client = main.ReceiptsClient(self._build_api_client(tenant_id))
+        client.do_auth()
+        with self._lock:
+            self._accounts[tenant_id] = client._account_id
+            self._save_registry()
+            self._keep_loaded(tenant_id, client)
+
+
+    def _save_registry(self):
+        temp_path = self._registry_path + ".tmp"
+        with open(temp_path, "w") as registry:
+            json.dump(self._accounts, registry)
+        os.replace(temp_path, self._registry_path)
+
+
+    def tenants(self):
+        with self._lock:
+            return list(self._accounts)
+
+
+    def client(self, tenant_id):
+        ''' Returns the ReceiptsClient of a tenant, loading its saved tokens if needed. '''
+
+        with self._lock:
+            client = self._loaded.get(tenant_id)
+            if client is not None:
+                self._loaded.move_to_end(tenant_id)
+                return client
+            if tenant_id not in self._accounts:
+                raise errors.MonzoError("Tenant {} has not been authorised".format(tenant_id))
+            account_id = self._accounts[tenant_id]
+
+        api_client = self._build_api_client(tenant_id)
+        if not api_client.load_saved_tokens():
+            raise errors.AuthError("No saved tokens for tenant {}, authorise it again".format(tenant_id))
+        client = main.ReceiptsClient(api_client, account_id)
+        with self._lock:
+            self._keep_loaded(tenant_id, client)
+        return client
+
+
+    def _keep_loaded(self, tenant_id, client):
+        self._loaded[tenant_id] = client
+        self._loaded.move_to_end(tenant_id)
+        while len(self._loaded) > self._max_loaded:
+            _, evicted = self._loaded.popitem(last=False)
+            # Its tokens are already on disk and will be loaded again on next use.
+            evicted._api_client._tokens.stop()
+
+
+    def submit(self, tenant_id, function, *args):
+        ''' Schedules function(client, *args) to run with the tenant's ReceiptsClient, and
+            returns a concurrent.futures.Future for its result.
+        '''
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise errors.MonzoError("Client pool has been closed")
+            pending = self._pending.setdefault(tenant_id, deque())
+            if len(pending) == 0 and tenant_id not in self._running:
+                self._ready.append(tenant_id)
+            pending.append((future, function, args))
+            self._lock.notify()
+        return future
+
+
+    def _next_task(self):
+        ''' Picks the next task round-robin among tenants with work waiting, skipping tenants
+            that are over their rate limit. Called with the lock held.
+        '''
+        while True:
+            if self._closed and len(self._pending) == 0:
+                return None
+
+            shortest_wait = None
+            for _ in range(len(self._ready)):
+                tenant_id = self._ready.popleft()
+                wait = self._rate_limiter.tenant_wait(tenant_id, self._tenant_limit)
+                if wait > 0:
+                    self._ready.append(tenant_id)
+                    shortest_wait = wait if shortest_wait is None else min(shortest_wait, wait)
+                    continue
+
+                self._running.add(tenant_id)
+                return tenant_id, self._pending[tenant_id].popleft()
+
+            self._lock.wait(shortest_wait)
+
+
+    def _finish_task(self, tenant_id):
+        ''' Puts a tenant back in turn if it has more work waiting. Called with the lock held. '''
+
+        self._running.discard(tenant_id)
+        if len(self._pending[tenant_id]) > 0:
+            self._ready.append(tenant_id)
+            self._lock.notify()
+        else:
+            del self._pending[tenant_id]
+            if self._closed:
+                self._lock.notify_all()
+
+
+    def _work(self):
+        while True:
+            with self._lock:
+                next_task = self._next_task()
+            if next_task is None:
+                return
+
+            tenant_id, (future, function, args) = next_task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(self.client(tenant_id), *args))
+                except Exception as e:
+                    # A failure of one tenant's task must not stop the worker.
+                    future.set_exception(e)
+            with self._lock:
+                self._finish_task(tenant_id)
+
+
+    def close(self):
+        ''' Runs the work already submitted, then stops the workers. '''
+
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        for worker in self._workers:
+            worker.join()
+        for client in self._loaded.values():
+            client._api_client._tokens.stop()
@@ -6,6 +6,7 @@ MONZO_CLIENT_SECRET = "mnzpub.YOUR_CLIENT_SECRET_HERE"
 # Configurations you should not need to change.
 MONZO_OAUTH_HOSTNAME = "auth.monzo.com"
 MONZO_API_HOSTNAME = "api.monzo.com"
+MONZO_API_SCHEME = "https" # Only changed to "http" to run against the local mock API in benchmarks/.
 MONZO_RESPONSE_TYPE = "code"
 MONZO_AUTH_GRANT_TYPE = "authorization_code"
 MONZO_REFRESH_GRANT_TYPE = "refresh_token"
@@ -13,3 +14,58 @@ MONZO_OAUTH_REDIRECT_URI = "http://127.0.0.1:21234/" # For receiving the auth co
 MONZO_CLIENT_IS_CONFIDENTIAL = True 
 # If your application runs on a backend server with client secret hidden from user, it should be registered 
 # as confidential and will have the ability to refresh access tokens.
+
+# HTTP transport settings for the pooled session used by OAuth2Client.
+MONZO_HTTP_POOL_CONNECTIONS = 4 # Number of per-host connection pools to keep.
+MONZO_HTTP_POOL_MAXSIZE = 16 # Maximum number of kept-alive connections per host.
+MONZO_HTTP_MAX_RETRIES = 3 # Retries on connection errors and 429/5xx responses.
+MONZO_HTTP_BACKOFF_FACTOR = 0.5 # Sleeps 0.5s, 1s, 2s... between retries, unless Retry-After says otherwise.
+MONZO_HTTP_TIMEOUT = 10 # Seconds before an API request is abandoned.
+MONZO_ASYNC_CONCURRENCY = 32 # Maximum number of requests in flight from async_client.AsyncOAuth2Client.
+
+# Tokens are saved encrypted to MONZO_TOKEN_STORE_PATH so that restarts skip the interactive auth
+# flow. Leave the key empty to disable this, or generate one with:
+#   python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+MONZO_TOKEN_STORE_PATH = "tokens.enc"
+MONZO_TOKEN_STORE_KEY = ""
+MONZO_TOKEN_REFRESH_MARGIN = 300 # Seconds before expiry at which the access token is refreshed.
+
+# Read-through cache for GET responses of the API paths below. Set MONZO_CACHE_MAX_ENTRIES to 0 to
+# disable it, and MONZO_CACHE_SQLITE_PATH to a file name to keep cached responses between runs.
+# Transaction listings are only cached when their "before" timestamp is in the past.
+MONZO_CACHE_MAX_ENTRIES = 1024 # Responses kept in memory, counted in entries rather than bytes.
+MONZO_CACHE_TTL = 300 # Seconds before a cached response is revalidated or fetched again.
+MONZO_CACHE_PATHS = ("transactions", "transaction-receipts")
+MONZO_CACHE_SQLITE_PATH = ""
+MONZO_CACHE_SQLITE_MAX_AGE = 7 * 24 * 60 * 60 # Seconds before an entry is pruned from the SQLite file.
+
+# Webhook receiver settings, see webhook_server.py.
+MONZO_WEBHOOK_LISTEN_HOST = "0.0.0.0"
+MONZO_WEBHOOK_LISTEN_PORT = 8080
+MONZO_WEBHOOK_WORKERS = 8 # Concurrent receipt uploads.
+MONZO_WEBHOOK_QUEUE_SIZE = 1000 # Events beyond this are refused with a 503, for Monzo to redeliver later.
+MONZO_WEBHOOK_DEAD_LETTER_PATH = "webhook_dead_letters.jsonl" # Receipts which could not be uploaded.
+
+# Client-side rate limits, as (requests per second, burst) token buckets. Endpoints are named by the
+# first segment of their path, e.g. "transactions" or "transaction-receipts".
+MONZO_RATE_LIMIT_ENDPOINTS = {}
+MONZO_RATE_LIMIT_DEFAULT = (20, 40) # Per endpoint, unless set in MONZO_RATE_LIMIT_ENDPOINTS.
+MONZO_RATE_LIMIT_PER_ACCOUNT = (10, 20)
+# The number of concurrent requests grows while responses are quicker than the latency target,
+# and is halved on 429/5xx responses or a Retry-After header.
+MONZO_CONCURRENCY_INITIAL = 8
+MONZO_CONCURRENCY_MIN = 1
+MONZO_CONCURRENCY_MAX = 64
+MONZO_CONCURRENCY_LATENCY_TARGET = 1.0 # Seconds.
+
+# Transactions are synced incrementally to this SQLite file by main.py. Leave empty to download the
+# whole history on every run instead. Each sync fetches again the transactions created in the
+# reconciliation window before the newest one stored, to pick up pending transactions which changed.
+MONZO_SYNC_DB_PATH = "transactions.db"
+MONZO_SYNC_RECONCILIATION_WINDOW = 7 * 24 * 60 * 60 # Seconds.
+
+MONZO_DAEMON_SOCKET_PATH = "monzo-receipts.sock" # Unix socket daemon.py serves cli.py commands on.
+
+# Hashes of the receipts written, so that receipts unchanged since are not uploaded again. Leave
+# empty to upload every receipt every time.
+MONZO_RECEIPT_HASH_DB_PATH = "receipt_hashes.db"
@@ -0,0 +1,210 @@
+import inspect
+import json
+import os
+import socket
+import socketserver
+import threading
+import traceback
+from collections import deque
+
+import bulk_upload
+import config
+import errors
+import main
+import receipt_hashes
+import sync
+
+# A long-lived process holding an authorised ReceiptsClient, with its warm connection pool
+# and resolved account, which serves the commands of cli.py over a local Unix socket. Auth
+# happens once when the daemon starts, so each command only costs its own API calls.
+#
+# Each connection carries one request, a line of JSON {"command": ..., "args": {...}},
+# answered with a line of JSON {"ok": true, "result": ...}, or {"ok": false, "error": ...,
+# "type": ...} naming the errors.MonzoError subclass raised, or the type of any other
+# exception, which is a bug in the daemon rather than in the request.
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Closed without a request, as when serve() checks for a running daemon.
+            return
+        try:
+            command, args = self._parse(line)
+            response = json.dumps({"ok": True, "result": self.server.daemon.run(command, args)})
+        except errors.MonzoError as e:
+            response = json.dumps({"ok": False, "error": str(e), "type": type(e).__name__})
+        except Exception as e:
+            # The client must still get a reply, and the daemon keep serving.
+            traceback.print_exc()
+            response = json.dumps({"ok": False, "error": "internal error: {!r}".format(e),
+                "type": type(e).__name__})
+        self.wfile.write(response.encode("utf-8") + b"\n")
+
+
+    @staticmethod
+    def _parse(line):
+        ''' Returns the command and arguments of a request line. '''
+
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError as e:
+            raise errors.ValidationError("bad request: {}".format(e))
+        if not isinstance(request, dict) or not isinstance(request.get("command"), str):
+            raise errors.ValidationError("bad request: no command given")
+        args = request.get("args") or {}
+        if not isinstance(args, dict):
+            raise errors.ValidationError("bad request: args must be an object")
+        return request["command"], args
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    ''' Runs commands with one authorised main.ReceiptsClient, shared by the threads
+        serving connections.
+    '''
+
+    COMMANDS = ("list", "put-receipt", "read-receipt", "register-webhook", "reconcile-receipts")
+
+    def __init__(self, receipts_client, transaction_store=None, receipt_uploader=None):
+        self._receipts_client = receipts_client
+        self._transaction_store = transaction_store
+        self._receipt_uploader = receipt_uploader
+        self._sync_lock = threading.Lock()
+        self._server = None
+
+
+    def run(self, command, args):
+        if command not in self.COMMANDS:
+            raise errors.ValidationError("unknown command {}".format(command))
+        method = getattr(self, "_" + command.replace("-", "_"))
+        try:
+            inspect.signature(method).bind(**args)
+        except TypeError as e:
+            raise errors.ValidationError("bad arguments for {}: {}".format(command, e))
+        return method(**args)
+
+
+    def _list(self, since=None, before=None, limit=100):
+        ''' Returns the latest `limit` transactions created in [since, before), oldest first. '''
+
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 0:
+            raise errors.ValidationError("limit must be a non-negative integer, not {!r}".format(limit))
+        for name, timestamp in (("since", since), ("before", before)):
+            if timestamp is not None and not isinstance(timestamp, str):
+                raise errors.ValidationError("{} must be an RFC 3339 timestamp, not {!r}".format(name,
+                    timestamp))
+
+        if self._transaction_store is None:
+            transactions = deque(maxlen=limit)
+            transactions.extend(self._receipts_client.iter_transactions(since=since, before=before))
+            return list(transactions)
+
+        # Concurrent commands would only fetch the same changes twice.
+        with self._sync_lock:
+            sync.SyncEngine(self._receipts_client, self._transaction_store,
+                getattr(config, "MONZO_SYNC_RECONCILIATION_WINDOW", 7 * 24 * 60 * 60)).sync()
+        return self._transaction_store.query(self._receipts_client._account_id, since=since, before=before,
+            newest_first=True, limit=limit)[::-1]
+
+
+    def _put_receipt(self, receipt):
+        try:
+            receipt = bulk_upload.build_receipt(receipt)
+        except ValueError as e:
+            raise errors.ValidationError("invalid receipt: {}".format(e))
+        if self._receipt_uploader is not None:
+            response = self._receipt_uploader.put(receipt)
+            if response is None:
+                return {"skipped": True, "stats": self._receipt_uploader.stats()}
+        else:
+            response = self._receipts_client._api_client.api_put("transaction-receipts/", receipt.marshal())
+        if self._transaction_store is not None:
+            self._transaction_store.record_receipt(receipt.transaction_id, receipt.external_id)
+        return response
+
+
+    def _read_receipt(self, external_id):
+        return self._receipts_client.read_receipt(external_id)
+
+
+    def _register_webhook(self, url):
+        return self._receipts_client.example_register_webhook(url)
+
+
+    def _reconcile_receipts(self, external_ids=None):
+        if self._receipt_uploader is None:
+            raise errors.MonzoError("No receipt hash store configured, set MONZO_RECEIPT_HASH_DB_PATH")
+        return self._receipt_uploader.reconcile(external_ids or None)
+
+
+    def serve(self, socket_path):
+        ''' Serves commands on the socket until shutdown() is called. Raises MonzoError if
+            another daemon is serving on it already.
+        '''
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                # Left behind by a daemon which did not shut down cleanly.
+                os.unlink(socket_path)
+            else:
+                raise errors.MonzoError("A daemon is already serving on {}".format(socket_path))
+            finally:
+                probe.close()
+
+        # Anyone able to connect can act on the account, so the socket is created
+        # accessible to its owner only, rather than restricted once others could connect.
+        previous_umask = os.umask(0o177)
+        try:
+            self._server = _UnixServer(socket_path, CommandHandler)
+        finally:
+            os.umask(previous_umask)
+        self._server.daemon = self
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.unlink(socket_path)
+
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+if __name__ == "__main__":
+    import signal
+    from utils import error
+
+    sync_db_path = getattr(config, "MONZO_SYNC_DB_PATH", "")
+    store = sync.TransactionStore(sync_db_path) if sync_db_path else None
+    client = main.ReceiptsClient(transaction_store=store)
+    try:
+        client.do_auth()
+    except errors.MonzoError as e:
+        error(e)
+
+    receipt_uploader = None
+    receipt_hash_db_path = getattr(config, "MONZO_RECEIPT_HASH_DB_PATH", "")
+    if receipt_hash_db_path:
+        receipt_uploader = receipt_hashes.ConditionalUploader(client._api_client,
+            receipt_hashes.ReceiptHashStore(receipt_hash_db_path))
+    daemon = Daemon(client, store, receipt_uploader)
+    # shutdown() waits for serve_forever() to return, so it cannot be called from the
+    # thread running it, which is the one signal handlers run on.
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: threading.Thread(target=daemon.shutdown).start())
+    socket_path = getattr(config, "MONZO_DAEMON_SOCKET_PATH", "monzo-receipts.sock")
+    print("Serving commands on {}".format(socket_path))
+    try:
+        daemon.serve(socket_path)
+    except errors.MonzoError as e:
+        client._api_client._tokens.stop()
+        error(e)
+    client._api_client._tokens.stop()
+    print("Daemon stopped.")
@@ -0,0 +1,62 @@
+# Exceptions raised by the library code of this client. They never exit the process:
+# only the command-line entry points turn them into an error message and exit code, so
+# long-running workers can catch them, and retry or give up on a single piece of work.
+
+class MonzoError(Exception):
+    ''' Base class of all errors raised by this client. '''
+
+
+class APIError(MonzoError):
+    ''' A call to the Monzo API failed. status_code is None if no response was received,
+        response holds the decoded response body, and retry_after the number of seconds
+        the API asked us to wait before trying again, if it did.
+    '''
+
+    def __init__(self, message, status_code=None, response=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = response
+        self.retry_after = retry_after
+
+
+class AuthError(APIError):
+    ''' The OAuth2 flow failed, or the API rejected our access token. '''
+
+
+class RateLimitedError(APIError):
+    ''' The API responded with 429 Too Many Requests. '''
+
+
+class TransientError(APIError):
+    ''' A failure likely to go away on retry: a 5xx response, a timeout or a connection error. '''
+
+
+class ValidationError(APIError):
+    ''' The request was rejected as invalid, or failed validation before being sent. '''
+
+
+class NotFoundError(APIError):
+    ''' The requested resource does not exist. '''
+
+
+def from_response(message, status_code, response, retry_after=None):
+    ''' Builds the APIError subclass matching a failed response's status code. '''
+
+    if status_code in (401, 403):
+        error_class = AuthError
+    elif status_code == 404:
+        error_class = NotFoundError
+    elif status_code == 429:
+        error_class = RateLimitedError
+    elif status_code >= 500:
+        error_class = TransientError
+    elif status_code >= 400:
+        error_class = ValidationError
+    else:
+        error_class = APIError
+    return error_class("{} ({}: {})".format(message, status_code, response), status_code, response,
+        retry_after)
+
+
+def is_retryable(error):
+    return isinstance(error, (TransientError, RateLimitedError))
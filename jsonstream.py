@@ -0,0 +1,115 @@
+import codecs
+import json
+
+# Incremental decoding of large JSON responses, such as long transaction listings, as
+# their body arrives. Only the part of the body holding the element being decoded is
+# kept, so memory use does not grow with the size of the response, and the first
+# element is available as soon as its bytes are.
+
+_WHITESPACE = " \t\n\r"
+_NUMBER_CHARACTERS = "0123456789.eE+-"
+_decoder = json.JSONDecoder()
+
+
+def project(value, fields):
+    ''' Keeps only the given fields of a decoded object. '''
+
+    return {field: value[field] for field in fields if field in value}
+
+
+class _Buffer:
+    ''' Text decoded from a stream of byte chunks, consumed from the front. '''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder("utf-8")().decode
+        self.text = ""
+        self.position = 0
+        self.finished = False
+
+
+    def fill(self):
+        ''' Appends the next chunk, dropping the text already consumed. Returns False at the
+            end of the stream.
+        '''
+        if self.finished:
+            return False
+        chunk = next(self._chunks, None)
+        self.text = self.text[self.position:] + self._decode(chunk if chunk is not None else b"",
+            final=chunk is None)
+        self.position = 0
+        self.finished = chunk is None
+        return True
+
+
+    def peek(self):
+        ''' Skips whitespace and returns the next character, or "" at the end of the stream. '''
+
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in _WHITESPACE:
+                self.position += 1
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self.fill():
+                return ""
+
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError("expected {!r} at {!r}".format(character, self.text[self.position:self.position + 20]))
+        self.position += 1
+
+
+    def value(self):
+        ''' Decodes the next JSON value. '''
+
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.position)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number running to the end of the text, or cut short at a character that
+            # cannot follow a whole number, such as the "e" of "1e-05", may continue in the
+            # next chunk.
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and not self.finished \
+                and (end == len(self.text) or self.text[end] in _NUMBER_CHARACTERS):
+                self.fill()
+                continue
+            self.position = end
+            return value
+
+
+def iter_array(chunks, key=None, fields=None):
+    ''' Yields the elements of a JSON array from an iterable of byte chunks. The array is
+        either the whole document, or if key is given the value of that key in a top-level
+        object, whose other values are decoded and dropped. If fields are given, elements
+        are objects of which only those fields are kept.
+    '''
+    buffer = _Buffer(chunks)
+    if key is not None:
+        buffer.expect("{")
+        while True:
+            if buffer.peek() == "}":
+                raise KeyError(key)
+            name = buffer.value()
+            buffer.expect(":")
+            if name == key:
+                break
+            buffer.value()
+            if buffer.peek() == ",":
+                buffer.position += 1
+
+    buffer.expect("[")
+    if buffer.peek() == "]":
+        return
+    while True:
+        value = buffer.value()
+        yield project(value, fields) if fields is not None else value
+        if buffer.peek() == ",":
+            buffer.position += 1
+            continue
+        buffer.expect("]")
+        return
@@ -1,23 +1,57 @@
 import json
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import requests
 
 import config
+import errors
 import oauth2
+import receipt_hashes
 import receipt_types
+import sync
+import transaction_index
 from utils import error
 
+def build_example_receipt(transaction, receipt_id):
+    ''' Builds a receipt with fabricated information for a transaction, itemised so that
+        it adds up to the transaction amount.
+    '''
+    # Price amounts are in the number of pences.
+    example_sub_item_1 = receipt_types.SubItem("Bananas loose", 1.5, "kg", 119, "GBP", 0)
+    example_sub_item_2 = receipt_types.SubItem("Organic bananas", 1, "kg", 150, "GBP", 0)
+    example_items = [receipt_types.Item("Selected bananas", 2.5, "kg", 269, "GBP", 0, [example_sub_item_1,
+        example_sub_item_2])]
+    if abs(transaction["amount"]) > 269:
+        example_items.append(receipt_types.Item("Excess fare", 1, "", abs(transaction["amount"]) 
+            - 269, "GBP", 20, []))
+    example_payments = [receipt_types.Payment("card", "123321", "1234", "A10B2C", "", "", "", "", 
+        abs(transaction["amount"]), "GBP")]
+    example_taxes = [receipt_types.Tax("VAT", 0, "GBP", "12345678")]
+
+    return receipt_types.Receipt("", receipt_id, transaction["id"], 
+        abs(transaction["amount"]), "GBP", example_payments, example_taxes, example_items)
+
+
 class ReceiptsClient:
     ''' An example single-account client of the Monzo Transaction Receipts API. 
         For the underlying OAuth2 implementation, see oauth2.OAuth2Client.
     '''
 
-    def __init__(self):
-        self._api_client = oauth2.OAuth2Client()
-        self._api_client_ready = False
-        self._account_id = None
+    def __init__(self, api_client=None, account_id=None, transaction_store=None, receipt_uploader=None):
+        self._api_client = api_client if api_client is not None else oauth2.OAuth2Client()
+        self._api_client_ready = api_client is not None and account_id is not None
+        self._account_id = account_id
+        self._transaction_store = transaction_store
+        self._receipt_uploader = receipt_uploader
         self.transactions = []
+        self.transaction_index = transaction_index.TransactionIndex()
+        # An already authorised API client and account can be passed in to skip do_auth().
+        # With a sync.TransactionStore, transactions are synced to it incrementally rather
+        # than downloaded in full on every run. With a receipt_hashes.ConditionalUploader,
+        # receipts are only uploaded if they changed since they were last written.
 
 
     def do_auth(self):
@@ -25,27 +59,34 @@ class ReceiptsClient:
             authorised user's current account information, rather than from joint account, 
             if present. Also waits for user to confirm access to their data in their Monzo
             app -- this is required for the client to be compliant with Strong Customer
-            Authentication and able to access user data.
+            Authentication and able to access user data. If a token store is configured,
+            tokens saved by a previous run are used instead, skipping the interactive flow.
         '''
 
-        print("Starting OAuth2 flow...")
-        self._api_client.start_auth()
-
-        print("OAuth2 flow completed, testing API call...")
-        response = self._api_client.test_api_call()
-        if "authenticated" in response:
-            print("API call test successful!")
-        else:
-            error("OAuth2 flow seems to have failed.")
+        # Tokens saved by a previous run were already approved in the Monzo app.
+        try:
+            restored = self._api_client.load_saved_tokens() and self._test_api_call()
+        except errors.AuthError as e:
+            # Revoked, or expired without a refresh token to renew them.
+            print("Saved tokens were rejected ({}), discarding them.".format(e))
+            self._api_client.clear_saved_tokens()
+            restored = False
+        if not restored:
+            print("Starting OAuth2 flow...")
+            self._api_client.start_auth()
+            print("OAuth2 flow completed, testing API call...")
+            self._test_api_call()
         self._api_client_ready = True
 
-        print("Please open your Monzo app, click \"Allow access to your data\" for your application, and follow the instructions.") 
-        input("Once approved, press [Enter] to continue:")
+        if not restored:
+            print("Please open your Monzo app, click \"Allow access to your data\" for your application, and follow the instructions.") 
+            input("Once approved, press [Enter] to continue:")
 
         print("Retrieving account information...")
-        success, response = self._api_client.api_get("accounts", {})
-        if not success or "accounts" not in response or len(response["accounts"]) < 1:
-            error("Could not retrieve accounts information: {}".format(response))
+        response = self._api_client.api_get("accounts", {})
+        if "accounts" not in response or len(response["accounts"]) < 1:
+            raise errors.APIError("Could not retrieve accounts information: {}".format(response),
+                response=response)
         
         # We will be operating on personal account only.
         for account in response["accounts"]:
@@ -55,40 +96,139 @@ class ReceiptsClient:
                 return
 
         if self._account_id is None:
-            error("Could not find a personal account")
+            raise errors.MonzoError("Could not find a personal account")
     
 
-    def list_transactions(self):
-        ''' An example call to the end point documented in
-            https://docs.monzo.com/#list-transactions, other requests 
-            can be implemented in a similar fashion. 
+    def _test_api_call(self):
+        response = self._api_client.test_api_call()
+        if "authenticated" not in response:
+            raise errors.AuthError("OAuth2 flow seems to have failed.")
+        print("API call test successful!")
+        return True
+
+
+    def iter_transactions(self, since=None, before=None, page_size=100, prefetch=True, fields=None,
+        use_cache=True):
+        ''' Walks the end point documented in https://docs.monzo.com/#list-transactions
+            page by page, yielding transactions oldest first. Pages are requested with a
+            "since" cursor set to the last transaction ID seen. If prefetch is set, the next
+            page is fetched in the background once the caller moves past the first
+            transaction of a page, so stopping on the first transaction of a page requests
+            no further pages, and stopping later at most one. If fields are
+            given, such as ("id", "amount", "user_id", "created", "merchant"), pages are
+            decoded as they stream in and only those fields of each transaction kept.
+            Set use_cache to False to skip the response cache of the API client.
         '''
         if self._api_client is None or not self._api_client_ready:
-            error("API client not initialised.")
+            raise errors.MonzoError("API client not initialised.")
 
-        # Our call is not paginated here with e.g. "limit": 10, which will be slow for
-        # accounts with a lot of transactions.
-        success, response = self._api_client.api_get("transactions", {
-            "account_id": self._account_id,
-        })
+        def fetch_page(cursor):
+            params = {
+                "account_id": self._account_id,
+                "limit": page_size,
+            }
+            if cursor is not None:
+                params["since"] = cursor
+            if before is not None:
+                params["before"] = before
+            if fields is not None:
+                # The cursor needs the ID of the last transaction of a page.
+                return list(self._api_client.api_get_stream("transactions", params, "transactions",
+                    tuple(fields) + ("id",) if "id" not in fields else fields))
+            response = self._api_client.api_get("transactions", params, use_cache)
+            if "transactions" not in response:
+                raise errors.APIError("Could not list past transactions ({})".format(response),
+                    response=response)
+            return response["transactions"]
 
-        if not success or "transactions" not in response:
-            error("Could not list past transactions ({})".format(response))
-        
-        self.transactions = response["transactions"]
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page = fetch_page(since)
+            while len(page) > 0:
+                cursor = page[-1]["id"] if len(page) >= page_size else None
+                pending = None
+                for i, transaction in enumerate(page):
+                    yield transaction
+                    if i == 0 and executor is not None and cursor is not None:
+                        pending = executor.submit(fetch_page, cursor)
+
+                if cursor is None:
+                    return
+                page = pending.result() if pending is not None else fetch_page(cursor)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def list_transactions(self, keep_last=None):
+        ''' Loads transactions of the account into self.transactions, and indexes them in
+            self.transaction_index, using the paginated iter_transactions(). If keep_last is
+            set, only the most recent keep_last transactions are held in memory while the
+            rest of the history streams past.
+            With a transaction store, only what changed since the last sync is fetched
+            and the transactions are then read from the store.
+        '''
+        if self._transaction_store is not None:
+            counts = sync.SyncEngine(self, self._transaction_store,
+                getattr(config, "MONZO_SYNC_RECONCILIATION_WINDOW", 7 * 24 * 60 * 60)).sync()
+            print("Synced transactions: {}".format(counts))
+            self.transactions = self._transaction_store.query(self._account_id, newest_first=True,
+                limit=keep_last)[::-1]
+            self.transaction_index = transaction_index.TransactionIndex(self.transactions)
+            return
+
+        transactions = deque(maxlen=keep_last)
+        transactions.extend(self.iter_transactions())
+
+        self.transactions = list(transactions)
+        self.transaction_index = transaction_index.TransactionIndex(self.transactions)
         print("All transactions loaded.")
+
+
+    def find_transaction(self, predicate, **kwargs):
+        ''' Returns the oldest transaction for which predicate(transaction) is true, reading
+            no page past the one it was found on, other than one being prefetched. Keyword
+            arguments are passed on to iter_transactions(). Returns None if no transaction
+            matches.
+        '''
+        for transaction in self.iter_transactions(**kwargs):
+            if predicate(transaction):
+                return transaction
+        return None
+
+
+    def find_latest_transaction(self, predicate, window=7 * 24 * 60 * 60, windows=8, **kwargs):
+        ''' Returns the most recent transaction for which predicate(transaction) is true, or
+            None. Transactions are only listed oldest first, so the history is searched in
+            time windows going back from now, the first `window` seconds long and each one
+            after twice as long as the one before, and only the windows down to the one
+            holding the match are downloaded. After `windows` windows, the rest of the
+            history is searched in one go. Keyword arguments other than since and before are
+            passed on to iter_transactions().
+        '''
+        end = datetime.now(timezone.utc)
+        before = None
+        for i in range(windows + 1):
+            start = end - timedelta(seconds=window * (2 ** (i + 1) - 1))
+            since = start.strftime(sync.TIMESTAMP_FORMAT) if i < windows else None
+            match = None
+            for transaction in self.iter_transactions(since=since, before=before, **kwargs):
+                if predicate(transaction):
+                    match = transaction
+            if match is not None:
+                return match
+            before = since
+        return None
         
 
     def read_receipt(self, receipt_id):
         ''' Retrieve receipt for a transaction with an external ID of our choosing.
         '''
-        success, response = self._api_client.api_get("transaction-receipts", {
+        response = self._api_client.api_get("transaction-receipts", {
             "external_id": receipt_id,
         })
-        if not success:
-            error("Failed to load receipt: {}".format(response))
-        
         print("Receipt read: {}".format(response))
+        return response
 
     
     def example_add_receipt_data(self):
@@ -97,51 +237,34 @@ class ReceiptsClient:
             receipts data on the same transaction again and again to test it 
             if you need to. 
         '''
-        if len(self.transactions) == 0:
-            error("No transactions found, either it was not loaded with list_transactions() or there's no transaction in the Monzo account :/")
-
-        transactions_index = -1
-        most_recent_transaction = None
-        while abs(transactions_index) <= len(self.transactions):
-            # Some transactions are not initiated by the user, for example the monthly transaction charging overdraft fees. Because
-            # we can only add receipts to transactions initiated by the user, we need to search from the most recent until such a
-            # transaction is found.
-            if self.transactions[transactions_index]["user_id"] != self._api_client._user_id:
-                transactions_index -= 1
-                continue
-
-            most_recent_transaction = self.transactions[transactions_index]
-            break
-        
+        # Some transactions are not initiated by the user, for example the monthly transaction charging overdraft fees. Because
+        # we can only add receipts to transactions initiated by the user, the most recent of those is looked up in the index, or
+        # if no transactions were loaded with list_transactions(), in as much of the recent history as it takes to find one.
+        user_id = self._api_client._user_id
+        if len(self.transaction_index) > 0:
+            most_recent_transaction = self.transaction_index.latest(user_id=user_id)
+        else:
+            most_recent_transaction = self.find_latest_transaction(
+                lambda transaction: transaction.get("user_id") == user_id)
         if most_recent_transaction == None:
-            error("Could not find a transaction initiated by the user, cannot continue.")
+            raise errors.MonzoError("Could not find a transaction initiated by the user, cannot continue.")
 
         print("Using most recent transaction to attach receipt: {}".format(most_recent_transaction))
 
         # Using a random receipt ID we generate as external ID
         receipt_id = uuid.uuid4().hex
-        
-        # Price amounts are in the number of pences.
-        example_sub_item_1 = receipt_types.SubItem("Bananas loose", 1.5, "kg", 119, "GBP", 0)
-        example_sub_item_2 = receipt_types.SubItem("Organic bananas", 1, "kg", 150, "GBP", 0)
-        example_items = [receipt_types.Item("Selected bananas", 2.5, "kg", 269, "GBP", 0, [example_sub_item_1,
-            example_sub_item_2])]
-        if abs(most_recent_transaction["amount"]) > 269:
-            example_items.append(receipt_types.Item("Excess fare", 1, "", abs(most_recent_transaction["amount"]) 
-            - 269, "GBP", 20, []))
-        example_payments = [receipt_types.Payment("card", "123321", "1234", "A10B2C", "", "", "", "", 
-            abs(most_recent_transaction["amount"]), "GBP")]
-        example_taxes = [receipt_types.Tax("VAT", 0, "GBP", "12345678")]
-        
-        example_receipt = receipt_types.Receipt("", receipt_id, most_recent_transaction["id"], 
-            abs(most_recent_transaction["amount"]), "GBP", example_payments, example_taxes, example_items)
+        example_receipt = build_example_receipt(most_recent_transaction, receipt_id)
         example_receipt_marshaled = example_receipt.marshal()
         print("Uploading receipt data to API: ", json.dumps(example_receipt_marshaled, indent=4, sort_keys=True))
         print("")
         
-        success, response = self._api_client.api_put("transaction-receipts/", example_receipt_marshaled)
-        if not success:
-            error("Failed to upload receipt: {}".format(response))
+        if self._receipt_uploader is not None:
+            response = self._receipt_uploader.put(example_receipt)
+        else:
+            response = self._api_client.api_put("transaction-receipts/", example_receipt_marshaled)
+        self.transaction_index.mark_receipt(most_recent_transaction["id"])
+        if self._transaction_store is not None:
+            self._transaction_store.record_receipt(most_recent_transaction["id"], receipt_id)
 
         print("Successfully uploaded receipt {}: {}".format(receipt_id, response))
         return receipt_id
@@ -157,33 +280,45 @@ class ReceiptsClient:
         '''
 
         print("Listing webhooks on account")
-        success, response = self._api_client.api_get("webhooks", {
+        response = self._api_client.api_get("webhooks", {
             "account_id": self._account_id,
         })
-        if not success:
-            error("Failed to list webhooks: {}".format(response))
         print("Existing webhooks: ", response)
 
         print("Registering a webhook with callback URL {} ...".format(incoming_endpoint))
-        success, response = self._api_client.api_post("webhooks", {
+        response = self._api_client.api_post("webhooks", {
             "account_id": self._account_id,
             "url": incoming_endpoint,
         })
-        if not success or "webhook" not in response:
-            error("Failed to register webhook: {}".format(response))
+        if "webhook" not in response:
+            raise errors.APIError("Failed to register webhook: {}".format(response), response=response)
         print("Successfully registered webhooks ", response)
 
         return response["webhook"]["id"]
         
 
 if __name__ == "__main__":
-    client = ReceiptsClient()
-    client.do_auth()
-    client.list_transactions()
-    receipt_id = client.example_add_receipt_data()
-    client.read_receipt(receipt_id)
-    client.example_register_webhook("https://example.com/webhook_callback") 
-    # The webhook endpoint used should be an HTTP-style server served by your own app server.
+    # Errors raised by the client end the example here, the only place it exits.
+    try:
+        sync_db_path = getattr(config, "MONZO_SYNC_DB_PATH", "")
+        store = sync.TransactionStore(sync_db_path) if sync_db_path else None
+        api_client = oauth2.OAuth2Client()
+        receipt_uploader = None
+        receipt_hash_db_path = getattr(config, "MONZO_RECEIPT_HASH_DB_PATH", "")
+        if receipt_hash_db_path:
+            receipt_uploader = receipt_hashes.ConditionalUploader(api_client,
+                receipt_hashes.ReceiptHashStore(receipt_hash_db_path))
+        client = ReceiptsClient(api_client, transaction_store=store, receipt_uploader=receipt_uploader)
+        client.do_auth()
+        if store is not None:
+            # Only fetches what changed since the last run.
+            client.list_transactions()
+        receipt_id = client.example_add_receipt_data()
+        client.read_receipt(receipt_id)
+        client.example_register_webhook("https://example.com/webhook_callback") 
+        # The webhook endpoint used should be an HTTP-style server served by your own app server.
+    except errors.MonzoError as e:
+        error(e)
 
     
     
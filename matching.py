@@ -0,0 +1,124 @@
+import bisect
+from collections import defaultdict
+from datetime import datetime, timezone
+
+# Matching receipts from merchant exports, which do not know Monzo transaction IDs, to the
+# transactions they were paid with. Transactions are bucketed by (currency, amount), so a
+# receipt is only ever compared with the transactions of its own amount, and within a
+# bucket only with those made within a time window of the purchase, found by bisection.
+
+def to_seconds(timestamp):
+    ''' Converts an RFC 3339 timestamp to seconds since the epoch, taking its UTC offset
+        into account, so that a merchant's local time matches the UTC time of the API. A
+        timestamp without an offset is taken to be in UTC. Numbers are taken to be seconds
+        since the epoch already.
+    '''
+    if isinstance(timestamp, (int, float)):
+        return timestamp
+    # fromisoformat() is much quicker than strptime(), but only accepts a trailing Z from
+    # Python 3.11.
+    parsed = datetime.fromisoformat(timestamp[:-1] + "+00:00" if timestamp.endswith("Z") else timestamp)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def receipt_last_four(receipt):
+    ''' Returns the last four digits of the card a receipt was paid with, if any. '''
+
+    for payment in receipt.payments:
+        if payment.type == "card" and payment.last_four:
+            return payment.last_four
+    return None
+
+
+class MatchingEngine:
+    ''' Matches receipt_types.Receipts to transactions of the same currency and amount,
+        made within `window` seconds of the purchase, paid out of the account and not
+        declined. If card_last_four(transaction) is given and returns the last four digits
+        of the card a transaction was made with, it must also agree with the card payment
+        on the receipt.
+
+        Where several receipts and transactions could match one another, the pairs
+        closest in time are matched first, with ties broken by receipt time, receipt
+        external_id, and then transaction ID, so that the same input always gives the
+        same matches. A transaction is matched at most once across calls to match().
+    '''
+
+    def __init__(self, transactions, window=600, card_last_four=None):
+        self._window = window
+        self._card_last_four = card_last_four
+        self._buckets = defaultdict(list)
+        self._matched = set()
+        for transaction in transactions:
+            # Only payments out of the account have receipts, whose totals are positive, and
+            # declined payments never took the money.
+            if transaction["amount"] >= 0 or transaction.get("decline_reason"):
+                continue
+            self._buckets[(transaction.get("currency"), -transaction["amount"])].append(
+                (to_seconds(transaction["created"]), transaction["id"], transaction))
+        for bucket in self._buckets.values():
+            # Transaction IDs are unique, so the transactions themselves are never compared.
+            bucket.sort()
+
+
+    def match(self, receipts):
+        ''' Takes (receipt, purchased_at) pairs, purchased_at being an RFC 3339 timestamp or
+            seconds since the epoch, and returns (matched, unmatched) lists of receipts. The
+            matched receipts have their transaction_id set and are ready to upload.
+        '''
+        by_bucket = defaultdict(list)
+        for receipt, purchased_at in receipts:
+            by_bucket[(receipt.currency, receipt.total)].append((to_seconds(purchased_at), receipt))
+
+        matched = []
+        unmatched = []
+        for key, bucket_receipts in by_bucket.items():
+            transactions = self._buckets.get(key)
+            if not transactions:
+                unmatched.extend(receipt for _, receipt in bucket_receipts)
+                continue
+            for receipt, transaction in self._match_bucket(bucket_receipts, transactions):
+                if transaction is None:
+                    unmatched.append(receipt)
+                else:
+                    receipt.transaction_id = transaction["id"]
+                    matched.append(receipt)
+                    self._matched.add(transaction["id"])
+        return matched, unmatched
+
+
+    def _match_bucket(self, bucket_receipts, transactions):
+        ''' Returns (receipt, transaction or None) for every receipt of a bucket. '''
+
+        times = [entry[0] for entry in transactions]
+        window = self._window
+        candidates = []
+        for i, (purchased_at, receipt) in enumerate(bucket_receipts):
+            last_four = receipt_last_four(receipt) if self._card_last_four is not None else None
+            start = bisect.bisect_left(times, purchased_at - window)
+            end = bisect.bisect_right(times, purchased_at + window, start)
+            for j in range(start, end):
+                created, transaction_id, transaction = transactions[j]
+                if transaction_id in self._matched:
+                    continue
+                if last_four is not None:
+                    transaction_last_four = self._card_last_four(transaction)
+                    if transaction_last_four is not None and transaction_last_four != last_four:
+                        continue
+                # Compared field by field up to the transaction ID, which is unique, so the
+                # positions after it only serve to look the pair up again.
+                candidates.append((abs(created - purchased_at), purchased_at, receipt.external_id,
+                    transaction_id, i, j))
+
+        assigned = [None] * len(bucket_receipts)
+        if len(candidates) == 1:
+            assigned[candidates[0][4]] = transactions[candidates[0][5]][2]
+        elif len(candidates) > 1:
+            candidates.sort()
+            taken = set()
+            for _, _, _, transaction_id, i, j in candidates:
+                if assigned[i] is None and transaction_id not in taken:
+                    assigned[i] = transactions[j][2]
+                    taken.add(transaction_id)
+        return [(receipt, assigned[i]) for i, (_, receipt) in enumerate(bucket_receipts)]
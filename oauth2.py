@@ -3,10 +3,18 @@ import uuid
 import base64
 import urllib.parse as urllib
 import json
+import time
+import email.utils
 
 import requests
+from urllib3.util.retry import Retry
 
-from utils import error
+import cache
+import errors
+import jsonstream
+import ratelimit
+import tokens
+import tracing
 
 # A very simple OAuth2 client for the Monzo Third Party API. You presently cannot use
 # this API for public applications, as only a small amount of users you nominate can
@@ -26,7 +34,8 @@ class OAuth2Client:
         https://docs.monzo.com/#acquire-an-access-token
     '''
     
-    def __init__(self):
+    def __init__(self, response_cache=None, session=None, token_store=None, background_refresh=True,
+        rate_limiter=None):
         self._user_id = ""
         self._is_confidential_client = config.MONZO_CLIENT_IS_CONFIDENTIAL
         # Your client should only be confidential if it is a backend application, with
@@ -36,7 +45,155 @@ class OAuth2Client:
         # browser from cross site forgery attacks. While we don't need it as a 
         # command-line application, we still send a randomised state nevertheless 
         # to demonstrate.
-        
+        self._session = session if session is not None else self.build_session()
+        self._session_headers = {}
+        # All calls, including those to the token endpoints, share one pooled session so
+        # connections to the API are kept alive instead of re-handshaking every request.
+        # A session may be shared by several clients, so the Authorization header is kept
+        # per client and sent with each request.
+        self._access_token = ""
+        self._refresh_token = ""
+        store_key = getattr(config, "MONZO_TOKEN_STORE_KEY", "")
+        if token_store is None and store_key:
+            token_store = tokens.TokenStore(getattr(config, "MONZO_TOKEN_STORE_PATH", "tokens.enc"),
+                store_key)
+        self._tokens = tokens.TokenManager(self._exchange_refresh_token,
+            getattr(config, "MONZO_TOKEN_REFRESH_MARGIN", 300), token_store, background_refresh)
+        self._cache = response_cache if response_cache is not None else self.build_response_cache()
+        # GET responses of slow-changing resources are cached, see cache.ResponseCache.
+        self._rate_limiter = rate_limiter if rate_limiter is not None else self.build_rate_limiter()
+        # Every API call waits for the client-side rate and concurrency limits.
+        self._observers = []
+
+
+    @staticmethod
+    def build_session(pool_maxsize=None):
+        ''' Builds a requests session with a bounded per-host connection pool and retries
+            with exponential backoff on connection errors and 429/5xx responses.
+        '''
+        retries = Retry(
+            total=getattr(config, "MONZO_HTTP_MAX_RETRIES", 3),
+            backoff_factor=getattr(config, "MONZO_HTTP_BACKOFF_FACTOR", 0.5),
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = tracing.TimedHTTPAdapter(
+            pool_connections=getattr(config, "MONZO_HTTP_POOL_CONNECTIONS", 4),
+            pool_maxsize=pool_maxsize or getattr(config, "MONZO_HTTP_POOL_MAXSIZE", 16),
+            max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+    @staticmethod
+    def build_rate_limiter():
+        ''' Builds the client-side rate limiter configured in config.py. '''
+
+        return ratelimit.RequestLimiter(
+            getattr(config, "MONZO_RATE_LIMIT_ENDPOINTS", {}),
+            getattr(config, "MONZO_RATE_LIMIT_DEFAULT", (20, 40)),
+            getattr(config, "MONZO_RATE_LIMIT_PER_ACCOUNT", (10, 20)),
+            ratelimit.AdaptiveConcurrencyLimit(
+                getattr(config, "MONZO_CONCURRENCY_INITIAL", 8),
+                getattr(config, "MONZO_CONCURRENCY_MIN", 1),
+                getattr(config, "MONZO_CONCURRENCY_MAX", 64),
+                getattr(config, "MONZO_CONCURRENCY_LATENCY_TARGET", 1.0),
+            ),
+        )
+
+
+    @staticmethod
+    def build_response_cache():
+        ''' Builds the response cache configured in config.py, or returns None if it is disabled. '''
+
+        max_entries = getattr(config, "MONZO_CACHE_MAX_ENTRIES", 1024)
+        if max_entries <= 0:
+            return None
+        return cache.ResponseCache(max_entries, getattr(config, "MONZO_CACHE_TTL", 300),
+            getattr(config, "MONZO_CACHE_PATHS", ("transactions", "transaction-receipts")),
+            getattr(config, "MONZO_CACHE_SQLITE_PATH", ""),
+            getattr(config, "MONZO_CACHE_SQLITE_MAX_AGE", 7 * 24 * 60 * 60))
+
+
+    def _set_access_token(self, access_token):
+        ''' Records a new access token, sent as the Authorization header of every API call. '''
+
+        self._access_token = access_token
+        self._session_headers = {"Authorization": "Bearer {}".format(access_token)}
+
+
+    def _record_tokens(self, expires_in):
+        self._tokens.record({
+            "access_token": self._access_token,
+            "refresh_token": self._refresh_token,
+            "user_id": self._user_id,
+        }, expires_in)
+
+
+    def load_saved_tokens(self):
+        ''' Restores tokens saved by a previous run, if a token store is configured. Returns
+            whether tokens were found, in which case the interactive auth flow can be skipped.
+        '''
+        saved = self._tokens.load()
+        if saved is None:
+            return False
+
+        self._set_access_token(saved["access_token"])
+        self._refresh_token = saved.get("refresh_token", "")
+        self._user_id = saved.get("user_id", "")
+        if self._refresh_token == "":
+            self._is_confidential_client = False
+        self._tokens.refresh_if_expiring()
+        print("Restored saved access token.")
+        return True
+
+
+    def clear_saved_tokens(self):
+        ''' Forgets the current tokens and deletes saved ones, such as after they were
+            revoked, so that the next run goes through the interactive auth flow.
+        '''
+        self._tokens.clear()
+        self._set_access_token("")
+        self._refresh_token = ""
+        self._user_id = ""
+        self._is_confidential_client = config.MONZO_CLIENT_IS_CONFIDENTIAL
+
+
+    def pool_stats(self):
+        ''' Returns connection pool counters for the session: a hit is a request served on a
+            kept-alive connection, a miss is one that had to open a new connection.
+        '''
+        stats = {"requests": 0, "hits": 0, "misses": 0}
+        for adapter in set(self._session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                stats["requests"] += pool.num_requests
+                stats["misses"] += pool.num_connections
+        stats["hits"] = max(stats["requests"] - stats["misses"], 0)
+        return stats
+
+
+    def add_observer(self, observer):
+        ''' Registers observer(event) to be called with a tracing.RequestEvent after every
+            request sent to the API, e.g. a tracing.PrometheusExporter.
+        '''
+        self._observers.append(observer)
+
+
+    def remove_observer(self, observer):
+        self._observers.remove(observer)
+
+
+    def cache_stats(self):
+        ''' Returns the response cache's hit ratio and bytes saved, or None if caching is off. '''
+
+        return self._cache.stats() if self._cache is not None else None
+
     
     def start_auth(self):
         ''' Builds an auth URL to be used to initiate OAuth2 flow on the web OAuth portal. '''
@@ -59,16 +216,16 @@ class OAuth2Client:
         callback_url = input("Once you have obtained the callback link by clicking the login button in your email, paste your callback URL here: ").strip()
         try:
             callback = urllib.urlparse(callback_url).query
-        except:
-            error("cannot parse callback URL, try again.")
+        except ValueError:
+            raise errors.AuthError("cannot parse callback URL, try again.")
 
         callback_qs = dict(urllib.parse_qsl(callback))
         if "code" not in callback_qs:
-            error("cannot find temporary auth code in callback URL")
+            raise errors.AuthError("cannot find temporary auth code in callback URL")
         if "state" not in callback_qs:
-            error("cannot find randomised auth state in callback URL")
+            raise errors.AuthError("cannot find randomised auth state in callback URL")
         if callback_qs["state"].strip() != self._oauth_state:
-            error("invalid randomised auth state in callback URL, did you use the most recent login link?")
+            raise errors.AuthError("invalid randomised auth state in callback URL, did you use the most recent login link?")
         
         self._auth_code = callback_qs["code"].strip()
         self.exchange_auth_code()
@@ -78,7 +235,7 @@ class OAuth2Client:
         '''Exchanges the temporary authorization code with an access token for the application. '''
         
         if self._auth_code == "":
-            error("no auth code, have you completed intial auth flow")
+            raise errors.AuthError("no auth code, have you completed intial auth flow")
 
         oauth2_POST_params = {
             "grant_type": config.MONZO_AUTH_GRANT_TYPE,
@@ -87,16 +244,10 @@ class OAuth2Client:
             "redirect_uri": config.MONZO_OAUTH_REDIRECT_URI,
             "code": self._auth_code,
         }
-        request_url = "https://{}/oauth2/token?".format(config.MONZO_API_HOSTNAME)
-        response = requests.post(request_url, data=oauth2_POST_params)
-        if response.status_code != 200:
-            error("Auth failed, bad status code returned: {} ({})".format(response.status_code,
-                response.text))
-
-        response_object = response.json()
+        response_object = self._post_token(oauth2_POST_params, "Auth failed")
         if "access_token" in response_object:
             print("Auth successful, access token received.") 
-            self._access_token = response_object["access_token"]
+            self._set_access_token(response_object["access_token"])
 
             if "refresh_token" in response_object:
                 self._refresh_token = response_object["refresh_token"]
@@ -106,16 +257,24 @@ class OAuth2Client:
                     print("Warning: this client is not registered as confidential, we will not be able to refresh token")
     
             if "user_id" not in response_object:
-                error("Could not retrieve user_id from token exchange response: {}", response_object)
+                raise errors.AuthError("Could not retrieve user_id from token exchange response: {}".format(
+                    response_object))
             self._user_id = response_object["user_id"]
+            self._record_tokens(response_object.get("expires_in"))
 
 
     def refresh_access_token(self):
         ''' If we are a confidential client, we can refresh the access token to get a new one derived from the same OAuth
-            authorisation. 
+            authorisation. Concurrent callers share a single refresh.
         '''
+        self._tokens.refresh()
+
+
+    def _exchange_refresh_token(self):
+        ''' Exchanges the refresh token for new tokens, see refresh_access_token(). '''
+
         if not self._is_confidential_client:
-            error("Not a confidential client, cannot refresh access token.")
+            raise errors.AuthError("Not a confidential client, cannot refresh access token.")
 
         oauth2_POST_params = {
             "grant_type": config.MONZO_REFRESH_GRANT_TYPE,
@@ -123,98 +282,262 @@ class OAuth2Client:
             "client_secret": config.MONZO_CLIENT_SECRET,
             "refresh_token": self._refresh_token,
         }
-        request_url = "https://{}/oauth2/token?".format(config.MONZO_API_HOSTNAME)
-        response = requests.post(request_url, data=oauth2_POST_params)
-        if response.status_code != 200:
-            error("Token refreshed failed, bad status code returned: {} ({})".format(response.status_code,
-                response.text))
-        
-        response_object = response.json()
+        response_object = self._post_token(oauth2_POST_params, "Token refresh failed")
         if "access_token" in response_object:
-            self._access_token = response_object["access_token"]
+            self._set_access_token(response_object["access_token"])
         else:
-            error("No access token returned in token refresh response")
+            raise errors.AuthError("No access token returned in token refresh response")
         if "refresh_token" in response_object:
             self._refresh_token = response_object["refresh_token"]
         else:
-            error("No refresh token returned in token refresh response")
+            raise errors.AuthError("No refresh token returned in token refresh response")
+        self._record_tokens(response_object.get("expires_in"))
         print("Token refreshed, new access token and refresh token recorded.")
     
 
-    def api_get(self, path, params_data):
-        ''' Uses the access token to send a GET API call to the Monzo API. '''
+    def _post_token(self, oauth2_POST_params, failure_message):
+        ''' Sends a request to the token endpoint and returns the decoded response. '''
+
+        try:
+            response = self._session.post(api_url("oauth2/token?"), data=oauth2_POST_params,
+                timeout=getattr(config, "MONZO_HTTP_TIMEOUT", 10))
+        except requests.RequestException as e:
+            raise errors.TransientError("{}: {}".format(failure_message, e)) from e
+
+        if response.status_code != 200:
+            failure = errors.from_response(failure_message, response.status_code, response.text,
+                parse_retry_after(response.headers.get("Retry-After")))
+            if isinstance(failure, errors.ValidationError):
+                # A rejected code or refresh token means the flow has to be started again.
+                failure = errors.AuthError(str(failure), failure.status_code, failure.response)
+            raise failure
+        return response.json()
 
+
+    def _send(self, method, url, **kwargs):
+        ''' Sends an API call with the current access token, which is refreshed first if it is
+            about to expire. If the API rejects the token anyway, it is refreshed and the call
+            retried once.
+        '''
+        if self._is_confidential_client:
+            self._tokens.refresh_if_expiring()
+        generation = self._tokens.generation
+        headers = kwargs.pop("headers", {})
+        response = self._limited_request(method, url, headers=dict(self._session_headers, **headers),
+            **kwargs)
+        if response.status_code == 401 and self._is_confidential_client:
+            response.close()
+            self._tokens.refresh(generation)
+            response = self._limited_request(method, url, headers=dict(self._session_headers, **headers),
+                **kwargs)
+        return response
+
+
+    def _limited_request(self, method, url, **kwargs):
+        ''' Sends a request once the rate limiter lets it through, and feeds back whether the
+            API showed signs of overload, including on attempts retried by the session.
+        '''
+        path = urllib.urlparse(url).path.strip("/")
+        params = kwargs.get("params") or kwargs.get("data")
+        account = params.get("account_id") if isinstance(params, dict) else None
+        self._rate_limiter.acquire(path.split("/")[0], account or self._user_id)
+
+        started = time.monotonic()
+        response = None
+        overloaded = False
+        retry_after = None
+        error_message = None
+        if self._observers:
+            tracing.take_connection_timings()
+        try:
+            # Without a timeout, a stalled connection would hang the call forever.
+            response = self._session.request(method, url,
+                timeout=kwargs.pop("timeout", getattr(config, "MONZO_HTTP_TIMEOUT", 10)), **kwargs)
+            retries = getattr(response.raw, "retries", None)
+            overloaded = response.status_code == 429 or response.status_code >= 500 or any(
+                attempt.status is not None and (attempt.status == 429 or attempt.status >= 500)
+                for attempt in (retries.history if retries is not None else ()))
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        except requests.RequestException as e:
+            overloaded = True
+            error_message = str(e)
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self._rate_limiter.release(elapsed, overloaded, retry_after)
+            if self._observers:
+                self._notify_observers(method, path, response, elapsed, error_message,
+                    kwargs.get("stream", False))
+        return response
+
+
+    def _notify_observers(self, method, path, response, elapsed, error_message, streamed=False):
+        connect, tls = tracing.take_connection_timings()
+        retries = getattr(response.raw, "retries", None) if response is not None else None
+        body = response.request.body if response is not None else None
+        event = tracing.RequestEvent(
+            method=method,
+            endpoint=path.split("/")[0],
+            status=response.status_code if response is not None else None,
+            started_at=time.time() - elapsed,
+            connect=connect,
+            tls=tls,
+            ttfb=response.elapsed.total_seconds() if response is not None else elapsed,
+            total=elapsed,
+            bytes_out=len(body) if body else 0,
+            bytes_in=tracing.received_bytes(response, streamed) if response is not None else 0,
+            retries=len(retries.history) if retries is not None else 0,
+            error=error_message,
+        )
+        for observer in self._observers:
+            observer(event)
+
+
+    def _request(self, method, path, use_cache=True, **kwargs):
         if path.startswith("/"):
             path = path[1:]
-        response = requests.get("https://{}/{}".format(config.MONZO_API_HOSTNAME, path), 
-            headers={"Authorization": "Bearer {}".format(self._access_token)},
-            params=params_data)
+        url = api_url(path)
+
+        cache_key = None
+        cached = None
+        if method == "GET" and use_cache and self._cache is not None and \
+            self._cache.cacheable(path, kwargs.get("params")):
+            cache_key = self._cache.key(self._user_id, path, kwargs.get("params"))
+            cached, fresh = self._cache.lookup(cache_key)
+            if fresh:
+                return json.loads(cached.body)
+            if cached is not None and cached.etag:
+                kwargs["headers"] = {"If-None-Match": cached.etag}
+
+        try:
+            response = self._send(method, url, **kwargs)
+        except requests.RequestException as e:
+            raise errors.TransientError("{} {} failed: {}".format(method, path, e)) from e
+        if cache_key is not None and cached is not None and response.status_code == 304:
+            self._cache.revalidated(cache_key, cached)
+            return json.loads(cached.body)
 
+        # Decoded to text once, and parsed from that, rather than keeping a second copy of
+        # the body when it is not JSON.
+        text = response.text
         try:
-            resp = response.json()
+            resp = json.loads(text)
         except json.decoder.JSONDecodeError:
-            resp = response.text
+            resp = text
 
         if response.status_code != 200:
-            return False, resp
+            raise errors.from_response("{} {} failed".format(method, path), response.status_code, resp,
+                parse_retry_after(response.headers.get("Retry-After")))
 
-        return True, resp
+        if cache_key is not None:
+            self._cache.store(cache_key, text, response.headers.get("ETag"))
+        elif method != "GET":
+            self._invalidate_written(path, kwargs.get("data"))
 
-    
-    def api_post(self, path, params_data):
-        ''' Uses the access token to send a POST API call to the Monzo API. '''
+        return resp
 
-        if path.startswith("/"):
-            path = path[1:]
-        response = requests.post("https://{}/{}".format(config.MONZO_API_HOSTNAME, path), 
-            headers={"Authorization": "Bearer {}".format(self._access_token)},
-            data=params_data)
 
+    def _invalidate_written(self, path, data):
+        ''' Drops the cached responses made stale by a successful write of data to path. '''
+
+        if self._cache is None or not path.startswith("transaction-receipts"):
+            return
+        # A receipt we have just written must not be served stale from the cache. Receipts
+        # are read back by external_id, so only that one response is dropped.
         try:
-            resp = response.json()
-        except json.decoder.JSONDecodeError:
-            resp = response.text
+            external_id = json.loads(data)["external_id"]
+        except (TypeError, ValueError, KeyError):
+            self._cache.invalidate(self._user_id, "transaction-receipts")
+            return
+        self._cache.delete(self._cache.key(self._user_id, "transaction-receipts", {"external_id": external_id}))
 
 
-        if response.status_code != 200:
-            return False, resp
-        
-        return True, resp
-    
-    def api_put(self, path, params_data):
-        ''' Uses the access token to send a PUT API call to the Monzo API. '''
+    def api_get(self, path, params_data, use_cache=True):
+        ''' Uses the access token to send a GET API call to the Monzo API. Returns the decoded
+            response, or raises an errors.APIError subclass if the call failed. Set use_cache
+            to False to read the API's current state rather than a cached response.
+        '''
+
+        return self._request("GET", path, use_cache, params=params_data)
 
+    
+    def api_get_stream(self, path, params_data, key, fields=None, chunk_size=64 * 1024):
+        ''' Sends a GET API call like api_get(), and yields the elements of the array under
+            `key` in the response as they arrive, keeping only `fields` of each if given.
+            The body is never held in memory whole, and streamed responses are not cached.
+        '''
         if path.startswith("/"):
             path = path[1:]
-        response = requests.put("https://{}/{}".format(config.MONZO_API_HOSTNAME, path), 
-            headers={"Authorization": "Bearer {}".format(self._access_token)},
-            data=params_data)
-
+        url = api_url(path)
         try:
-            resp = response.json()
-        except json.decoder.JSONDecodeError:
-            resp = response.text
-        
-        if response.status_code != 200:
-            return False, resp
+            response = self._send("GET", url, params=params_data, stream=True)
+        except requests.RequestException as e:
+            raise errors.TransientError("GET {} failed: {}".format(path, e)) from e
+
+        with response:
+            if response.status_code != 200:
+                try:
+                    resp = response.json()
+                except json.decoder.JSONDecodeError:
+                    resp = response.text
+                raise errors.from_response("GET {} failed".format(path), response.status_code, resp,
+                    parse_retry_after(response.headers.get("Retry-After")))
+            try:
+                yield from jsonstream.iter_array(response.iter_content(chunk_size), key, fields)
+            except requests.RequestException as e:
+                raise errors.TransientError("GET {} failed: {}".format(path, e)) from e
+            except (ValueError, KeyError) as e:
+                raise errors.APIError("GET {} returned an unexpected response: {!r}".format(path, e),
+                    response.status_code)
+
+
+    def api_post(self, path, params_data):
+        ''' Uses the access token to send a POST API call to the Monzo API. '''
 
-        return True, resp
+        return self._request("POST", path, data=params_data)
+    
+    def api_put(self, path, params_data):
+        ''' Uses the access token to send a PUT API call to the Monzo API. '''
+
+        return self._request("PUT", path, data=params_data)
     
 
     def test_api_call(self):
         ''' Sends a GET ping API call to the Monzo API to test the auth state. '''
 
-        success, response = self.api_get("ping/whoami", {})
-        if not success:
-            error("API test call failed, bad status code returned: {} ({})".format(response.status_code,
-                response))
-        
+        response = self.api_get("ping/whoami", {})
         print("API test call successful.")
         return response
 
 
+def api_url(path):
+    ''' Returns the URL of an API path on the host configured in config.py. '''
+
+    return "{}://{}/{}".format(getattr(config, "MONZO_API_SCHEME", "https"), config.MONZO_API_HOSTNAME, path)
+
+
+def parse_retry_after(value):
+    ''' Parses a Retry-After header, given either in seconds or as an HTTP date. '''
+
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
 if __name__ == "__main__":
-    client = OAuth2Client()
-    client.start_auth()
-    client.test_api_call()
-    client.refresh_access_token()
+    from utils import error
+
+    try:
+        client = OAuth2Client()
+        client.start_auth()
+        client.test_api_call()
+        client.refresh_access_token()
+    except errors.MonzoError as e:
+        error(e)
@@ -0,0 +1,199 @@
+import threading
+import time
+
+# Client-side rate limiting for calls to the Monzo API.
+
+class TokenBucket:
+    ''' Allows `rate` requests per second on average, with bursts of up to `burst`. '''
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def _refill(self):
+        # Called with the lock held.
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+    def try_acquire(self):
+        ''' Takes a token if one is available and returns 0, otherwise returns the number of
+            seconds until one will be.
+        '''
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self._rate
+
+
+    def wait_time(self):
+        ''' Returns the number of seconds until a token will be available, without taking it. '''
+
+        with self._lock:
+            self._refill()
+            return 0 if self._tokens >= 1 else (1 - self._tokens) / self._rate
+
+
+    def full(self):
+        ''' Whether the bucket has refilled completely, and so holds no state worth keeping. '''
+
+        with self._lock:
+            self._refill()
+            return self._tokens >= self._burst
+
+
+    def acquire(self):
+        ''' Blocks until a token is available and takes it. '''
+
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+
+class AdaptiveConcurrencyLimit:
+    ''' Limits the number of requests in flight, adapting the limit AIMD-style: it grows by
+        about one for every `limit` healthy responses, and is halved on a 429 or 5xx, or
+        when the API asks us to back off with Retry-After, in which case no new requests
+        are let through until that time has passed.
+    '''
+
+    def __init__(self, initial, minimum, maximum, latency_target):
+        self._limit = float(initial)
+        self._minimum = minimum
+        self._maximum = maximum
+        self._latency_target = latency_target
+        self._in_flight = 0
+        self._paused_until = 0
+        self._condition = threading.Condition()
+
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self._in_flight >= int(self._limit):
+                    self._condition.wait()
+                else:
+                    break
+            self._in_flight += 1
+
+
+    def release(self, latency, overloaded=False, retry_after=None):
+        ''' Records the outcome of a request let through by acquire(). '''
+
+        with self._condition:
+            self._in_flight -= 1
+            if overloaded or retry_after:
+                self._limit = max(self._minimum, self._limit / 2)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            elif latency <= self._latency_target:
+                self._limit = min(self._maximum, self._limit + 1 / self._limit)
+            self._condition.notify_all()
+
+
+class RequestLimiter:
+    ''' Client-side limits applied to every API call of an oauth2.OAuth2Client: a token
+        bucket per endpoint, a token bucket per account, and an adaptive limit on
+        concurrent requests. One limiter can be shared by clients using the same session,
+        and tenant() gives each of them a limit of its own on top.
+
+        Buckets are created on first use. Every SWEEP_INTERVAL seconds, buckets which have
+        refilled completely are dropped, as a new bucket would behave the same, so that
+        accounts and tenants no longer in use are not kept forever.
+    '''
+
+    SWEEP_INTERVAL = 60
+
+    def __init__(self, endpoint_rates, default_endpoint_rate, account_rate, concurrency):
+        self._endpoint_rates = endpoint_rates
+        self._default_endpoint_rate = default_endpoint_rate
+        self._account_rate = account_rate
+        self._concurrency = concurrency
+        self._buckets = {}
+        self._swept_at = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def _bucket(self, key, rate):
+        with self._lock:
+            if time.monotonic() - self._swept_at >= self.SWEEP_INTERVAL:
+                self._sweep()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(*rate)
+            return bucket
+
+
+    def _sweep(self):
+        # Called with the lock held.
+        for key in [key for key, bucket in self._buckets.items() if bucket.full()]:
+            del self._buckets[key]
+        self._swept_at = time.monotonic()
+
+
+    def tenant(self, tenant_id, rate):
+        ''' Returns a limiter for one tenant's client, which also holds every request it
+            sends to a (rate, burst) token bucket of the tenant's own.
+        '''
+        return TenantLimiter(self, tenant_id, rate)
+
+
+    def tenant_wait(self, tenant_id, rate):
+        ''' Returns the number of seconds until the tenant may send a request. '''
+
+        return self._bucket(("tenant", tenant_id), rate).wait_time()
+
+
+    def acquire(self, endpoint, account):
+        ''' Blocks until a request to the endpoint on behalf of the account may be sent. '''
+
+        self._bucket(("endpoint", endpoint),
+            self._endpoint_rates.get(endpoint, self._default_endpoint_rate)).acquire()
+        self._bucket(("account", account), self._account_rate).acquire()
+        self._concurrency.acquire()
+
+
+    def release(self, latency, overloaded=False, retry_after=None):
+        self._concurrency.release(latency, overloaded, retry_after)
+
+
+    def stats(self):
+        return {"concurrency_limit": self._concurrency.limit}
+
+
+class TenantLimiter:
+    ''' A RequestLimiter for one tenant's client, see RequestLimiter.tenant(). '''
+
+    def __init__(self, limiter, tenant_id, rate):
+        self._limiter = limiter
+        self._tenant_id = tenant_id
+        self._rate = rate
+
+
+    def acquire(self, endpoint, account):
+        self._limiter._bucket(("tenant", self._tenant_id), self._rate).acquire()
+        self._limiter.acquire(endpoint, account)
+
+
+    def release(self, latency, overloaded=False, retry_after=None):
+        self._limiter.release(latency, overloaded, retry_after)
+
+
+    def stats(self):
+        return self._limiter.stats()
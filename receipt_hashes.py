@@ -0,0 +1,124 @@
+import sqlite3
+import threading
+import time
+
+import errors
+import receipt_types
+
+# Conditional receipt uploads. The content hash of every receipt written is kept per
+# external_id, so that re-runs and reconciliation jobs sending the same receipts again
+# skip those unchanged since they were last written, and only PUT new or changed ones.
+# The hashes can be checked against the receipts actually held by the API on demand.
+
+class ReceiptHashStore:
+    ''' The content hash of the last receipt written for each external_id, in a SQLite
+        file shared by every uploader using it.
+    '''
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS receipt_hashes "
+                "(external_id TEXT PRIMARY KEY, transaction_id TEXT, content_hash TEXT, written_at REAL)")
+
+
+    def get(self, external_id):
+        with self._lock:
+            row = self._connection.execute("SELECT content_hash FROM receipt_hashes WHERE external_id = ?",
+                (external_id,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def set(self, external_id, transaction_id, content_hash):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO receipt_hashes VALUES (?, ?, ?, ?)",
+                (external_id, transaction_id, content_hash, time.time()))
+
+
+    def delete(self, external_id):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM receipt_hashes WHERE external_id = ?", (external_id,))
+
+
+    def external_ids(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT external_id FROM receipt_hashes")]
+
+
+class ConditionalUploader:
+    ''' Uploads receipt_types.Receipts with an oauth2.OAuth2Client unless the same content
+        was last written for their external_id. Counts uploads and skips, and the payload
+        bytes skipped receipts did not send.
+    '''
+
+    def __init__(self, api_client, store):
+        self._api_client = api_client
+        self._store = store
+        self._lock = threading.Lock()
+        self._counts = {"uploaded": 0, "skipped": 0, "bytes_saved": 0}
+
+
+    def unchanged(self, receipt):
+        ''' Returns whether the receipt was last written with the same content, counting it
+            as skipped if so.
+        '''
+        if self._store.get(receipt.external_id) != receipt.content_hash():
+            return False
+        with self._lock:
+            self._counts["skipped"] += 1
+            self._counts["bytes_saved"] += len(receipt.marshal_bytes())
+        return True
+
+
+    def written(self, receipt):
+        ''' Records that the receipt was uploaded. '''
+
+        self._store.set(receipt.external_id, receipt.transaction_id, receipt.content_hash())
+        with self._lock:
+            self._counts["uploaded"] += 1
+
+
+    def put(self, receipt):
+        ''' Uploads the receipt if it changed, returning the API response, or None if it
+            was skipped. Raises errors.APIError if the upload failed.
+        '''
+        if self.unchanged(receipt):
+            return None
+        response = self._api_client.api_put("transaction-receipts/", receipt.marshal())
+        self.written(receipt)
+        return response
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+        total = stats["uploaded"] + stats["skipped"]
+        stats["skip_rate"] = stats["skipped"] / total if total else 0
+        return stats
+
+
+    def reconcile(self, external_ids=None):
+        ''' Reads back the receipts with the external IDs given, or all those with a stored
+            hash, and replaces stored hashes which do not match what the API holds, so that
+            the next upload of those receipts is not skipped. Returns counts of the receipts
+            found matching, changed and missing.
+        '''
+        counts = {"matching": 0, "changed": 0, "missing": 0}
+        for external_id in external_ids if external_ids is not None else self._store.external_ids():
+            try:
+                response = self._api_client.api_get("transaction-receipts", {"external_id": external_id},
+                    use_cache=False)
+            except errors.NotFoundError:
+                self._store.delete(external_id)
+                counts["missing"] += 1
+                continue
+
+            receipt = receipt_types.unmarshal(response)
+            content_hash = receipt.content_hash()
+            if self._store.get(external_id) == content_hash:
+                counts["matching"] += 1
+            else:
+                self._store.set(external_id, receipt.transaction_id, content_hash)
+                counts["changed"] += 1
+        return counts
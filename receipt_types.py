@@ -1,70 +1,229 @@
+import hashlib
 import json
+from json.encoder import encode_basestring_ascii
 
-# Implements the payload protocol for Transaction Receipts API. 
+# Implements the payload protocol for Transaction Receipts API.
 # See example_add_receipt_data() in main.py for data types example usage.
+#
+# Each type keeps its fields in __slots__ rather than a per-instance dict, and is
+# serialised by a function generated once per type when this module is loaded, which
+# fills a precompiled string template. Marshalling a receipt therefore never builds the
+# intermediate dicts json.dumps would need. The output is identical to
+# json.dumps(receipt.data).
+#
+# The attributes are the receipt: .data is a fresh dict built from them on each access,
+# so a receipt is changed by assigning to its attributes, and changes made to a .data
+# dict are not seen by marshal(). Receipts compare by value, and are not hashable.
+
+def _encode(value):
+    value_type = type(value)
+    if value_type is int:
+        return int.__repr__(value)
+    if value_type is float and value == value and value not in (_INFINITY, -_INFINITY):
+        return float.__repr__(value)
+    return json.dumps(value)
+
+_INFINITY = float("inf")
+
+_AMOUNT_FIELDS = ("total", "amount", "tax")
+_QUANTITY_FIELDS = ("quantity",)
+
+
+def _canonical(value, field=None):
+    ''' Normalises a payload so that receipts with the same content compare equal: the ID
+        assigned by the API is left out, amounts are integers, and whole quantities
+        integers, so that 2, 2.0 and "2" are all the same quantity.
+    '''
+    if isinstance(value, dict):
+        return {key: _canonical(child, key) for key, child in value.items() if key != "id"}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(child) for child in value]
+    if field in _AMOUNT_FIELDS + _QUANTITY_FIELDS and not isinstance(value, bool):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return value
+        if number.is_integer():
+            return int(number)
+        return number if field in _QUANTITY_FIELDS else value
+    return value
+
+
+def _compile_writer(cls):
+    ''' Generates cls._dump(self), returning the JSON object for an instance as a string
+        from a template compiled for the type. Fields listed in cls._NESTED hold sequences
+        of other receipt types. Strings and integers, the common cases, are encoded
+        without a call to _encode().
+    '''
+    template = []
+    lines = ["def _dump(self):"]
+    for i, field in enumerate(cls.__slots__):
+        template.append('"{}": %s'.format(field))
+        if field in cls._NESTED:
+            lines.append("    v{} = '[' + ', '.join([child._dump() for child in self.{}]) + ']'".format(i, field))
+        else:
+            lines.append("    v{} = self.{}".format(i, field))
+            lines.append("    t = v{}.__class__".format(i))
+            lines.append("    v{0} = _escape(v{0}) if t is str else _int_repr(v{0}) if t is int else _encode(v{0})".format(i))
+    lines.append("    return {!r} % ({},)".format("{" + ", ".join(template) + "}",
+        ", ".join("v{}".format(i) for i in range(len(cls.__slots__)))))
+
+    namespace = {"_encode": _encode, "_escape": encode_basestring_ascii, "_int_repr": int.__repr__}
+    exec("\n".join(lines), namespace)
+    cls._dump = namespace["_dump"]
+    return cls
+
+
+class _Record:
+    __slots__ = ()
+    _NESTED = ()
+
+    # Receipts are mutable and compare by value, so they are not hashable. __eq__ alone
+    # implies this, said here for the generated types.
+    __hash__ = None
+
+    @property
+    def data(self):
+        ''' The payload as a new dict, built from the attributes on each access. Changes to
+            it are not written back to the receipt.
+        '''
+
+        return {field: [child.data for child in getattr(self, field)] if field in self._NESTED
+            else getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, field) == getattr(other, field)
+            for field in self.__slots__)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(repr(getattr(self, field))
+            for field in self.__slots__))
+
+
+@_compile_writer
+class SubItem(_Record):
+    __slots__ = ("description", "quantity", "unit", "amount", "currency", "tax")
 
-class SubItem:
     def __init__(self, description, quantity, unit, amount, currency, tax):
-        self.data = {
-            "description": description,
-            "quantity": quantity,
-            "unit": unit,
-            "amount": amount,
-            "currency": currency,
-            "tax": tax,
-        }
-
-class Item:
+        self.description = description
+        self.quantity = quantity
+        self.unit = unit
+        self.amount = amount
+        self.currency = currency
+        self.tax = tax
+
+    @classmethod
+    def from_data(cls, data, currency=""):
+        return cls(data["description"], data["quantity"], data.get("unit", ""), data["amount"],
+            data.get("currency", currency), data.get("tax", 0))
+
+@_compile_writer
+class Item(_Record):
+    __slots__ = ("description", "quantity", "unit", "amount", "currency", "tax", "sub_items")
+    _NESTED = ("sub_items",)
+
     def __init__(self, description, quantity, unit, amount, currency, tax, sub_items):
-        self.data = {
-            "description": description,
-            "quantity": quantity,
-            "unit": unit,
-            "amount": amount,
-            "currency": currency,
-            "tax": tax,
-            "sub_items": [sub.data for sub in sub_items],
-        }
-
-class Payment:
+        self.description = description
+        self.quantity = quantity
+        self.unit = unit
+        self.amount = amount
+        self.currency = currency
+        self.tax = tax
+        self.sub_items = tuple(sub_items)
+
+    @classmethod
+    def from_data(cls, data, currency=""):
+        currency = data.get("currency", currency)
+        return cls(data["description"], data["quantity"], data.get("unit", ""), data["amount"],
+            currency, data.get("tax", 0),
+            [SubItem.from_data(sub, currency) for sub in data.get("sub_items") or []])
+
+@_compile_writer
+class Payment(_Record):
+    __slots__ = ("type", "bin", "last_four", "auth_code", "aid", "mid", "tid", "gift_card_type",
+        "amount", "currency")
+
     def __init__(self, type, bin, last_four, auth_code, aid, mid, tid, gift_card_type, amount, currency):
-        self.data = {
-            "type": type,
-            "bin": bin,
-            "last_four": last_four,
-            "auth_code": auth_code,
-            "aid": aid,
-            "mid": mid,
-            "tid": tid,
-            "gift_card_type": gift_card_type,
-            "amount": amount,
-            "currency": currency,
-        }
-
-class Tax:
+        self.type = type
+        self.bin = bin
+        self.last_four = last_four
+        self.auth_code = auth_code
+        self.aid = aid
+        self.mid = mid
+        self.tid = tid
+        self.gift_card_type = gift_card_type
+        self.amount = amount
+        self.currency = currency
+
+    @classmethod
+    def from_data(cls, data, currency=""):
+        return cls(data["type"], data.get("bin", ""), data.get("last_four", ""),
+            data.get("auth_code", ""), data.get("aid", ""), data.get("mid", ""), data.get("tid", ""),
+            data.get("gift_card_type", ""), data["amount"], data.get("currency", currency))
+
+@_compile_writer
+class Tax(_Record):
+    __slots__ = ("description", "amount", "currency", "tax_number")
+
     def __init__(self, description, amount, currency, tax_number):
-        self.data = {
-            "description": description,
-            "amount": amount,
-            "currency": currency,
-            "tax_number": tax_number,
-        }
-
-class Receipt:
+        self.description = description
+        self.amount = amount
+        self.currency = currency
+        self.tax_number = tax_number
+
+    @classmethod
+    def from_data(cls, data, currency=""):
+        return cls(data["description"], data["amount"], data.get("currency", currency),
+            data.get("tax_number", ""))
+
+@_compile_writer
+class Receipt(_Record):
+    __slots__ = ("id", "external_id", "transaction_id", "total", "currency", "payments", "taxes", "items")
+    _NESTED = ("payments", "taxes", "items")
+
     def __init__(self, id, external_id, transaction_id, total, currency, payments, taxes, items):
-        self.data = {
-            "id": id, 
-            "external_id": external_id,
-            "transaction_id": transaction_id,
-            "total": total,
-            "currency": currency,
-            "payments": [payment.data for payment in payments],
-            "taxes": [tax.data for tax in taxes],
-            "items": [item.data for item in items],
-        }
-    
+        self.id = id
+        self.external_id = external_id
+        self.transaction_id = transaction_id
+        self.total = total
+        self.currency = currency
+        self.payments = tuple(payments)
+        self.taxes = tuple(taxes)
+        self.items = tuple(items)
+
+    @classmethod
+    def from_data(cls, data):
+        ''' Builds a receipt from its payload, as a dict. Optional fields may be left out,
+            and nested amounts default to the currency of the receipt.
+        '''
+        currency = data["currency"]
+        return cls(data.get("id", ""), data["external_id"], data["transaction_id"], data["total"],
+            currency,
+            [Payment.from_data(payment, currency) for payment in data.get("payments") or []],
+            [Tax.from_data(tax, currency) for tax in data.get("taxes") or []],
+            [Item.from_data(item, currency) for item in data.get("items") or []])
+
     def marshal(self):
-        return json.dumps(self.data)
+        return self._dump()
+
+    def marshal_bytes(self):
+        return self.marshal().encode("ascii")
+
+    def content_hash(self):
+        ''' A SHA-256 hex digest of the receipt's content, which does not depend on key
+            order, on the ID assigned by the API, or on how amounts and quantities are
+            written.
+        '''
+        canonical = json.dumps(_canonical(self.data), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("ascii")).hexdigest()
 
 
-    
+def unmarshal(payload):
+    ''' Parses a receipt from a JSON string, bytes or an already decoded dict. The
+        {"receipt": {...}} envelope of transaction-receipts GET responses is accepted too.
+    '''
+    if isinstance(payload, (str, bytes)):
+        payload = json.loads(payload)
+    if "receipt" in payload:
+        payload = payload["receipt"]
+    return Receipt.from_data(payload)
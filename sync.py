@@ -0,0 +1,210 @@
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from utils import merchant_id
+
+# A local copy of the transaction history of each account, kept in SQLite and brought up
+# to date incrementally. The newest transaction stored is the high-water mark: a sync only
+# asks the API for transactions created after it, less a reconciliation window, so that
+# pending transactions which settled or changed since the last run are picked up again.
+# Transactions can then be queried by date, merchant, amount and user locally.
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def _parse_timestamp(timestamp):
+    # Timestamps from the API have fractional seconds of varying length, which are ignored.
+    return datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+
+
+class TransactionStore:
+    ''' Transactions and the receipts attached to them, stored in a SQLite file shared by
+        every client using it. Transactions are kept as returned by the API, with the
+        fields they are queried by in indexed columns.
+    '''
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript('''
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id TEXT PRIMARY KEY,
+                    account_id TEXT NOT NULL,
+                    created TEXT NOT NULL,
+                    settled TEXT,
+                    amount INTEGER NOT NULL,
+                    currency TEXT,
+                    merchant TEXT,
+                    user_id TEXT,
+                    body TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS transactions_created ON transactions (account_id, created);
+                CREATE INDEX IF NOT EXISTS transactions_merchant ON transactions (account_id, merchant, created);
+                CREATE INDEX IF NOT EXISTS transactions_amount ON transactions (account_id, amount);
+                CREATE INDEX IF NOT EXISTS transactions_user ON transactions (account_id, user_id, created);
+
+                CREATE TABLE IF NOT EXISTS receipts (
+                    external_id TEXT PRIMARY KEY,
+                    transaction_id TEXT NOT NULL,
+                    uploaded_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS receipts_transaction ON receipts (transaction_id);
+
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    account_id TEXT PRIMARY KEY,
+                    high_water_created TEXT NOT NULL,
+                    high_water_id TEXT NOT NULL,
+                    synced_at REAL NOT NULL
+                );
+            ''')
+
+
+    def upsert(self, transactions):
+        ''' Stores transactions, replacing stored copies which differ. Returns the number of
+            (inserted, updated) transactions.
+        '''
+        rows = [(transaction["id"], transaction["account_id"], transaction["created"],
+            transaction.get("settled") or None, transaction["amount"], transaction.get("currency"),
+            merchant_id(transaction), transaction.get("user_id") or None,
+            json.dumps(transaction, sort_keys=True)) for transaction in transactions]
+        if len(rows) == 0:
+            return 0, 0
+
+        with self._lock, self._connection:
+            placeholders = ",".join("?" * len(rows))
+            known = set(row[0] for row in self._connection.execute(
+                "SELECT id FROM transactions WHERE id IN ({})".format(placeholders), [row[0] for row in rows]))
+            changes = self._connection.total_changes
+            self._connection.executemany('''
+                INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET settled = excluded.settled, amount = excluded.amount,
+                    currency = excluded.currency, merchant = excluded.merchant, user_id = excluded.user_id,
+                    body = excluded.body
+                WHERE body != excluded.body
+            ''', rows)
+            inserted = sum(1 for row in rows if row[0] not in known)
+            return inserted, self._connection.total_changes - changes - inserted
+
+
+    def high_water_mark(self, account_id):
+        ''' Returns (created, transaction ID) of the newest transaction synced for the
+            account, or None if it was never synced.
+        '''
+        with self._lock:
+            return self._connection.execute(
+                "SELECT high_water_created, high_water_id FROM sync_state WHERE account_id = ?",
+                (account_id,)).fetchone()
+
+
+    def set_high_water_mark(self, account_id, created, transaction_id):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+                (account_id, created, transaction_id, time.time()))
+
+
+    def record_receipt(self, transaction_id, external_id):
+        ''' Records that a receipt was attached to a transaction. '''
+
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO receipts VALUES (?, ?, ?)",
+                (external_id, transaction_id, time.time()))
+
+
+    def receipts(self, transaction_id):
+        ''' Returns the external IDs of the receipts attached to a transaction. '''
+
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                "SELECT external_id FROM receipts WHERE transaction_id = ? ORDER BY uploaded_at",
+                (transaction_id,))]
+
+
+    def query(self, account_id, since=None, before=None, merchant=None, min_amount=None, max_amount=None,
+        user_id=None, without_receipt=False, newest_first=False, limit=None):
+        ''' Returns the stored transactions of an account matching all the conditions given,
+            oldest first unless newest_first is set. since and before are RFC 3339 timestamps,
+            and amounts are in minor units, negative for money going out.
+        '''
+        conditions = ["account_id = ?"]
+        params = [account_id]
+        for condition, value in (("created >= ?", since), ("created < ?", before), ("merchant = ?", merchant),
+            ("amount >= ?", min_amount), ("amount <= ?", max_amount), ("user_id = ?", user_id)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if without_receipt:
+            conditions.append("NOT EXISTS (SELECT 1 FROM receipts WHERE receipts.transaction_id = transactions.id)")
+
+        statement = "SELECT body FROM transactions WHERE {} ORDER BY created {}".format(
+            " AND ".join(conditions), "DESC" if newest_first else "ASC")
+        if limit is not None:
+            statement += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._connection.execute(statement, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+    def without_receipt(self, account_id, user_id, **kwargs):
+        ''' Returns the transactions initiated by the user which have no receipt recorded. '''
+
+        return self.query(account_id, user_id=user_id, without_receipt=True, **kwargs)
+
+
+    def close(self):
+        self._connection.close()
+
+
+class SyncEngine:
+    ''' Brings the store up to date with the account of a main.ReceiptsClient. Each sync
+        re-fetches the transactions created in the reconciliation window before the
+        high-water mark, and everything after it.
+    '''
+
+    def __init__(self, receipts_client, store, reconciliation_window, page_size=100):
+        self._receipts_client = receipts_client
+        self._store = store
+        self._reconciliation_window = reconciliation_window
+        self._page_size = page_size
+
+
+    def sync(self):
+        ''' Runs a sync and returns counts of the transactions fetched, inserted and updated. '''
+
+        account_id = self._receipts_client._account_id
+        mark = self._store.high_water_mark(account_id)
+        since = None
+        if mark is not None:
+            since = (_parse_timestamp(mark[0]) - timedelta(seconds=self._reconciliation_window)) \
+                .strftime(TIMESTAMP_FORMAT)
+
+        counts = {"fetched": 0, "inserted": 0, "updated": 0}
+        batch = []
+        for transaction in self._receipts_client.iter_transactions(since=since, page_size=self._page_size,
+            use_cache=False):
+            batch.append(transaction)
+            if len(batch) >= self._page_size:
+                self._store_batch(account_id, batch, counts)
+                batch = []
+        self._store_batch(account_id, batch, counts)
+        return counts
+
+
+    def _store_batch(self, account_id, batch, counts):
+        if len(batch) == 0:
+            return
+        inserted, updated = self._store.upsert(batch)
+        counts["fetched"] += len(batch)
+        counts["inserted"] += inserted
+        counts["updated"] += updated
+
+        # Transactions are listed oldest first, so the mark only moves forward once the
+        # batch is stored; an interrupted sync resumes from the last batch it stored.
+        newest = batch[-1]
+        mark = self._store.high_water_mark(account_id)
+        if mark is None or newest["created"] >= mark[0]:
+            self._store.set_high_water_mark(account_id, newest["created"], newest["id"])
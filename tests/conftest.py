@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+import mock_server
+import run
+
+# Tests run against benchmarks/mock_server.py, with config pointed at it as the benchmarks
+# do, so that they need neither credentials nor network access.
+
+run.configure("127.0.0.1")
+
+
+@pytest.fixture
+def api():
+    api = mock_server.MockMonzoAPI(transactions=50).start()
+    run.configure(api.hostname)
+    yield api
+    api.stop()
+
+
+@pytest.fixture
+def receipts_client(api):
+    ''' A main.ReceiptsClient authorised against the mock API. '''
+
+    client = run.authorised_client()
+    yield client
+    client._api_client._tokens.stop()
@@ -0,0 +1,77 @@
+import asyncio
+
+import async_client
+import cache
+import main
+
+
+def run(receipts_client, work, **kwargs):
+    # Runs work(AsyncReceiptsClient) with an async client sharing the tokens and limits of
+    # the sync client.
+    async def session():
+        api_client = async_client.AsyncOAuth2Client.from_client(receipts_client._api_client, **kwargs)
+        async with api_client:
+            return await work(async_client.AsyncReceiptsClient(api_client, receipts_client._account_id))
+    return asyncio.run(session())
+
+
+def test_list_transactions(api, receipts_client):
+    async def work(client):
+        return await client.list_transactions(page_size=20)
+    assert [transaction["id"] for transaction in run(receipts_client, work)] == \
+        [transaction["id"] for transaction in api.transactions]
+
+
+def test_put_receipts_concurrently(api, receipts_client):
+    receipts = [main.build_example_receipt(transaction, "receipt_{}".format(i))
+        for i, transaction in enumerate(api.transactions[:20])]
+
+    async def work(client):
+        return await client.put_receipts(receipts)
+    results = run(receipts_client, work, concurrency=4)
+    assert not [result for result in results if isinstance(result, Exception)]
+    assert sorted(api.receipts) == sorted(receipt.external_id for receipt in receipts)
+
+
+def test_connection_pool_follows_concurrency(receipts_client):
+    async def work(client):
+        return client._api_client._session.connector.limit
+    assert run(receipts_client, work, concurrency=5) == 5
+
+
+def test_rejected_token_is_refreshed_and_retried(api, receipts_client):
+    receipts_client._api_client._set_access_token("access_revoked")
+    api.revoked_tokens.add("access_revoked")
+
+    async def work(client):
+        return await client.list_webhooks()
+    assert run(receipts_client, work) == {"webhooks": []}
+    assert receipts_client._api_client._access_token == "access_mock"
+
+
+def test_requests_wait_for_rate_limiter(api, receipts_client):
+    limiter = receipts_client._api_client._rate_limiter
+    acquired = []
+    acquire = limiter.acquire
+    limiter.acquire = lambda endpoint, account: (acquired.append((endpoint, account)), acquire(endpoint, account))
+
+    async def work(client):
+        await client.list_webhooks()
+    run(receipts_client, work)
+    assert acquired == [("webhooks", "acc_mock")]
+
+
+def test_put_invalidates_sync_response_cache(api, receipts_client):
+    api_client = receipts_client._api_client
+    api_client._cache = cache.ResponseCache(100, 300, ("transaction-receipts",))
+    transaction = api.transactions[0]
+    api_client.api_put("transaction-receipts/", main.build_example_receipt(transaction, "receipt_0").marshal())
+    assert api_client.api_get("transaction-receipts", {"external_id": "receipt_0"})["receipt"]["total"] \
+        == abs(transaction["amount"])
+
+    changed = main.build_example_receipt(dict(transaction, amount=-999), "receipt_0")
+
+    async def work(client):
+        await client.put_receipt(changed)
+    run(receipts_client, work)
+    assert api_client.api_get("transaction-receipts", {"external_id": "receipt_0"})["receipt"]["total"] == 999
@@ -0,0 +1,61 @@
+import json
+
+import bulk_upload
+import config
+import run
+
+
+def receipt_record(transaction, external_id, **fields):
+    record = {"external_id": external_id, "transaction_id": transaction["id"],
+        "total": -transaction["amount"], "currency": "GBP",
+        "items": [{"description": "Item", "quantity": 1, "amount": -transaction["amount"]}],
+        "payments": [{"type": "card", "last_four": "1234", "amount": -transaction["amount"]}]}
+    record.update(fields)
+    return record
+
+
+def upload(client, tmp_path, records):
+    dead_letter_path = tmp_path / "dead_letters.jsonl"
+    uploader = bulk_upload.BulkUploader(client._api_client, str(dead_letter_path), workers=2)
+    summary = uploader.run(enumerate(records, start=1))
+    dead_letters = [json.loads(line) for line in dead_letter_path.read_text().splitlines()]
+    return summary, dead_letters
+
+
+def test_uploads_and_dead_letters_invalid_records(api, receipts_client, tmp_path):
+    records = [receipt_record(transaction, "receipt_{}".format(i))
+        for i, transaction in enumerate(api.transactions[:5])]
+    records[2]["total"] += 1
+
+    summary, dead_letters = upload(receipts_client, tmp_path, records)
+    assert (summary["uploaded"], summary["invalid"], summary["failed"]) == (4, 1, 0)
+    assert [dead_letter["line"] for dead_letter in dead_letters] == [3]
+    assert sorted(api.receipts) == ["receipt_0", "receipt_1", "receipt_3", "receipt_4"]
+
+
+def test_failed_upload_is_retried_only_by_the_session(api, monkeypatch, tmp_path):
+    monkeypatch.setattr(config, "MONZO_HTTP_BACKOFF_FACTOR", 0, raising=False)
+    client = run.authorised_client()
+    try:
+        api.error_rate = 1.0
+        requests_before = api.request_count
+        summary, dead_letters = upload(client, tmp_path, [receipt_record(api.transactions[0], "receipt_0")])
+    finally:
+        client._api_client._tokens.stop()
+
+    retries = getattr(config, "MONZO_HTTP_MAX_RETRIES", 3)
+    assert api.request_count - requests_before == 1 + retries
+    assert (summary["uploaded"], summary["failed"], summary["retries"]) == (0, 1, retries)
+    assert [dead_letter["line"] for dead_letter in dead_letters] == [1]
+
+
+def test_malformed_currency_is_dead_lettered(api, receipts_client, tmp_path):
+    records = [receipt_record(transaction, "receipt_{}".format(i))
+        for i, transaction in enumerate(api.transactions[:2])]
+    records[1]["currency"] = ["x"]
+
+    summary, dead_letters = upload(receipts_client, tmp_path, records)
+    assert (summary["uploaded"], summary["invalid"]) == (1, 1)
+    assert [dead_letter["line"] for dead_letter in dead_letters] == [2]
+    assert "invalid_currency" in dead_letters[0]["error"]
+    assert sorted(api.receipts) == ["receipt_0"]
@@ -0,0 +1,32 @@
+import time
+
+import cache
+import main
+
+
+def test_write_drops_only_the_written_receipt(api, receipts_client):
+    api_client = receipts_client._api_client
+    api_client._cache = cache.ResponseCache(100, 300, ("transaction-receipts",))
+    for i, transaction in enumerate(api.transactions[:2]):
+        receipt = main.build_example_receipt(transaction, "receipt_{}".format(i))
+        api_client.api_put("transaction-receipts/", receipt.marshal())
+        api_client.api_get("transaction-receipts", {"external_id": "receipt_{}".format(i)})
+
+    changed = main.build_example_receipt(dict(api.transactions[0], amount=-999), "receipt_0")
+    api_client.api_put("transaction-receipts/", changed.marshal())
+    requests_before = api.request_count
+    assert api_client.api_get("transaction-receipts", {"external_id": "receipt_0"})["receipt"]["total"] == 999
+    api_client.api_get("transaction-receipts", {"external_id": "receipt_1"})
+    assert api.request_count - requests_before == 1
+
+
+def test_sqlite_tier_prunes_old_entries(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    tier = cache.SQLiteCache(path, max_age=60)
+    tier.set("old", cache.CacheEntry("{}", None, time.time() - 120))
+    tier.set("new", cache.CacheEntry("{}", None, time.time()))
+    assert tier.get("old") is not None
+
+    reopened = cache.SQLiteCache(path, max_age=60)
+    assert reopened.get("old") is None
+    assert reopened.get("new") is not None
@@ -0,0 +1,49 @@
+import time
+
+from cryptography.fernet import Fernet
+
+import client_pool
+import mock_server
+import ratelimit
+
+
+def authorised_pool(tmp_path, tenant_id, **kwargs):
+    # A pool with one tenant, authorised against the mock API without the browser flow.
+    pool = client_pool.ReceiptsClientPool(str(tmp_path), Fernet.generate_key(), workers=2, **kwargs)
+    api_client = pool._build_api_client(tenant_id)
+    api_client._auth_code = "mock"
+    api_client.exchange_auth_code()
+    api_client._tokens.stop()
+    pool._accounts[tenant_id] = mock_server.ACCOUNT_ID
+    return pool
+
+
+def test_tenant_limit_counts_requests(api, tmp_path):
+    pool = authorised_pool(tmp_path, "tenant", tenant_requests_per_second=20, tenant_burst=3)
+
+    def three_requests(client):
+        for _ in range(3):
+            client._api_client.api_get("ping/whoami", {})
+
+    started = time.monotonic()
+    futures = [pool.submit("tenant", three_requests) for _ in range(3)]
+    for future in futures:
+        future.result()
+    elapsed = time.monotonic() - started
+    pool.close()
+
+    # Three tasks are within the burst, but nine requests are six over it.
+    assert elapsed >= 6 / 20 * 0.9
+
+
+def test_refilled_buckets_are_swept(monkeypatch):
+    monkeypatch.setattr(ratelimit.RequestLimiter, "SWEEP_INTERVAL", 0)
+    limiter = ratelimit.RequestLimiter({}, (1000, 1), (1000, 1),
+        ratelimit.AdaptiveConcurrencyLimit(1, 1, 1, 1.0))
+    limiter.acquire("transactions", "acc_1")
+    limiter.release(0)
+    assert ("account", "acc_1") in limiter._buckets
+
+    time.sleep(0.01)
+    limiter.tenant_wait("tenant", (1000, 1))
+    assert ("account", "acc_1") not in limiter._buckets
@@ -0,0 +1,78 @@
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+import cli
+import daemon
+import errors
+
+
+@pytest.fixture
+def served(receipts_client, tmp_path):
+    # A daemon serving the mock API's client on a socket in tmp_path.
+    socket_path = str(tmp_path / "daemon.sock")
+    served = daemon.Daemon(receipts_client)
+    thread = threading.Thread(target=served.serve, args=(socket_path,), daemon=True)
+    thread.start()
+    while served._server is None:
+        thread.join(0.01)
+    yield served, socket_path
+    served.shutdown()
+    thread.join()
+
+
+def test_list(api, served):
+    _, socket_path = served
+    response = cli.send("list", {"limit": 5}, socket_path)
+    assert response["ok"]
+    assert [transaction["id"] for transaction in response["result"]] == \
+        [transaction["id"] for transaction in api.transactions[-5:]]
+
+
+def test_bad_arguments_are_rejected(served):
+    _, socket_path = served
+    for args in ({"limit": "x"}, {"limit": 5, "verbose": True}):
+        response = cli.send("list", args, socket_path)
+        assert (response["ok"], response["type"]) == (False, "ValidationError")
+
+
+def test_internal_error_gets_a_reply(served, monkeypatch):
+    served_daemon, socket_path = served
+
+    def broken(external_id):
+        raise RuntimeError("broken")
+    monkeypatch.setattr(served_daemon, "_read_receipt", broken)
+    response = cli.send("read-receipt", {"external_id": "receipt_0"}, socket_path)
+    assert (response["ok"], response["type"]) == (False, "RuntimeError")
+    assert cli.send("list", {"limit": 1}, socket_path)["ok"]
+
+
+def test_socket_is_private_and_not_taken_over(receipts_client, served):
+    _, socket_path = served
+    assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+    with pytest.raises(errors.MonzoError):
+        daemon.Daemon(receipts_client).serve(socket_path)
+    assert cli.send("list", {"limit": 1}, socket_path)["ok"]
+
+
+def test_send_without_reply(tmp_path):
+    socket_path = str(tmp_path / "silent.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+
+    def hang_up():
+        connection, _ = listener.accept()
+        connection.recv(1024)
+        connection.close()
+    thread = threading.Thread(target=hang_up)
+    thread.start()
+    try:
+        with pytest.raises(ConnectionError):
+            cli.send("list", {}, socket_path)
+    finally:
+        thread.join()
+        listener.close()
@@ -0,0 +1,18 @@
+import pytest
+
+import errors
+
+
+def test_from_response_maps_status_codes():
+    for status, error_class in ((401, errors.AuthError), (404, errors.NotFoundError),
+        (429, errors.RateLimitedError), (500, errors.TransientError), (400, errors.ValidationError)):
+        error = errors.from_response("GET x failed", status, {}, 5)
+        assert type(error) is error_class
+        assert (error.status_code, error.retry_after) == (status, 5)
+    assert errors.is_retryable(errors.from_response("", 503, {}))
+    assert not errors.is_retryable(errors.from_response("", 400, {}))
+
+
+def test_client_raises_instead_of_exiting(api, receipts_client):
+    with pytest.raises(errors.NotFoundError):
+        receipts_client._api_client.api_get("transaction-receipts", {"external_id": "missing"})
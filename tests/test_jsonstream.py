@@ -0,0 +1,33 @@
+import json
+
+import jsonstream
+import mock_server
+
+
+def split_everywhere(document):
+    # Yields the document as two chunks for every position it could be split at.
+    data = document.encode("utf-8")
+    for position in range(len(data) + 1):
+        yield [data[:position], data[position:]]
+
+
+def test_values_split_across_chunks():
+    elements = [1e-05, -12345, 2.5e+30, "café €", True, None, {"a": [1, {"b": "c"}]}, 0]
+    document = json.dumps({"before": [1, 2], "transactions": elements, "after": "x"})
+    for chunks in split_everywhere(document):
+        assert list(jsonstream.iter_array(chunks, "transactions")) == elements
+    one_byte = [bytes([byte]) for byte in document.encode("utf-8")]
+    assert list(jsonstream.iter_array(one_byte, "transactions")) == elements
+
+
+def test_fields_are_projected():
+    document = json.dumps([{"id": "a", "amount": 1, "notes": "x"}, {"id": "b"}])
+    assert list(jsonstream.iter_array([document.encode("utf-8")], fields=("id", "amount"))) == \
+        [{"id": "a", "amount": 1}, {"id": "b"}]
+
+
+def test_streamed_listing_from_api(api, receipts_client):
+    transactions = list(receipts_client._api_client.api_get_stream("transactions",
+        {"account_id": mock_server.ACCOUNT_ID}, "transactions", fields=("id", "amount"), chunk_size=7))
+    assert transactions == [{"id": transaction["id"], "amount": transaction["amount"]}
+        for transaction in api.transactions]
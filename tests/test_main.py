@@ -0,0 +1,26 @@
+import mock_server
+
+
+def test_iter_transactions_pages_through_history(api, receipts_client):
+    transactions = list(receipts_client.iter_transactions(page_size=7))
+    assert [transaction["id"] for transaction in transactions] == \
+        [transaction["id"] for transaction in api.transactions]
+
+
+def test_find_transaction_stops_on_first_page(api, receipts_client):
+    requests_before = api.request_count
+    transaction = receipts_client.find_transaction(lambda transaction: True, page_size=10)
+    assert transaction["id"] == api.transactions[0]["id"]
+    assert api.request_count - requests_before == 1
+
+
+def test_find_latest_transaction(api, receipts_client):
+    transaction = receipts_client.find_latest_transaction(
+        lambda transaction: transaction["user_id"] == mock_server.USER_ID)
+    # The last transaction of the mock history is not initiated by the user.
+    assert transaction["id"] == api.transactions[-2]["id"]
+
+
+def test_example_receipt_without_loading_transactions(api, receipts_client):
+    receipt_id = receipts_client.example_add_receipt_data()
+    assert api.receipts[receipt_id]["transaction_id"] == api.transactions[-2]["id"]
@@ -0,0 +1,27 @@
+from datetime import datetime, timezone
+
+import main
+import matching
+import mock_server
+
+
+def test_to_seconds_converts_offsets_to_utc():
+    assert matching.to_seconds("2018-01-01T00:00:00Z") == 1514764800
+    assert matching.to_seconds("2018-01-01T01:00:00+01:00") == 1514764800
+    assert matching.to_seconds("2018-01-01T00:00:00.5Z") == 1514764800.5
+    assert matching.to_seconds("2018-01-01T00:00:00") == 1514764800
+
+
+def test_matches_receipt_timestamped_in_local_time():
+    transactions = mock_server.generate_transactions(50)
+    transaction = next(transaction for transaction in transactions if transaction["amount"] < 0)
+    receipt = main.build_example_receipt(transaction, "receipt_0")
+    utc_seconds = matching.to_seconds(transaction["created"])
+    # The till's clock is an hour ahead of UTC, and says so.
+    local_time = datetime.fromtimestamp(utc_seconds + 3600, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+01:00")
+
+    engine = matching.MatchingEngine(transactions, window=60)
+    receipt.transaction_id = ""
+    matched, unmatched = engine.match([(receipt, local_time)])
+    assert (matched, unmatched) == ([receipt], [])
+    assert receipt.transaction_id == transaction["id"]
@@ -0,0 +1,44 @@
+import socket
+import time
+
+import pytest
+
+import config
+import errors
+import main
+import oauth2
+
+BASELINE_KEYS = ("MONZO_CLIENT_ID", "MONZO_CLIENT_SECRET", "MONZO_OAUTH_HOSTNAME", "MONZO_API_HOSTNAME",
+    "MONZO_RESPONSE_TYPE", "MONZO_AUTH_GRANT_TYPE", "MONZO_REFRESH_GRANT_TYPE", "MONZO_OAUTH_REDIRECT_URI",
+    "MONZO_CLIENT_IS_CONFIDENTIAL")
+
+
+def test_stalled_connection_times_out(monkeypatch):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    monkeypatch.setattr(config, "MONZO_API_HOSTNAME", "127.0.0.1:{}".format(listener.getsockname()[1]))
+    monkeypatch.setattr(config, "MONZO_HTTP_TIMEOUT", 0.2)
+    monkeypatch.setattr(config, "MONZO_HTTP_MAX_RETRIES", 0)
+    client = oauth2.OAuth2Client()
+    client._set_access_token("access_mock")
+
+    started = time.monotonic()
+    with pytest.raises(errors.TransientError):
+        client.api_get("ping/whoami", {})
+    assert time.monotonic() - started < 5
+    listener.close()
+
+
+def test_config_written_before_new_settings(api, monkeypatch):
+    # A config.py copied from the original config-example.py, pointed at the mock API.
+    for name in dir(config):
+        if name.startswith("MONZO_") and name not in BASELINE_KEYS + ("MONZO_API_SCHEME",):
+            monkeypatch.delattr(config, name)
+
+    api_client = oauth2.OAuth2Client()
+    api_client._auth_code = "mock"
+    api_client.exchange_auth_code()
+    client = main.ReceiptsClient(api_client, "acc_mock")
+    assert len(list(client.iter_transactions())) == 50
+    api_client._tokens.stop()
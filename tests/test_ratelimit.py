@@ -0,0 +1,41 @@
+import time
+
+import ratelimit
+
+
+def test_token_bucket_allows_burst_then_rate():
+    bucket = ratelimit.TokenBucket(100, 3)
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 0]
+    wait = bucket.try_acquire()
+    assert 0 < wait <= 0.01
+    time.sleep(wait)
+    assert bucket.try_acquire() == 0
+
+
+def test_concurrency_limit_halves_on_overload_and_grows_back():
+    limit = ratelimit.AdaptiveConcurrencyLimit(8, 1, 16, latency_target=1.0)
+    limit.acquire()
+    limit.release(0.1, overloaded=True)
+    assert limit.limit == 4
+    for _ in range(20):
+        limit.acquire()
+        limit.release(0.1)
+    assert limit.limit > 4
+
+
+def test_retry_after_pauses_requests():
+    limit = ratelimit.AdaptiveConcurrencyLimit(8, 1, 16, latency_target=1.0)
+    limit.acquire()
+    limit.release(0.1, retry_after=0.1)
+    started = time.monotonic()
+    limit.acquire()
+    assert time.monotonic() - started >= 0.09
+
+
+def test_client_requests_go_through_limiter(api, receipts_client):
+    limiter = receipts_client._api_client._rate_limiter
+    acquired = []
+    acquire = limiter.acquire
+    limiter.acquire = lambda endpoint, account: (acquired.append((endpoint, account)), acquire(endpoint, account))
+    receipts_client._api_client.api_get("transactions", {"account_id": receipts_client._account_id, "limit": 5})
+    assert acquired == [("transactions", receipts_client._account_id)]
@@ -0,0 +1,30 @@
+import main
+import receipt_hashes
+
+
+def test_unchanged_receipts_are_skipped(api, receipts_client, tmp_path):
+    uploader = receipt_hashes.ConditionalUploader(receipts_client._api_client,
+        receipt_hashes.ReceiptHashStore(str(tmp_path / "hashes.sqlite")))
+    receipt = main.build_example_receipt(api.transactions[0], "receipt_0")
+
+    assert uploader.put(receipt) is not None
+    requests_before = api.request_count
+    assert uploader.put(main.build_example_receipt(api.transactions[0], "receipt_0")) is None
+    assert api.request_count == requests_before
+
+    receipt.total += 1
+    assert uploader.put(receipt) is not None
+    stats = uploader.stats()
+    assert (stats["uploaded"], stats["skipped"]) == (2, 1)
+
+
+def test_reconcile_notices_receipts_changed_elsewhere(api, receipts_client, tmp_path):
+    uploader = receipt_hashes.ConditionalUploader(receipts_client._api_client,
+        receipt_hashes.ReceiptHashStore(str(tmp_path / "hashes.sqlite")))
+    for i, transaction in enumerate(api.transactions[:3]):
+        uploader.put(main.build_example_receipt(transaction, "receipt_{}".format(i)))
+    api.receipts["receipt_1"]["total"] += 1
+    del api.receipts["receipt_2"]
+
+    assert uploader.reconcile() == {"matching": 1, "changed": 1, "missing": 1}
+    assert not uploader.unchanged(main.build_example_receipt(api.transactions[1], "receipt_1"))
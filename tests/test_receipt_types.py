@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+import main
+import mock_server
+import receipt_types
+
+
+def example_receipt():
+    return main.build_example_receipt(mock_server.generate_transactions(1, 0)[0], "receipt_0")
+
+
+def test_marshal_matches_data():
+    receipt = example_receipt()
+    assert receipt.marshal() == json.dumps(receipt.data)
+    assert receipt_types.unmarshal(receipt.marshal()) == receipt
+
+
+def test_receipts_are_not_hashable():
+    receipt = example_receipt()
+    with pytest.raises(TypeError):
+        hash(receipt)
+    with pytest.raises(TypeError):
+        hash(receipt.items[0])
+
+
+def test_receipt_is_changed_through_attributes():
+    receipt = example_receipt()
+    receipt.data["total"] = 1
+    assert receipt.total != 1
+
+    receipt.total = 1
+    assert receipt.data["total"] == 1
+    assert json.loads(receipt.marshal())["total"] == 1
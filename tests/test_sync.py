@@ -0,0 +1,21 @@
+import sync
+
+
+def test_sync_is_incremental(api, receipts_client, tmp_path):
+    store = sync.TransactionStore(str(tmp_path / "sync.sqlite"))
+    engine = sync.SyncEngine(receipts_client, store, reconciliation_window=60 * 60, page_size=20)
+
+    assert engine.sync() == {"fetched": 50, "inserted": 50, "updated": 0}
+    # Transactions are 17 minutes apart, so the last hour holds the newest four again.
+    requests_before = api.request_count
+    assert engine.sync() == {"fetched": 4, "inserted": 0, "updated": 0}
+    assert api.request_count - requests_before == 1
+
+    account_id = receipts_client._account_id
+    assert [transaction["id"] for transaction in store.query(account_id)] == \
+        [transaction["id"] for transaction in api.transactions]
+    store.record_receipt(api.transactions[0]["id"], "receipt_0")
+    user_id = api.transactions[0]["user_id"]
+    assert [transaction["id"] for transaction in store.without_receipt(account_id, user_id, limit=2)] == \
+        [transaction["id"] for transaction in api.transactions[1:3]]
+    store.close()
@@ -0,0 +1,48 @@
+import threading
+
+from cryptography.fernet import Fernet
+
+import oauth2
+import tokens
+
+
+def test_rejected_token_is_refreshed_and_retried(api, receipts_client):
+    api_client = receipts_client._api_client
+    api_client._set_access_token("access_revoked")
+    api.revoked_tokens.add("access_revoked")
+
+    assert api_client.api_get("webhooks", {"account_id": receipts_client._account_id}) == {"webhooks": []}
+    assert api_client._access_token == "access_mock"
+
+
+def test_concurrent_refreshes_share_one_request():
+    refreshes = []
+    manager = tokens.TokenManager(lambda: refreshes.append(1) or manager.record({}), 300, background=False)
+    generation = manager.generation
+    threads = [threading.Thread(target=manager.refresh, args=(generation,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(refreshes) == 1
+
+
+def test_expiring():
+    manager = tokens.TokenManager(lambda: None, 300, background=False)
+    manager.record({"access_token": "a"}, expires_in=3600)
+    assert not manager.expiring()
+    manager.record({"access_token": "a"}, expires_in=60)
+    assert manager.expiring()
+
+
+def test_saved_tokens_are_restored(api, tmp_path):
+    store = tokens.TokenStore(str(tmp_path / "tokens.enc"), Fernet.generate_key())
+    api_client = oauth2.OAuth2Client(token_store=store, background_refresh=False)
+    api_client._auth_code = "mock"
+    api_client.exchange_auth_code()
+    assert b"access_mock" not in (tmp_path / "tokens.enc").read_bytes()
+
+    restored = oauth2.OAuth2Client(token_store=store, background_refresh=False)
+    assert restored.load_saved_tokens()
+    assert restored._user_id == "user_mock"
+    assert restored.api_get("ping/whoami", {})["authenticated"]
@@ -0,0 +1,36 @@
+import time
+
+import mock_server
+import run
+import tracing
+
+
+def test_bytes_in_counts_compressed_body():
+    api = mock_server.MockMonzoAPI(transactions=50, compress=True).start()
+    run.configure(api.hostname)
+    client = run.authorised_client()
+    try:
+        events = []
+        client._api_client.add_observer(events.append)
+        response = client._api_client._session.get(
+            "http://{}/transactions?account_id={}".format(api.hostname, mock_server.ACCOUNT_ID),
+            headers={"Authorization": "Bearer access_mock"})
+        client._api_client.api_get("transactions", {"account_id": mock_server.ACCOUNT_ID})
+    finally:
+        client._api_client._tokens.stop()
+        api.stop()
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert events[-1].bytes_in == int(response.headers["Content-Length"])
+    assert events[-1].bytes_in < len(response.content)
+
+
+def test_profiler_reports_sampled_functions():
+    def busy():
+        deadline = time.monotonic() + 0.2
+        while time.monotonic() < deadline:
+            pass
+
+    with tracing.SamplingProfiler(interval=0.001) as profiler:
+        busy()
+    assert any(function.endswith(":busy") and share > 0.5 for function, share in profiler.report(top=100))
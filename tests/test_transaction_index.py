@@ -0,0 +1,33 @@
+import random
+
+import mock_server
+import transaction_index
+
+
+def test_added_out_of_order_is_queried_in_order():
+    transactions = mock_server.generate_transactions(50)
+    shuffled = list(transactions)
+    random.Random(0).shuffle(shuffled)
+    index = transaction_index.TransactionIndex(shuffled[:10])
+    index.extend(shuffled[10:])
+
+    assert [transaction["id"] for transaction in index.query()] == \
+        [transaction["id"] for transaction in transactions]
+    since, before = transactions[10]["created"], transactions[20]["created"]
+    assert [transaction["id"] for transaction in index.query(since=since, before=before, newest_first=True)] == \
+        [transaction["id"] for transaction in reversed(transactions[10:20])]
+
+
+def test_without_receipt():
+    transactions = mock_server.generate_transactions(50)
+    index = transaction_index.TransactionIndex(transactions)
+    for transaction in transactions[:45]:
+        index.mark_receipt(transaction["id"])
+
+    assert [transaction["id"] for transaction in index.query(without_receipt=True)] == \
+        [transaction["id"] for transaction in transactions[45:]]
+    assert index.latest(without_receipt=True, before=transactions[48]["created"])["id"] == \
+        transactions[47]["id"]
+    user_id = transactions[0]["user_id"]
+    assert [transaction["id"] for transaction in index.query(user_id=user_id, without_receipt=True)] == \
+        [transaction["id"] for transaction in transactions[45:] if transaction["user_id"] == user_id]
@@ -0,0 +1,60 @@
+import main
+import mock_server
+import receipt_types
+import validation
+
+
+def example_receipts(count):
+    transactions = [transaction for transaction in mock_server.generate_transactions(count * 2)
+        if transaction["amount"] < 0][:count]
+    return [main.build_example_receipt(transaction, "receipt_{}".format(i))
+        for i, transaction in enumerate(transactions)]
+
+
+def changed(receipt, **fields):
+    data = receipt.data
+    data.update(fields)
+    return receipt_types.Receipt.from_data(data)
+
+
+def with_currency(receipt, currency):
+    # The receipt with every currency in it replaced, as nested ones default to the receipt's.
+    data = receipt.data
+    for field in ("items", "payments", "taxes"):
+        data[field] = [{key: value for key, value in element.items() if key != "currency"}
+            for element in data[field]]
+    for item in data["items"]:
+        item["sub_items"] = [{key: value for key, value in sub.items() if key != "currency"}
+            for sub in item["sub_items"]]
+    data["currency"] = currency
+    return receipt_types.Receipt.from_data(data)
+
+
+def test_flags():
+    receipt = example_receipts(1)[0]
+    receipts = [
+        receipt,
+        changed(receipt, total=receipt.total - 1),
+        changed(receipt, total=receipt.total - 0.5),
+        with_currency(receipt, ["GBP"]),
+        with_currency(receipt, "GB"),
+        changed(receipt, currency=7),
+        changed(receipt, currency="EUR", items=[dict(item.data, currency="GBP") for item in receipt.items],
+            payments=[dict(payment.data, currency="EUR") for payment in receipt.payments]),
+    ]
+    assert [validation.describe(code) for code in validation.validate_receipts(receipts)] == [
+        [],
+        ["items_total_mismatch"],
+        ["invalid_amount", "items_total_mismatch"],
+        ["invalid_currency"],
+        ["invalid_currency"],
+        ["currency_mismatch", "invalid_currency"],
+        ["currency_mismatch"],
+    ]
+
+
+def test_chunks_agree_with_one_batch():
+    receipts = example_receipts(20)
+    receipts[7] = with_currency(receipts[7], ["GBP"])
+    assert list(validation.validate_receipts(receipts, processes=2, chunk_size=6)) == \
+        list(validation.validate_receipts(receipts))
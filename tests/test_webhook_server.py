@@ -0,0 +1,51 @@
+import asyncio
+import json
+import socket
+
+import aiohttp
+
+import async_client
+import main
+import webhook_server
+
+
+def receive(receipts_client, transactions, dead_letter_path):
+    # Delivers a transaction.created event for each transaction to a receiver on a free
+    # port, and returns the receiver's metrics once it has drained.
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    async def session():
+        api_client = async_client.AsyncOAuth2Client.from_client(receipts_client._api_client)
+        async with api_client:
+            receiver = webhook_server.WebhookReceiver(
+                async_client.AsyncReceiptsClient(api_client, receipts_client._account_id),
+                lambda transaction: main.build_example_receipt(transaction, transaction["id"]),
+                str(dead_letter_path), workers=2, backoff=0)
+            await receiver.start("127.0.0.1", port)
+            async with aiohttp.ClientSession() as http:
+                for transaction in transactions:
+                    async with http.post("http://127.0.0.1:{}/".format(port),
+                        json={"type": "transaction.created", "data": transaction}) as response:
+                        assert response.status == 200
+            await receiver.stop()
+            return receiver.metrics()
+    return asyncio.run(session())
+
+
+def test_uploads_receipt_for_each_event(api, receipts_client, tmp_path):
+    metrics = receive(receipts_client, api.transactions[:3], tmp_path / "dead_letters.jsonl")
+    assert metrics["uploaded"] == 3
+    assert sorted(api.receipts) == sorted(transaction["id"] for transaction in api.transactions[:3])
+
+
+def test_failed_upload_is_retried_then_dead_lettered(api, receipts_client, tmp_path):
+    dead_letter_path = tmp_path / "dead_letters.jsonl"
+    api.error_rate = 1.0
+    metrics = receive(receipts_client, api.transactions[:1], dead_letter_path)
+
+    assert (metrics["uploaded"], metrics["failed"], metrics["retries"]) == (0, 1, 2)
+    dead_letters = [json.loads(line) for line in dead_letter_path.read_text().splitlines()]
+    assert [dead_letter["transaction"]["id"] for dead_letter in dead_letters] == [api.transactions[0]["id"]]
+    assert dead_letters[0]["receipt"]["transaction_id"] == api.transactions[0]["id"]
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+
+# Token lifecycle support for oauth2.OAuth2Client: tracking when the access token
+# expires, refreshing it before it does, and keeping tokens on disk between runs so
+# that a restarted client does not have to go through the interactive auth flow.
+
+class TokenStore:
+    ''' Persists tokens to a local file, encrypted with a Fernet key. Generate a key with
+        python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+    '''
+
+    def __init__(self, path, key):
+        self._path = path
+        self._fernet = Fernet(key)
+
+
+    def load(self):
+        ''' Returns the saved tokens, or None if there are none or they cannot be decrypted. '''
+
+        try:
+            with open(self._path, "rb") as token_file:
+                return json.loads(self._fernet.decrypt(token_file.read()))
+        except (FileNotFoundError, InvalidToken, ValueError):
+            return None
+
+
+    def save(self, tokens):
+        temp_path = self._path + ".tmp"
+        file_descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(file_descriptor, "wb") as token_file:
+            token_file.write(self._fernet.encrypt(json.dumps(tokens).encode("utf-8")))
+        os.replace(temp_path, self._path)
+
+
+    def clear(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+class TokenManager:
+    ''' Tracks the expiry of the current access token and refreshes it with the refresh
+        callable, both in the background ahead of expiry and on demand. Refreshes are
+        single-flight: callers that ask for a refresh while one is in progress wait for it
+        and share its result instead of sending their own request to the token endpoint.
+        With background set to False, no timer thread is kept and tokens are only refreshed
+        on demand, which suits processes holding tokens for many users.
+    '''
+
+    def __init__(self, refresh, refresh_margin, store=None, background=True):
+        self._refresh = refresh
+        self._background = background
+        self._refresh_margin = refresh_margin
+        self._store = store
+        self._refresh_lock = threading.Lock()
+        self._timer = None
+        self._expires_at = None
+        self.generation = 0
+        # Incremented every time new tokens are recorded, so that a caller holding a stale
+        # generation can tell whether someone else has already refreshed.
+
+
+    def record(self, tokens, expires_in=None):
+        ''' Records newly issued tokens, persists them and schedules the next refresh. '''
+
+        self._expires_at = time.time() + expires_in if expires_in else None
+        self.generation += 1
+        if self._store is not None:
+            self._store.save(dict(tokens, expires_at=self._expires_at))
+        if tokens.get("refresh_token"):
+            self._schedule()
+
+
+    def load(self):
+        ''' Loads persisted tokens, returning them or None. '''
+
+        if self._store is None:
+            return None
+        tokens = self._store.load()
+        if tokens is None:
+            return None
+
+        self._expires_at = tokens.pop("expires_at", None)
+        self.generation += 1
+        if tokens.get("refresh_token"):
+            self._schedule()
+        return tokens
+
+
+    def clear(self):
+        ''' Forgets the current tokens and deletes any persisted ones. '''
+
+        self.stop()
+        self._expires_at = None
+        self.generation += 1
+        if self._store is not None:
+            self._store.clear()
+
+
+    def expiring(self):
+        return self._expires_at is not None and time.time() >= self._expires_at - self._refresh_margin
+
+
+    def refresh(self, generation=None):
+        ''' Refreshes the access token, unless it has been refreshed since `generation`. '''
+
+        with self._refresh_lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._refresh()
+
+
+    def refresh_if_expiring(self):
+        if self.expiring():
+            self.refresh(self.generation)
+
+
+    def _schedule(self):
+        self.stop()
+        if self._expires_at is None or not self._background:
+            return
+        delay = max(self._expires_at - self._refresh_margin - time.time(), 0)
+        self._timer = threading.Timer(delay, self._background_refresh, args=(self.generation,))
+        self._timer.daemon = True
+        self._timer.start()
+
+
+    def _background_refresh(self, generation):
+        try:
+            self.refresh(generation)
+        except Exception as e:
+            # Left to the next API call to refresh on demand.
+            print("Warning: background token refresh failed: {}".format(e))
+
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -0,0 +1,248 @@
+import collections
+import json
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Per-request instrumentation for oauth2.OAuth2Client. Observers added with
+# OAuth2Client.add_observer() are called with a RequestEvent after every request sent to
+# the API, including each retry after a 401. With no observers, no event is built.
+
+RequestEvent = namedtuple("RequestEvent", [
+    "method",       # HTTP method.
+    "endpoint",     # First segment of the API path, e.g. "transactions".
+    "status",       # HTTP status code, or None if the request failed without a response.
+    "started_at",   # Wall clock time the request was sent, in seconds since the epoch.
+    "connect",      # Seconds spent on DNS resolution and TCP connect, 0 on a kept-alive connection.
+    "tls",          # Seconds spent on the TLS handshake, 0 on a kept-alive connection.
+    "ttfb",         # Seconds until the response headers were received.
+    "total",        # Seconds until the response was fully read.
+    "bytes_out",    # Size of the request body.
+    "bytes_in",     # Size of the response body as received, before it is decompressed.
+    "retries",      # Attempts retried by the session before this response.
+    "error",        # Description of the failure if the request raised, otherwise None.
+])
+
+_connection_timings = threading.local()
+# Connections are opened on the thread sending the request, so their timings can be
+# handed over to the event for that request through a thread local.
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        started = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            _connection_timings.connect = time.perf_counter() - started
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        started = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            _connection_timings.connect = time.perf_counter() - started
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connection_timings.tls = time.perf_counter() - started - getattr(_connection_timings, "connect", 0)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    ''' An HTTPAdapter whose connections record how long connecting and the TLS handshake
+        took, for take_connection_timings().
+    '''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+def received_bytes(response, streamed=False):
+    ''' Returns the size of a response body as it was received, before it was decompressed.
+        A streamed body has not been read yet, and must not be read here, so its
+        Content-Length is given instead.
+    '''
+    if not streamed:
+        tell = getattr(response.raw, "tell", None)
+        if tell is not None:
+            return tell()
+    return int(response.headers.get("Content-Length") or 0)
+
+
+def take_connection_timings():
+    ''' Returns and resets (connect, tls) timings of connections opened on this thread. '''
+
+    timings = (getattr(_connection_timings, "connect", 0), getattr(_connection_timings, "tls", 0))
+    _connection_timings.connect = 0
+    _connection_timings.tls = 0
+    return timings
+
+
+class JsonLinesExporter:
+    ''' Writes each event as a line of JSON to a file. '''
+
+    def __init__(self, path):
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+
+    def __call__(self, event):
+        line = json.dumps(event._asdict())
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+    def close(self):
+        self._file.close()
+
+
+class PrometheusExporter:
+    ''' Aggregates events into request counters, byte counters and latency histograms by
+        method, endpoint and status, rendered in the Prometheus text exposition format.
+    '''
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = collections.Counter()
+        self._retries = collections.Counter()
+        self._bytes_in = collections.Counter()
+        self._bytes_out = collections.Counter()
+        self._buckets = collections.defaultdict(lambda: [0] * (len(self.BUCKETS) + 1))
+        self._sums = collections.Counter()
+
+
+    def __call__(self, event):
+        labels = (event.method, event.endpoint, str(event.status))
+        with self._lock:
+            self._requests[labels] += 1
+            self._retries[labels] += event.retries
+            self._bytes_in[labels] += event.bytes_in
+            self._bytes_out[labels] += event.bytes_out
+            self._sums[labels] += event.total
+            buckets = self._buckets[labels]
+            for i, bound in enumerate(self.BUCKETS):
+                if event.total <= bound:
+                    buckets[i] += 1
+            buckets[-1] += 1
+
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, kind, counter in (
+                ("monzo_api_requests_total", "counter", self._requests),
+                ("monzo_api_retries_total", "counter", self._retries),
+                ("monzo_api_received_bytes_total", "counter", self._bytes_in),
+                ("monzo_api_sent_bytes_total", "counter", self._bytes_out),
+            ):
+                lines.append("# TYPE {} {}".format(name, kind))
+                for labels, value in sorted(counter.items()):
+                    lines.append("{}{{{}}} {}".format(name, self._labels(labels), value))
+
+            lines.append("# TYPE monzo_api_request_duration_seconds histogram")
+            for labels, buckets in sorted(self._buckets.items()):
+                for bound, count in zip(self.BUCKETS + ("+Inf",), buckets):
+                    lines.append('monzo_api_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                        self._labels(labels), bound, count))
+                lines.append("monzo_api_request_duration_seconds_sum{{{}}} {}".format(
+                    self._labels(labels), self._sums[labels]))
+                lines.append("monzo_api_request_duration_seconds_count{{{}}} {}".format(
+                    self._labels(labels), buckets[-1]))
+        return "\n".join(lines) + "\n"
+
+
+    @staticmethod
+    def _labels(labels):
+        return 'method="{}",endpoint="{}",status="{}"'.format(*labels)
+
+
+class SamplingProfiler:
+    ''' A low-overhead profiler which, while running, samples the stacks of all threads
+        every `interval` seconds and counts the functions seen. Can be used as a context
+        manager around a workload.
+    '''
+
+    def __init__(self, interval=0.005):
+        self._interval = interval
+        self._samples = 0
+        self._counts = collections.Counter()
+        # The counts are updated by the sampling thread while a report may be taken.
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        self._running.set()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def _sample(self):
+        own_thread = threading.get_ident()
+        while self._running.is_set():
+            sample = collections.Counter()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    seen.add("{}:{}:{}".format(code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                # Counted once per sample however deep the recursion.
+                sample.update(seen)
+            with self._lock:
+                self._counts.update(sample)
+                self._samples += 1
+            time.sleep(self._interval)
+
+
+    def report(self, top=20):
+        ''' Returns the functions most often on a stack, with the share of samples. '''
+
+        with self._lock:
+            samples = self._samples
+            most_common = self._counts.most_common(top)
+        return [(function, count / samples) for function, count in most_common] if samples else []
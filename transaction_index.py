@@ -0,0 +1,180 @@
+import bisect
+from collections import defaultdict
+
+from utils import merchant_id
+
+# An in-memory index over loaded transactions, for answering many lookups without scanning
+# them all each time: hash indexes by ID, user and merchant, and sorted indexes by created
+# time and amount which are searched by bisection. Transactions can be added one at a time
+# as new pages or webhook events arrive. An addition in order, as new transactions mostly
+# are, is appended to a sorted index; one out of order leaves the index to be sorted again
+# before it is next searched, so that adding many costs one sort rather than a list
+# insertion each.
+
+class TransactionIndex:
+    ''' Indexes transactions as returned by the API. Range queries bisect a sorted index
+        to find where the range starts, and then only touch the transactions in it.
+    '''
+
+    def __init__(self, transactions=()):
+        self._by_id = {}
+        self._by_user = defaultdict(list)
+        self._by_merchant = defaultdict(list)
+        self._by_created = []
+        self._by_amount = []
+        self._unsorted = {}
+        # Sorted indexes with keys appended out of order, by id().
+        self._with_receipt = set()
+        self._without_receipt = set()
+
+        # Built with one sort per index, rather than an insertion each.
+        for transaction in transactions:
+            self._by_id[transaction["id"]] = transaction
+        for transaction in self._by_id.values():
+            key = (transaction["created"], transaction["id"])
+            self._by_created.append(key)
+            self._by_amount.append((transaction["amount"], transaction["created"], transaction["id"]))
+            self._by_user[transaction.get("user_id") or None].append(key)
+            self._by_merchant[merchant_id(transaction)].append(key)
+        self._without_receipt.update(self._by_id)
+        for keys in [self._by_created, self._by_amount] + list(self._by_user.values()) + \
+            list(self._by_merchant.values()):
+            keys.sort()
+
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._by_id
+
+
+    def get(self, transaction_id):
+        return self._by_id.get(transaction_id)
+
+
+    def add(self, transaction):
+        ''' Adds a transaction, replacing a previous version of it if indexed already. '''
+
+        previous = self._by_id.get(transaction["id"])
+        if previous is not None:
+            self._remove(previous)
+        self._by_id[transaction["id"]] = transaction
+        if transaction["id"] not in self._with_receipt:
+            self._without_receipt.add(transaction["id"])
+        key = (transaction["created"], transaction["id"])
+        self._append(self._by_created, key)
+        self._append(self._by_amount, (transaction["amount"], transaction["created"], transaction["id"]))
+        self._append(self._by_user[transaction.get("user_id") or None], key)
+        self._append(self._by_merchant[merchant_id(transaction)], key)
+
+
+    def _append(self, keys, key):
+        if keys and key < keys[-1]:
+            self._unsorted[id(keys)] = keys
+        keys.append(key)
+
+
+    def _sort(self):
+        # Called before a sorted index is searched. Timsort merges the appended run into
+        # the sorted one in linear time.
+        for keys in self._unsorted.values():
+            keys.sort()
+        self._unsorted.clear()
+
+
+    def extend(self, transactions):
+        for transaction in transactions:
+            self.add(transaction)
+
+
+    def _remove(self, transaction):
+        self._sort()
+        key = (transaction["created"], transaction["id"])
+        for keys, item in ((self._by_created, key),
+            (self._by_amount, (transaction["amount"], transaction["created"], transaction["id"])),
+            (self._by_user[transaction.get("user_id") or None], key),
+            (self._by_merchant[merchant_id(transaction)], key)):
+            del keys[bisect.bisect_left(keys, item)]
+
+
+    def mark_receipt(self, transaction_id):
+        ''' Records that a receipt was attached to a transaction. '''
+
+        self._with_receipt.add(transaction_id)
+        self._without_receipt.discard(transaction_id)
+
+
+    def has_receipt(self, transaction_id):
+        return transaction_id in self._with_receipt
+
+
+    @staticmethod
+    def _created_range(keys, since, before):
+        # Indexes of the (created, id) keys created in [since, before).
+        start = 0 if since is None else bisect.bisect_left(keys, (since,))
+        end = len(keys) if before is None else bisect.bisect_left(keys, (before,))
+        return start, end
+
+
+    def query(self, user_id=None, merchant=None, since=None, before=None, min_amount=None, max_amount=None,
+        without_receipt=False, predicate=None, newest_first=False):
+        ''' Yields the transactions matching all the conditions given, oldest first unless
+            newest_first is set. since and before are RFC 3339 timestamps, amounts are in
+            minor units, and predicate(transaction) can add any other condition. Transactions
+            are read from the user's or merchant's index if one is given, otherwise from the
+            created time or amount index, so that only the range in it is visited.
+        '''
+        self._sort()
+        amount_range = min_amount is not None or max_amount is not None
+        if user_id is not None or merchant is not None or since is not None or before is not None \
+            or not amount_range:
+            if user_id is not None:
+                keys = self._by_user.get(user_id, [])
+            elif merchant is not None:
+                keys = self._by_merchant.get(merchant, [])
+            else:
+                keys = self._by_created
+            start, end = self._created_range(keys, since, before)
+            if without_receipt and len(self._without_receipt) < end - start:
+                # Fewer transactions lack a receipt than are in the range, so only they are
+                # visited, and checked against the range below.
+                matches = sorted((self._by_id[transaction_id]["created"], transaction_id)
+                    for transaction_id in self._without_receipt)
+                candidates = (self._by_id[key[1]] for key in (reversed(matches) if newest_first else matches))
+            else:
+                positions = range(end - 1, start - 1, -1) if newest_first else range(start, end)
+                candidates = (self._by_id[keys[i][1]] for i in positions)
+        else:
+            start = 0 if min_amount is None else bisect.bisect_left(self._by_amount, (min_amount,))
+            end = len(self._by_amount) if max_amount is None \
+                else bisect.bisect_left(self._by_amount, (max_amount + 1,))
+            matches = sorted(self._by_amount[start:end], key=lambda key: (key[1], key[2]),
+                reverse=newest_first)
+            candidates = (self._by_id[key[2]] for key in matches)
+
+        for transaction in candidates:
+            if user_id is not None and (transaction.get("user_id") or None) != user_id:
+                continue
+            if merchant is not None and merchant_id(transaction) != merchant:
+                continue
+            if since is not None and transaction["created"] < since:
+                continue
+            if before is not None and transaction["created"] >= before:
+                continue
+            if min_amount is not None and transaction["amount"] < min_amount:
+                continue
+            if max_amount is not None and transaction["amount"] > max_amount:
+                continue
+            if without_receipt and transaction["id"] in self._with_receipt:
+                continue
+            if predicate is not None and not predicate(transaction):
+                continue
+            yield transaction
+
+
+    def latest(self, **kwargs):
+        ''' Returns the most recent transaction matching the conditions of query(), or None. '''
+
+        return next(self.query(newest_first=True, **kwargs), None)
@@ -3,3 +3,10 @@ import sys
 def error(message):
     print("Error: {}".format(message))
     sys.exit(1)
+
+def merchant_id(transaction):
+    # The merchant is an ID, or an object if the listing was expanded with expand[]=merchant.
+    merchant = transaction.get("merchant")
+    if isinstance(merchant, dict):
+        return merchant.get("id")
+    return merchant or None
@@ -0,0 +1,220 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Consistency checks of receipt_types.Receipts before upload, so that bad receipts are
+# caught locally rather than after a round trip to the API. A batch of receipts is laid
+# out in columns: one array per field of each nested type, with the index of the parent
+# of every element, so that every check is a handful of array operations over the whole
+# batch rather than a Python loop per receipt. Each receipt gets an error code made of
+# the flags below, 0 if it is consistent.
+
+INVALID_AMOUNT = 1 << 0 # An amount is not a whole number of minor units.
+INVALID_QUANTITY = 1 << 1 # A quantity is not a positive number.
+NON_POSITIVE_TOTAL = 1 << 2
+ITEMS_TOTAL_MISMATCH = 1 << 3 # The items do not add up to the total.
+SUB_ITEMS_MISMATCH = 1 << 4 # The sub-items of an item do not add up to its amount.
+PAYMENTS_SHORT = 1 << 5 # The payments do not cover the total.
+CURRENCY_MISMATCH = 1 << 6 # An item, payment or tax is in another currency than the receipt.
+TAX_INVALID = 1 << 7 # A tax amount is negative, or the taxes exceed the total.
+INVALID_CURRENCY = 1 << 8 # A currency is not a three-letter code.
+
+ERROR_NAMES = {
+    INVALID_AMOUNT: "invalid_amount",
+    INVALID_QUANTITY: "invalid_quantity",
+    NON_POSITIVE_TOTAL: "non_positive_total",
+    ITEMS_TOTAL_MISMATCH: "items_total_mismatch",
+    SUB_ITEMS_MISMATCH: "sub_items_mismatch",
+    PAYMENTS_SHORT: "payments_short",
+    CURRENCY_MISMATCH: "currency_mismatch",
+    TAX_INVALID: "tax_invalid",
+    INVALID_CURRENCY: "invalid_currency",
+}
+
+
+def describe(code):
+    ''' Returns the names of the errors in an error code. '''
+
+    return [name for flag, name in sorted(ERROR_NAMES.items()) if code & flag]
+
+
+_NUMBER_TYPES = (int, float)
+_INVALID_CURRENCY_CODE = -1
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError):
+        return math.nan
+
+
+def _numbers(values):
+    # Values which are not numbers, such as booleans, strings or nested lists, become NaN
+    # and are flagged by the checks. Plain ints and floats take the quick path.
+    if all(type(value) in _NUMBER_TYPES for value in values):
+        try:
+            return np.array(values, dtype=np.float64)
+        except OverflowError:
+            pass
+    return np.array([_number(value) for value in values], dtype=np.float64)
+
+
+def _currency_codes():
+    # Returns a function numbering the currencies it is given in order of appearance.
+    # Anything but a string of three letters, such as a list or "", is given
+    # _INVALID_CURRENCY_CODE, and flagged as INVALID_CURRENCY.
+    codes = {}
+
+    def code(currency):
+        number = codes.get(currency) if type(currency) is str else None
+        if number is None:
+            if type(currency) is not str or len(currency) != 3 or not currency.isascii() \
+                or not currency.isalpha():
+                return _INVALID_CURRENCY_CODE
+            number = codes[currency] = len(codes)
+        return number
+    return code
+
+
+class ReceiptBatch:
+    ''' Receipts laid out in columns. Items, sub-items, payments and taxes each have arrays
+        of their amounts, quantities and currency codes, and of the index of their parent:
+        the receipt, or for sub-items the item.
+    '''
+
+    def __init__(self, receipts):
+        code = _currency_codes()
+        totals, receipt_currencies = [], []
+        item_amounts, item_quantities, item_currencies, item_parents = [], [], [], []
+        sub_item_amounts, sub_item_quantities, sub_item_currencies, sub_item_parents = [], [], [], []
+        payment_amounts, payment_currencies, payment_parents = [], [], []
+        tax_amounts, tax_currencies, tax_parents = [], [], []
+
+        for i, receipt in enumerate(receipts):
+            totals.append(receipt.total)
+            receipt_currencies.append(code(receipt.currency))
+            for item in receipt.items:
+                for sub_item in item.sub_items:
+                    sub_item_amounts.append(sub_item.amount)
+                    sub_item_quantities.append(sub_item.quantity)
+                    sub_item_currencies.append(code(sub_item.currency))
+                    sub_item_parents.append(len(item_amounts))
+                item_amounts.append(item.amount)
+                item_quantities.append(item.quantity)
+                item_currencies.append(code(item.currency))
+                item_parents.append(i)
+            for payment in receipt.payments:
+                payment_amounts.append(payment.amount)
+                payment_currencies.append(code(payment.currency))
+                payment_parents.append(i)
+            for tax in receipt.taxes:
+                tax_amounts.append(tax.amount)
+                tax_currencies.append(code(tax.currency))
+                tax_parents.append(i)
+
+        self.size = len(totals)
+        self.totals = _numbers(totals)
+        self.currencies = np.array(receipt_currencies, dtype=np.int32)
+        self.item_amounts = _numbers(item_amounts)
+        self.item_quantities = _numbers(item_quantities)
+        self.item_currencies = np.array(item_currencies, dtype=np.int32)
+        self.item_parents = np.array(item_parents, dtype=np.int64)
+        self.sub_item_amounts = _numbers(sub_item_amounts)
+        self.sub_item_quantities = _numbers(sub_item_quantities)
+        self.sub_item_currencies = np.array(sub_item_currencies, dtype=np.int32)
+        self.sub_item_parents = np.array(sub_item_parents, dtype=np.int64)
+        self.payment_amounts = _numbers(payment_amounts)
+        self.payment_currencies = np.array(payment_currencies, dtype=np.int32)
+        self.payment_parents = np.array(payment_parents, dtype=np.int64)
+        self.tax_amounts = _numbers(tax_amounts)
+        self.tax_currencies = np.array(tax_currencies, dtype=np.int32)
+        self.tax_parents = np.array(tax_parents, dtype=np.int64)
+
+
+    def _any(self, parents, condition):
+        # Whether each receipt has an element for which the condition holds.
+        return np.bincount(parents[condition], minlength=self.size) > 0
+
+
+    def _sum(self, parents, amounts):
+        return np.bincount(parents, weights=amounts, minlength=self.size)
+
+
+    def validate(self):
+        ''' Returns an array with the error code of each receipt. '''
+
+        codes = np.zeros(self.size, dtype=np.uint32)
+        with np.errstate(invalid="ignore"):
+            invalid_amount = self.totals != np.floor(self.totals)
+            for amounts, parents in ((self.item_amounts, self.item_parents),
+                (self.payment_amounts, self.payment_parents), (self.tax_amounts, self.tax_parents)):
+                invalid_amount |= self._any(parents, amounts != np.floor(amounts))
+            invalid_amount |= self._any(self.item_parents[self.sub_item_parents],
+                self.sub_item_amounts != np.floor(self.sub_item_amounts))
+            codes[invalid_amount] |= INVALID_AMOUNT
+
+            # NaN quantities fail the comparison, and are caught as well.
+            invalid_quantity = self._any(self.item_parents, ~(self.item_quantities > 0)) | \
+                self._any(self.item_parents[self.sub_item_parents], ~(self.sub_item_quantities > 0))
+            codes[invalid_quantity] |= INVALID_QUANTITY
+
+            codes[~(self.totals > 0)] |= NON_POSITIVE_TOTAL
+
+            has_items = np.bincount(self.item_parents, minlength=self.size) > 0
+            items_total = self._sum(self.item_parents, self.item_amounts)
+            codes[has_items & (items_total != self.totals)] |= ITEMS_TOTAL_MISMATCH
+
+            item_count = len(self.item_amounts)
+            has_sub_items = np.bincount(self.sub_item_parents, minlength=item_count) > 0
+            sub_items_total = np.bincount(self.sub_item_parents, weights=self.sub_item_amounts,
+                minlength=item_count)
+            codes[self._any(self.item_parents, has_sub_items & (sub_items_total != self.item_amounts))] \
+                |= SUB_ITEMS_MISMATCH
+
+            has_payments = np.bincount(self.payment_parents, minlength=self.size) > 0
+            payments_total = self._sum(self.payment_parents, self.payment_amounts)
+            codes[has_payments & ~(payments_total >= self.totals)] |= PAYMENTS_SHORT
+
+            currency_mismatch = self._any(self.item_parents, self.item_currencies != self.currencies[self.item_parents])
+            currency_mismatch |= self._any(self.item_parents[self.sub_item_parents],
+                self.sub_item_currencies != self.currencies[self.item_parents[self.sub_item_parents]])
+            currency_mismatch |= self._any(self.payment_parents,
+                self.payment_currencies != self.currencies[self.payment_parents])
+            currency_mismatch |= self._any(self.tax_parents, self.tax_currencies != self.currencies[self.tax_parents])
+            codes[currency_mismatch] |= CURRENCY_MISMATCH
+
+            invalid_currency = self.currencies == _INVALID_CURRENCY_CODE
+            for currencies, parents in ((self.item_currencies, self.item_parents),
+                (self.sub_item_currencies, self.item_parents[self.sub_item_parents]),
+                (self.payment_currencies, self.payment_parents), (self.tax_currencies, self.tax_parents)):
+                invalid_currency |= self._any(parents, currencies == _INVALID_CURRENCY_CODE)
+            codes[invalid_currency] |= INVALID_CURRENCY
+
+            tax_invalid = self._any(self.tax_parents, ~(self.tax_amounts >= 0))
+            tax_invalid |= self._sum(self.tax_parents, self.tax_amounts) > self.totals
+            codes[tax_invalid] |= TAX_INVALID
+        return codes
+
+
+def _validate_chunk(receipts):
+    return ReceiptBatch(receipts).validate()
+
+
+def validate_receipts(receipts, processes=None, chunk_size=100000):
+    ''' Returns an array with the error code of each receipt, 0 for a valid receipt.
+        Batches larger than chunk_size are split into chunks, which are laid out and
+        validated by a pool of `processes` processes, one per CPU by default.
+    '''
+    receipts = list(receipts)
+    processes = processes or os.cpu_count() or 1
+    if len(receipts) <= chunk_size or processes == 1:
+        return _validate_chunk(receipts)
+
+    chunks = [receipts[start:start + chunk_size] for start in range(0, len(receipts), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return np.concatenate(list(pool.map(_validate_chunk, chunks)))
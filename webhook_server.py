@@ -0,0 +1,269 @@
+import asyncio
+import bisect
+import json
+import signal
+import time
+import uuid
+from collections import OrderedDict
+
+from aiohttp import web
+
+import async_client
+import config
+import errors
+
+# A receiver for the webhooks registered with ReceiptsClient.example_register_webhook().
+# Monzo calls it with a transaction.created event for every new transaction. The
+# receiver only acknowledges the event and puts it on a bounded queue, and a pool of
+# workers builds a receipt for the transaction and uploads it. When the queue is full,
+# events are refused with a 503 so that Monzo delivers them again later, rather than
+# letting the backlog grow without bound. An event is acknowledged before its receipt is
+# uploaded, so Monzo will not deliver it again if the upload fails: transient failures
+# are retried with backoff, and a receipt which still cannot be uploaded is written to a
+# dead-letter file with its transaction, to be uploaded again once fixed.
+
+class LatencyHistogram:
+    ''' Counts latencies into fixed buckets, in milliseconds. '''
+
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self._total = 0
+        self._sum_ms = 0
+
+
+    def observe(self, seconds):
+        milliseconds = seconds * 1000
+        self._counts[bisect.bisect_left(self.BUCKETS_MS, milliseconds)] += 1
+        self._total += 1
+        self._sum_ms += milliseconds
+
+
+    def percentile(self, quantile):
+        ''' Returns the upper bound of the bucket holding the given quantile. '''
+
+        if self._total == 0:
+            return 0
+        rank = quantile * self._total
+        seen = 0
+        for bound, count in zip(self.BUCKETS_MS + (float("inf"),), self._counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+    def snapshot(self):
+        return {
+            "count": self._total,
+            "mean_ms": self._sum_ms / self._total if self._total else 0,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "buckets": dict(zip(["le_{}".format(bound) for bound in self.BUCKETS_MS] + ["le_inf"],
+                self._counts)),
+        }
+
+
+class WebhookReceiver:
+    ''' Receives transaction.created webhooks and attaches a receipt to each transaction.
+        build_receipt(transaction) returns the receipt_types.Receipt to upload, or None
+        to leave the transaction alone. Failed uploads are appended to dead_letter_path, as
+        JSON lines holding the transaction, the receipt and the error.
+    '''
+
+    def __init__(self, receipts_client, build_receipt, dead_letter_path, workers=8, queue_size=1000,
+        dedup_size=100000, max_attempts=3, backoff=1.0):
+        self._receipts_client = receipts_client
+        self._build_receipt = build_receipt
+        self._dead_letter_path = dead_letter_path
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._worker_count = workers
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._dedup_size = dedup_size
+        self._seen = OrderedDict()
+        self._workers = []
+        self._runner = None
+        self._site = None
+        self._stopping = False
+
+        self._histograms = {stage: LatencyHistogram() for stage in ("ack", "queued", "upload", "total")}
+        self._counts = {"received": 0, "duplicates": 0, "ignored": 0, "rejected": 0,
+            "uploaded": 0, "failed": 0, "retries": 0}
+
+
+    async def handle_event(self, request):
+        received_at = time.monotonic()
+        if self._stopping:
+            # Events queued now could be lost before a worker gets to them.
+            self._counts["rejected"] += 1
+            return web.Response(status=503)
+        try:
+            event = await request.json()
+            transaction = event["data"]
+            transaction_id = transaction["id"]
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+
+        self._counts["received"] += 1
+        if event.get("type") != "transaction.created":
+            self._counts["ignored"] += 1
+        elif transaction_id in self._seen:
+            # Monzo delivers again when it does not get a timely acknowledgement.
+            self._counts["duplicates"] += 1
+        else:
+            try:
+                self._queue.put_nowait((received_at, transaction))
+            except asyncio.QueueFull:
+                self._counts["rejected"] += 1
+                return web.Response(status=503)
+            self._mark_seen(transaction_id)
+
+        self._histograms["ack"].observe(time.monotonic() - received_at)
+        return web.Response(status=200)
+
+
+    async def handle_metrics(self, request):
+        return web.json_response(self.metrics())
+
+
+    def _mark_seen(self, transaction_id):
+        self._seen[transaction_id] = True
+        if len(self._seen) > self._dedup_size:
+            self._seen.popitem(last=False)
+
+
+    async def _work(self):
+        while True:
+            received_at, transaction = await self._queue.get()
+            try:
+                dequeued_at = time.monotonic()
+                self._histograms["queued"].observe(dequeued_at - received_at)
+                await self._process(transaction)
+                self._histograms["upload"].observe(time.monotonic() - dequeued_at)
+                self._histograms["total"].observe(time.monotonic() - received_at)
+            finally:
+                self._queue.task_done()
+
+
+    async def _process(self, transaction):
+        receipt = None
+        try:
+            receipt = self._build_receipt(transaction)
+            if receipt is None:
+                self._counts["ignored"] += 1
+                return
+            await self._upload(receipt)
+        except Exception as e:
+            self._counts["failed"] += 1
+            print("Failed to upload receipt for transaction {}: {}".format(transaction["id"], e))
+            self._dead_letter(transaction, receipt, e)
+            return
+        self._counts["uploaded"] += 1
+
+
+    async def _upload(self, receipt):
+        # The async client does not retry, so transient failures are retried here, after
+        # the delay asked for by the API if it gave one.
+        for attempt in range(self._max_attempts):
+            try:
+                return await self._receipts_client.put_receipt(receipt)
+            except errors.APIError as e:
+                if not errors.is_retryable(e) or attempt == self._max_attempts - 1:
+                    raise
+                delay = max(self._backoff * 2 ** attempt, e.retry_after or 0)
+            self._counts["retries"] += 1
+            await asyncio.sleep(delay)
+
+
+    def _dead_letter(self, transaction, receipt, reason):
+        # Failures are rare enough for a blocking append to be harmless to the event loop.
+        with open(self._dead_letter_path, "a") as dead_letters:
+            dead_letters.write(json.dumps({
+                "transaction": transaction,
+                "receipt": receipt.data if receipt is not None else None,
+                "error": str(reason),
+            }) + "\n")
+
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_post("/", self.handle_event)
+        app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        self._site = web.TCPSite(self._runner, host, port)
+        await self._site.start()
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self._worker_count)]
+
+
+    async def stop(self, drain_timeout=30):
+        ''' Stops accepting events, then waits up to drain_timeout seconds for the workers to
+            finish the events already queued.
+        '''
+        self._stopping = True
+        if self._site is not None:
+            await self._site.stop()
+        try:
+            await asyncio.wait_for(self._queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print("Shutting down with {} events left undrained".format(self._queue.qsize()))
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+    def metrics(self):
+        metrics = dict(self._counts)
+        metrics["queue_depth"] = self._queue.qsize()
+        for stage, histogram in self._histograms.items():
+            metrics["{}_latency".format(stage)] = histogram.snapshot()
+        return metrics
+
+
+async def serve(receipts_client, build_receipt):
+    receiver = WebhookReceiver(receipts_client, build_receipt,
+        getattr(config, "MONZO_WEBHOOK_DEAD_LETTER_PATH", "webhook_dead_letters.jsonl"),
+        getattr(config, "MONZO_WEBHOOK_WORKERS", 8),
+        getattr(config, "MONZO_WEBHOOK_QUEUE_SIZE", 1000))
+    host = getattr(config, "MONZO_WEBHOOK_LISTEN_HOST", "0.0.0.0")
+    port = getattr(config, "MONZO_WEBHOOK_LISTEN_PORT", 8080)
+    await receiver.start(host, port)
+    print("Listening for webhooks on {}:{}".format(host, port))
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopping.set)
+    await stopping.wait()
+
+    print("Draining queued events...")
+    await receiver.stop()
+    await receipts_client._api_client.close()
+    print("Webhook receiver stopped: ", json.dumps(receiver.metrics(), indent=4, sort_keys=True))
+
+
+if __name__ == "__main__":
+    import main
+    from utils import error
+
+    client = main.ReceiptsClient()
+    try:
+        client.do_auth()
+    except errors.MonzoError as e:
+        error(e)
+
+    def build_receipt(transaction):
+        # Receipts can only be added to transactions initiated by the user.
+        if transaction.get("user_id") != client._api_client._user_id:
+            return None
+        return main.build_example_receipt(transaction, uuid.uuid4().hex)
+
+    async def run():
+        api_client = async_client.AsyncOAuth2Client.from_client(client._api_client)
+        await serve(async_client.AsyncReceiptsClient(api_client, client._account_id), build_receipt)
+
+    asyncio.run(run())